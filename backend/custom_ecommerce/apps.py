@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class CustomEcommerceConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'custom_ecommerce'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,220 @@
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, F, OuterRef
+from django.utils import timezone
+
+from .models import Cart, CartItem, Product, primary_images_prefetch
+
+
+class InsufficientStock(Exception):
+    """Raised when a cart line would hold more units than the product has in stock"""
+
+    def __init__(self, product_id, available=None):
+        self.product_id = product_id
+        self.available = available
+        super().__init__(f"Only {available} items available in stock" if available is not None
+                         else "Not enough items available in stock")
+
+
+def _stock_covers(quantity):
+    """Correlated EXISTS that is true when the line's product has ``quantity`` units in stock"""
+    return Exists(Product.objects.filter(pk=OuterRef('product_id'), stock__gte=quantity))
+
+
+def _increment_line(cart_id, product_id, quantity):
+    """
+    Add ``quantity`` to an existing line in one UPDATE that also checks stock,
+    so concurrent requests can neither lose an increment nor oversell.
+    """
+    return CartItem.objects.filter(
+        _stock_covers(OuterRef('quantity') + quantity),
+        cart_id=cart_id,
+        product_id=product_id,
+    ).update(quantity=F('quantity') + quantity, updated_on=timezone.now())
+
+
+def _available_stock(product_id):
+    return Product.objects.filter(pk=product_id).values_list('stock', flat=True).first()
+
+
+def get_cart_line(cart_id, product_id):
+    return CartItem.objects.select_related('product').prefetch_related(
+        primary_images_prefetch('product__images')
+    ).filter(cart_id=cart_id, product_id=product_id).first()
+
+
+def get_open_user_cart(user):
+    """The signed in user's most recent cart that has not been ordered, created when missing"""
+    cart = Cart.objects.filter(user=user, is_ordered=False).order_by('-id').first()
+    if cart is None:
+        cart = Cart.objects.create(user=user, is_guest=False, email=user.email or None)
+    return cart
+
+
+def get_cart_totals(cart_id):
+    totals = Cart.objects.filter(pk=cart_id).with_totals().values('items_quantity', 'items_subtotal').first()
+    if totals is None:
+        return {'total_items': 0, 'subtotal': Decimal('0.00')}
+    return {'total_items': totals['items_quantity'], 'subtotal': totals['items_subtotal']}
+
+
+def add_to_cart(cart_id, product, quantity):
+    """
+    Increment the (cart, product) line by ``quantity`` or create it.
+
+    The update-then-insert runs without reading the line first. If the insert
+    loses a race against another request creating the same line, the unique
+    (cart, product) constraint rejects it and the increment is retried.
+    """
+    if _increment_line(cart_id, product.pk, quantity):
+        return
+
+    try:
+        with transaction.atomic():
+            if not Product.objects.filter(pk=product.pk, stock__gte=quantity).exists():
+                raise InsufficientStock(product.pk, _available_stock(product.pk))
+            CartItem.objects.create(
+                cart_id=cart_id,
+                product=product,
+                quantity=quantity,
+                price=product.sale_price or product.price
+            )
+    except IntegrityError:
+        # The line exists, so the first update failed on stock or the line was created concurrently
+        if not _increment_line(cart_id, product.pk, quantity):
+            raise InsufficientStock(product.pk, _available_stock(product.pk))
+
+
+def set_cart_quantity(cart_id, product_id, quantity):
+    """
+    Set a line to ``quantity`` (removing it when ``quantity`` <= 0) with the stock check in the same UPDATE.
+    Raises CartItem.DoesNotExist when the line is not in the cart.
+    """
+    if quantity <= 0:
+        if not remove_from_cart(cart_id, product_id):
+            raise CartItem.DoesNotExist
+        return
+
+    updated = CartItem.objects.filter(
+        _stock_covers(quantity),
+        cart_id=cart_id,
+        product_id=product_id,
+    ).update(quantity=quantity, updated_on=timezone.now())
+
+    if not updated:
+        if not CartItem.objects.filter(cart_id=cart_id, product_id=product_id).exists():
+            raise CartItem.DoesNotExist
+        raise InsufficientStock(product_id, _available_stock(product_id))
+
+
+def remove_from_cart(cart_id, product_id):
+    deleted, _ = CartItem.objects.filter(cart_id=cart_id, product_id=product_id).delete()
+    return bool(deleted)
+
+
+class CartOperationError(Exception):
+    """Raised with one error per rejected operation when a batch of cart operations cannot be applied"""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("Cart operations could not be applied")
+
+
+def fold_cart_operations(quantities, operations, products):
+    """
+    Fold ``{'op': 'add'|'set'|'remove', 'product_id': ..., 'quantity': ...}`` operations in order into the
+    ``quantities`` mapping of product id to quantity. ``products`` holds the active products by id.
+    Returns one error per rejected operation or product, the mapping is updated either way.
+    """
+    errors = []
+    for index, operation in enumerate(operations):
+        product_id = operation['product_id']
+        current = quantities.get(product_id, 0)
+        if operation['op'] == 'add':
+            quantities[product_id] = current + operation.get('quantity', 1)
+        elif operation['op'] == 'set':
+            quantities[product_id] = max(operation['quantity'], 0)
+        else:
+            quantities[product_id] = 0
+
+        if quantities[product_id] and product_id not in products:
+            errors.append({'index': index, 'product_id': product_id, 'error': 'Product not found'})
+
+    for product_id, quantity in quantities.items():
+        product = products.get(product_id)
+        if product is not None and quantity > product.stock:
+            errors.append({
+                'product_id': product_id,
+                'error': f"Only {product.stock} items available in stock"
+            })
+    return errors
+
+
+def write_cart_lines(cart_id, quantities, lines, products, prices=None):
+    """
+    Bring the cart's lines in line with ``quantities`` using one bulk_create, bulk_update and delete.
+    ``lines`` maps product id to the existing CartItem, ``prices`` optionally overrides the unit price of new lines.
+    """
+    prices = prices or {}
+    now = timezone.now()
+    to_create, to_update, to_delete = [], [], []
+    for product_id, quantity in quantities.items():
+        line = lines.get(product_id)
+        if line is None:
+            if quantity:
+                product = products[product_id]
+                to_create.append(CartItem(
+                    cart_id=cart_id,
+                    product=product,
+                    quantity=quantity,
+                    price=prices.get(product_id) or product.sale_price or product.price
+                ))
+        elif not quantity:
+            to_delete.append(line.pk)
+        elif quantity != line.quantity:
+            line.quantity = quantity
+            line.updated_on = now
+            to_update.append(line)
+
+    if to_create:
+        CartItem.objects.bulk_create(to_create)
+    if to_update:
+        CartItem.objects.bulk_update(to_update, ['quantity', 'updated_on'])
+    if to_delete:
+        CartItem.objects.filter(pk__in=to_delete).delete()
+
+
+def apply_cart_operations(cart_id, operations):
+    """
+    Apply a list of cart operations (see fold_cart_operations) in one transaction. All products are loaded
+    with a single ``in_bulk`` and nothing is written if any operation fails validation.
+
+    Only existing lines can be locked, so a concurrent request may create a line for one of the batch's new
+    products first. The unique (cart, product) constraint then rejects the insert and, like in add_to_cart,
+    the batch is folded again over the lines as they are now.
+    """
+    product_ids = {operation['product_id'] for operation in operations}
+
+    with transaction.atomic():
+        products = Product.objects.filter(is_active=True).in_bulk(product_ids)
+        # Every retry finds at least one more existing line, so there is at most one per product
+        for attempt in range(len(product_ids) + 1):
+            # Lock the lines touched by the batch so single line actions wait for it
+            lines = {
+                line.product_id: line
+                for line in CartItem.objects.select_for_update().filter(cart_id=cart_id, product_id__in=product_ids)
+            }
+
+            quantities = {product_id: line.quantity for product_id, line in lines.items()}
+            errors = fold_cart_operations(quantities, operations, products)
+            if errors:
+                raise CartOperationError(errors)
+
+            try:
+                with transaction.atomic():
+                    write_cart_lines(cart_id, quantities, lines, products)
+                return
+            except IntegrityError:
+                if attempt == len(product_ids):
+                    raise
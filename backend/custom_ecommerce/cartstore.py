@@ -0,0 +1,279 @@
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from decimal import Decimal
+from functools import lru_cache
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .cart import CartOperationError, fold_cart_operations, get_open_user_cart, write_cart_lines
+from .models import Cart, CartItem, Product
+
+# The guest cart key travels in a signed cookie, so guest cart requests never read or write the session table
+GUEST_CART_COOKIE_SALT = 'custom_ecommerce.guest_cart'
+
+
+class CartBusyError(CartOperationError):
+    """Raised when another request kept the guest cart locked for longer than the store waits"""
+
+    def __init__(self):
+        super().__init__(["The cart is being updated by another request, try again"])
+
+
+@dataclass
+class StoredCart:
+    """A guest cart as kept by a cart store, ``items`` maps product id to [quantity, unit price in cents]"""
+    key: str
+    cart_id: Optional[int] = None
+    # When the first change not yet written to the database was made, 0 when in sync
+    dirty_since: float = 0
+    items: Dict[int, list] = field(default_factory=dict)
+
+    def to_compact(self):
+        return (self.cart_id, self.dirty_since, [(pid, qty, cents) for pid, (qty, cents) in self.items.items()])
+
+    @classmethod
+    def from_compact(cls, key, data):
+        cart_id, dirty_since, items = data
+        return cls(key=key, cart_id=cart_id, dirty_since=dirty_since,
+                   items={pid: [qty, cents] for pid, qty, cents in items})
+
+    @property
+    def quantities(self):
+        return {product_id: quantity for product_id, (quantity, _) in self.items.items()}
+
+    @property
+    def prices(self):
+        return {product_id: Decimal(cents) / 100 for product_id, (_, cents) in self.items.items()}
+
+
+def get_guest_cart_key(request, create=True):
+    """
+    The caller's guest cart key from the GUEST_CART_COOKIE signed cookie. A new key is made up when there is
+    none and ``create`` is set, ``remember_guest_cart_key`` then sends it back with the response.
+    """
+    key = getattr(request, '_guest_cart_key', None) or request.get_signed_cookie(
+        settings.GUEST_CART_COOKIE, default=None, salt=GUEST_CART_COOKIE_SALT
+    )
+    if key is None and create:
+        key = uuid.uuid4().hex
+        request._guest_cart_key = key
+        request._guest_cart_key_is_new = True
+    return key
+
+
+def remember_guest_cart_key(request, response):
+    """Set the guest cart cookie on ``response`` when the request was given a new key"""
+    if getattr(request, '_guest_cart_key_is_new', False):
+        response.set_signed_cookie(
+            settings.GUEST_CART_COOKIE, request._guest_cart_key, salt=GUEST_CART_COOKIE_SALT,
+            max_age=settings.GUEST_CART_TTL, httponly=True, samesite='Lax',
+            secure=settings.SESSION_COOKIE_SECURE
+        )
+    return response
+
+
+class BaseCartStore:
+    """
+    Keeps guest carts out of the database. Subclasses implement ``load``, ``save``, ``delete`` and ``lock``,
+    the store writes a cart to Cart/CartItem through ``persist`` at checkout and on the write-behind interval.
+    Read-modify-write sequences on a cart run inside ``lock(key)`` so concurrent updates cannot overwrite
+    each other.
+    """
+
+    def __init__(self, write_behind_seconds=None):
+        if write_behind_seconds is None:
+            write_behind_seconds = getattr(settings, 'GUEST_CART_WRITE_BEHIND_SECONDS', 0)
+        self.write_behind_seconds = write_behind_seconds
+
+    def load(self, key) -> StoredCart:
+        raise NotImplementedError
+
+    def save(self, cart: StoredCart):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def lock(self, key):
+        """Context manager holding the cart ``key`` exclusively, raises CartBusyError when it cannot"""
+        raise NotImplementedError
+
+    def apply(self, key, operations) -> StoredCart:
+        """
+        Apply cart operations to the stored cart with the same validation as
+        cart.apply_cart_operations. Raises CartOperationError when nothing could be applied.
+        """
+        with self.lock(key):
+            return self._apply(key, operations)
+
+    def _apply(self, key, operations):
+        cart = self.load(key)
+        product_ids = {operation['product_id'] for operation in operations}
+        products = Product.objects.filter(is_active=True).in_bulk(product_ids)
+
+        quantities = cart.quantities
+        errors = fold_cart_operations(quantities, operations, products)
+        if errors:
+            raise CartOperationError(errors)
+
+        for product_id, quantity in quantities.items():
+            if not quantity:
+                cart.items.pop(product_id, None)
+            elif product_id in cart.items:
+                cart.items[product_id][0] = quantity
+            else:
+                product = products[product_id]
+                price = product.sale_price or product.price
+                cart.items[product_id] = [quantity, int(price * 100)]
+
+        now = time.time()
+        cart.dirty_since = cart.dirty_since or now
+        if self.write_behind_seconds and now - cart.dirty_since >= self.write_behind_seconds:
+            # Carts that keep changing reach the database once per interval, abandoned ones never do
+            self.persist(cart)
+        else:
+            self.save(cart)
+        return cart
+
+    def persist(self, cart: StoredCart) -> Cart:
+        """
+        Write the stored cart to Cart/CartItem, creating the row the first time. The row's ``session_id`` is
+        the guest cart key, which is how CartViewSet finds the caller's carts. Call it holding ``lock``.
+        """
+        with transaction.atomic():
+            db_cart = None
+            if cart.cart_id:
+                db_cart = Cart.objects.filter(
+                    pk=cart.cart_id, session_id=cart.key, user__isnull=True, is_ordered=False
+                ).first()
+            if db_cart is None:
+                db_cart = Cart.objects.create(session_id=cart.key, is_guest=True)
+
+            quantities = cart.quantities
+            lines = {line.product_id: line for line in CartItem.objects.select_for_update().filter(cart=db_cart)}
+            for product_id in lines.keys() - quantities.keys():
+                quantities[product_id] = 0
+            products = Product.objects.in_bulk(quantities.keys() - lines.keys())
+            # Products deleted since they were added cannot be written
+            for product_id in quantities.keys() - lines.keys() - products.keys():
+                quantities.pop(product_id)
+            write_cart_lines(db_cart.pk, quantities, lines, products, prices=cart.prices)
+
+        cart.cart_id = db_cart.pk
+        cart.dirty_since = 0
+        self.save(cart)
+        return db_cart
+
+
+class CacheCartStore(BaseCartStore):
+    """
+    Keeps guest carts in a Django cache in compact tuple form. The cart lock is a cache key taken with
+    ``cache.add``, which only one caller can win, and it expires after ``lock_timeout`` seconds so a
+    crashed request cannot keep the cart locked.
+    """
+
+    key_prefix = 'guest-cart'
+    lock_timeout = 10
+    lock_wait = 2
+
+    def __init__(self, cache_alias=None, timeout=None, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = caches[cache_alias or getattr(settings, 'GUEST_CART_CACHE_ALIAS', 'default')]
+        self.timeout = timeout if timeout is not None else getattr(settings, 'GUEST_CART_TTL', 60 * 60 * 24 * 7)
+
+    def _cache_key(self, key):
+        return f"{self.key_prefix}:{key}"
+
+    def load(self, key):
+        data = self.cache.get(self._cache_key(key))
+        if data is None:
+            return StoredCart(key=key)
+        return StoredCart.from_compact(key, data)
+
+    def save(self, cart):
+        self.cache.set(self._cache_key(cart.key), cart.to_compact(), self.timeout)
+
+    def delete(self, key):
+        self.cache.delete(self._cache_key(key))
+
+    @contextmanager
+    def lock(self, key):
+        lock_key = f"{self._cache_key(key)}:lock"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.lock_wait
+        while not self.cache.add(lock_key, token, self.lock_timeout):
+            if time.monotonic() >= deadline:
+                raise CartBusyError()
+            time.sleep(0.01)
+        try:
+            yield
+        finally:
+            if self.cache.get(lock_key) == token:
+                self.cache.delete(lock_key)
+
+
+class LocMemCartStore(CacheCartStore):
+    """Cache store backed by its own in-process cache, for tests and single process development"""
+
+    def __init__(self, timeout=None, **kwargs):
+        BaseCartStore.__init__(self, **kwargs)
+        self.cache = LocMemCache('guest-carts', {})
+        self.timeout = timeout if timeout is not None else getattr(settings, 'GUEST_CART_TTL', 60 * 60 * 24 * 7)
+
+
+@lru_cache(maxsize=None)
+def get_cart_store() -> BaseCartStore:
+    """Return the guest cart store configured by ``GUEST_CART_STORE``"""
+    return import_string(getattr(settings, 'GUEST_CART_STORE', 'custom_ecommerce.cartstore.CacheCartStore'))()
+
+
+@receiver(setting_changed)
+def reset_cart_store(sender, setting, **kwargs):
+    if setting.startswith('GUEST_CART_') or setting == 'CACHES':
+        get_cart_store.cache_clear()
+
+
+def merge_guest_cart(key, user):
+    """
+    Move a guest cart into the user's open cart. Quantities are added and capped at the available stock,
+    products that are no longer active are dropped. Returns the user's cart or None if there was nothing to merge.
+    """
+    store = get_cart_store()
+    with store.lock(key):
+        return _merge_guest_cart(store, key, user)
+
+
+def _merge_guest_cart(store, key, user):
+    guest_cart = store.load(key)
+    if not guest_cart.items:
+        store.delete(key)
+        return None
+
+    with transaction.atomic():
+        user_cart = get_open_user_cart(user)
+
+        lines = {line.product_id: line for line in CartItem.objects.select_for_update().filter(cart=user_cart)}
+        products = Product.objects.filter(is_active=True).in_bulk(guest_cart.items.keys())
+        quantities = {}
+        for product_id, quantity in guest_cart.quantities.items():
+            product = products.get(product_id)
+            if product is None:
+                continue
+            current = lines[product_id].quantity if product_id in lines else 0
+            quantities[product_id] = min(current + quantity, max(product.stock, current))
+        write_cart_lines(user_cart.pk, quantities, lines, products, prices=guest_cart.prices)
+
+        if guest_cart.cart_id:
+            Cart.objects.filter(pk=guest_cart.cart_id, is_ordered=False, user__isnull=True).delete()
+
+    store.delete(key)
+    return user_cart
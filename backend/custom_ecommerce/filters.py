@@ -1,5 +1,6 @@
 import django_filters
 from django.db.models import F
+from rest_framework import filters
 from .models import Product
 
 
@@ -28,4 +29,31 @@ class ProductFilter(django_filters.FilterSet):
     def filter_in_stock(self, queryset, name, value):
         if value:
             return queryset.filter(stock__gt=0)
-        return queryset 
\ No newline at end of file
+        return queryset 
+
+class ProductOrderingFilter(filters.OrderingFilter):
+    """
+    OrderingFilter that also accepts ``popularity`` and ``trending``, most popular first, which sort on the
+    indexed leaderboard columns. ``-popularity`` reverses them like any other field.
+    """
+    aliases = {
+        'popularity': '-units_sold',
+        'trending': '-trending_score',
+    }
+
+    def get_ordering(self, request, queryset, view):
+        params = request.query_params.get(self.ordering_param)
+        if params:
+            fields = [self.resolve_alias(param.strip()) for param in params.split(',')]
+            ordering = self.remove_invalid_fields(queryset, fields, view, request)
+            if ordering:
+                return ordering
+        return self.get_default_ordering(view)
+
+    def resolve_alias(self, term):
+        target = self.aliases.get(term.lstrip('-'))
+        if target is None:
+            return term
+        if term.startswith('-'):
+            return target[1:] if target.startswith('-') else f'-{target}'
+        return target
@@ -0,0 +1,60 @@
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import Order, OrderItem, Product
+from .reservations import convert_order_holds
+
+
+def decrement_stock(quantities):
+    """
+    Take ``quantities`` (product id to units) out of stock. Every line is a conditional
+    ``UPDATE ... SET stock = stock - n WHERE id = ? AND stock >= n`` so concurrent decrements can never take
+    a product below zero, and a line that matched no row is one that could not be covered.
+    Returns the product ids that were short.
+    """
+    short = []
+    for product_id, quantity in sorted(quantities.items()):
+        # Sorted so concurrent orders lock the product rows in the same order
+        updated = Product.objects.filter(pk=product_id, stock__gte=quantity).update(stock=F('stock') - quantity)
+        if not updated:
+            short.append(product_id)
+    return short
+
+
+def commit_order_stock(order):
+    """
+    Take a paid order's units out of stock in one transaction and record the outcome on the order.
+
+    Lines with enough stock are decremented, lines without are listed in ``Order.stock_shortfall`` and the
+    order is marked short so staff can follow up. The order row is claimed first, so an order that was
+    already committed (e.g. a repeated IPN) is left alone. Returns the order's stock status.
+    """
+    with transaction.atomic():
+        order_row = Order.objects.select_for_update().filter(pk=order.pk).values('stock_status').first()
+        if order_row is None or order_row['stock_status'] != Order.STOCK_PENDING:
+            return order_row and order_row['stock_status']
+
+        quantities = dict(
+            OrderItem.objects.filter(order=order).order_by().values('product_id').annotate(
+                total=Sum('quantity')
+            ).values_list('product_id', 'total')
+        )
+        short = decrement_stock(quantities)
+
+        shortfall = None
+        if short:
+            available = dict(Product.objects.filter(pk__in=short).values_list('pk', 'stock'))
+            shortfall = [
+                {'product_id': product_id, 'requested': quantities[product_id], 'available': available.get(product_id, 0)}
+                for product_id in short
+            ]
+        stock_status = Order.STOCK_SHORT if short else Order.STOCK_COMMITTED
+        Order.objects.filter(pk=order.pk).update(
+            stock_status=stock_status, stock_shortfall=shortfall, updated_on=timezone.now()
+        )
+        convert_order_holds(order)
+
+    order.stock_status = stock_status
+    order.stock_shortfall = shortfall
+    return stock_status
@@ -0,0 +1,163 @@
+"""
+Best-seller and trending product leaderboards.
+
+Paid orders are counted into ``Product.units_sold`` and ``Product.trending_score`` in batches by
+``update_leaderboards`` (``manage.py update_leaderboards``), each order exactly once thanks to the
+``Order.popularity_counted`` claim. Both columns are indexed, so ordering products by them never aggregates
+order items, and the top of each ranking is kept as a short list of product ids in a Leaderboard row.
+
+Trending uses forward decay: a sale placed at ``t`` adds ``units * exp(rate * (t - landmark))`` to the score,
+with ``rate = ln 2 / TRENDING_HALF_LIFE_DAYS``. Every stored score shrinks by the same factor as time passes,
+so the stored values rank products exactly like their decayed scores without rewriting any row.
+``current_trending_score`` gives the decayed value. Once the exponents get large the landmark is moved
+forward and the scores are rescaled with one UPDATE.
+"""
+import math
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Leaderboard, Order, OrderItem, Product
+
+BEST_SELLERS = 'best_sellers'
+TRENDING = 'trending'
+
+RANKINGS = {
+    # leaderboard: Product column it ranks by
+    BEST_SELLERS: 'units_sold',
+    TRENDING: 'trending_score',
+}
+
+# Largest exponent before the landmark is moved forward, far from float overflow
+MAX_EXPONENT = 50
+
+
+def decay_rate():
+    """Decay per second of the trending scores"""
+    return math.log(2) / (settings.TRENDING_HALF_LIFE_DAYS * 86400)
+
+
+def get_landmark():
+    """The reference time of the stored trending scores, set on first use"""
+    board, created = Leaderboard.objects.get_or_create(name=TRENDING, defaults={'landmark': timezone.now()})
+    if board.landmark is None:
+        board.landmark = timezone.now()
+        board.save(update_fields=['landmark'])
+    return board.landmark
+
+
+def sale_weight(placed_on, landmark):
+    return math.exp(decay_rate() * (placed_on - landmark).total_seconds())
+
+
+def current_trending_score(product, now=None):
+    """``product``'s trending score decayed to ``now``"""
+    landmark = get_landmark()
+    return product.trending_score / sale_weight(now or timezone.now(), landmark)
+
+
+@transaction.atomic
+def rebase_trending(now=None):
+    """Move the landmark to ``now`` and rescale every trending score, the ranking stays the same"""
+    now = now or timezone.now()
+    board = Leaderboard.objects.select_for_update().get(name=TRENDING)
+    factor = 1 / sale_weight(now, board.landmark)
+    Product.objects.filter(trending_score__gt=0).update(trending_score=F('trending_score') * factor)
+    board.landmark = now
+    board.save(update_fields=['landmark'])
+
+
+def aggregate_sales(order_ids, landmark):
+    """{product_id: (units, trending weight)} of the items of the orders"""
+    totals = defaultdict(lambda: [0, 0.0])
+    items = OrderItem.objects.filter(order_id__in=order_ids).values_list(
+        'product_id', 'quantity', 'order__created_on'
+    )
+    for product_id, quantity, placed_on in items.iterator():
+        totals[product_id][0] += quantity
+        totals[product_id][1] += quantity * sale_weight(placed_on, landmark)
+    return totals
+
+
+@transaction.atomic
+def count_orders(order_ids, landmark):
+    """
+    Add the paid orders among ``order_ids`` that are not counted yet to the product columns, returns how
+    many were added. The claim on ``Order.popularity_counted`` makes calling it again a no-op.
+    """
+    claimed = list(
+        Order.objects.select_for_update()
+        .filter(pk__in=order_ids, is_paid=True, popularity_counted=False)
+        .order_by('pk').values_list('pk', flat=True)
+    )
+    if not claimed:
+        return 0
+    Order.objects.filter(pk__in=claimed).update(popularity_counted=True)
+
+    # Product rows are updated in primary key order so concurrent batches cannot deadlock
+    for product_id, (units, weight) in sorted(aggregate_sales(claimed, landmark).items()):
+        Product.objects.filter(pk=product_id).update(
+            units_sold=F('units_sold') + units, trending_score=F('trending_score') + weight
+        )
+    return len(claimed)
+
+
+def refresh_leaderboards(size=None):
+    """Store the top ``size`` active products of every ranking, returns {leaderboard: product ids}"""
+    size = size or settings.LEADERBOARD_SIZE
+    boards = {}
+    for name, column in RANKINGS.items():
+        product_ids = list(
+            Product.objects.filter(is_active=True, **{f'{column}__gt': 0})
+            .order_by(f'-{column}', 'pk').values_list('pk', flat=True)[:size]
+        )
+        Leaderboard.objects.update_or_create(name=name, defaults={'product_ids': product_ids})
+        boards[name] = product_ids
+    return boards
+
+
+def update_leaderboards(batch_size=500, rebuild=False, stdout=None):
+    """
+    Count every paid order not counted yet, ``batch_size`` orders per transaction, then refresh the top-N
+    lists. ``rebuild`` zeroes the columns first so all history is recounted, run it while no orders are
+    being paid. Returns the number of orders counted.
+    """
+    if rebuild:
+        with transaction.atomic():
+            Product.objects.update(units_sold=0, trending_score=0)
+            Order.objects.filter(popularity_counted=True).update(popularity_counted=False)
+            Leaderboard.objects.filter(name=TRENDING).update(landmark=timezone.now())
+
+    landmark = get_landmark()
+    if decay_rate() * (timezone.now() - landmark).total_seconds() > MAX_EXPONENT:
+        rebase_trending()
+        landmark = get_landmark()
+
+    last_id = 0
+    total = 0
+    while True:
+        batch = list(
+            Order.objects.filter(is_paid=True, popularity_counted=False, pk__gt=last_id)
+            .order_by('pk').values_list('pk', flat=True)[:batch_size]
+        )
+        if not batch:
+            break
+        last_id = batch[-1]
+        total += count_orders(batch, landmark)
+        if stdout:
+            stdout.write(f"Counted {total} orders (up to order id {last_id})")
+
+    refresh_leaderboards()
+    return total
+
+
+def leaderboard_products(name, queryset, limit=None):
+    """The products of leaderboard ``name`` found in ``queryset``, in leaderboard order"""
+    board = Leaderboard.objects.filter(name=name).values_list('product_ids', flat=True).first() or []
+    if limit:
+        board = board[:limit]
+    products = queryset.in_bulk(board)
+    return [products[pk] for pk in board if pk in products]
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from custom_ecommerce.rollups import backfill_rollups
+
+
+class Command(BaseCommand):
+    help = "Add paid orders that are not in the daily sales rollups yet, in chunks"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Orders aggregated per transaction")
+        parser.add_argument(
+            '--rebuild', action='store_true',
+            help="Empty the rollups and recount every paid order, run it while no orders are being paid"
+        )
+
+    def handle(self, *args, **options):
+        total = backfill_rollups(chunk_size=options['chunk_size'], rebuild=options['rebuild'], stdout=self.stdout)
+        self.stdout.write(f"Rolled up {total} orders")
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from custom_ecommerce.reservations import expire_stale_holds
+
+
+class Command(BaseCommand):
+    help = "Mark stock holds past their expiry as expired, in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--loop', type=int, default=0,
+            help="Keep sweeping every LOOP seconds instead of exiting after one pass"
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            expired = expire_stale_holds(batch_size=options['batch_size'])
+            self.stdout.write(f"Expired {expired} stock holds")
+            if not options['loop']:
+                return
+            time.sleep(options['loop'])
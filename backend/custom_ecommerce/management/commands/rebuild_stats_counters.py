@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from custom_ecommerce.stats import rebuild_counters
+
+
+class Command(BaseCommand):
+    help = "Recompute the ecommerce dashboard counters from the orders, transactions and catalogue tables"
+
+    def handle(self, *args, **options):
+        for name, value in sorted(rebuild_counters().items()):
+            self.stdout.write(f"{name}: {value}")
@@ -0,0 +1,44 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from custom_ecommerce.reconciliation import reconcile_pending_transactions
+from utils.gateways import get_payment_gateway
+
+
+class Command(BaseCommand):
+    help = "Check stale PENDING transactions with the payment gateway and apply the ones that have settled"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stale-minutes', type=int, default=30,
+                            help="Only check transactions pending for at least this long")
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--concurrency', type=int, default=8, help="Status requests in flight at once")
+        parser.add_argument('--rate', type=float, default=10, help="Status requests per second, 0 for no limit")
+        parser.add_argument('--loop', type=int, default=0,
+                            help="Keep reconciling every LOOP seconds instead of exiting after one pass")
+
+    def handle(self, *args, **options):
+        gateway = get_payment_gateway()
+        while True:
+            summary = reconcile_pending_transactions(
+                gateway,
+                stale_after=timedelta(minutes=options['stale_minutes']),
+                batch_size=options['batch_size'],
+                concurrency=options['concurrency'],
+                rate=options['rate'],
+                stdout=self.stdout,
+            )
+            checked = summary.get('checked', 0)
+            seconds = summary.get('seconds') or 0
+            self.stdout.write(
+                f"Checked {checked} transactions in {seconds}s "
+                f"({checked / seconds if seconds else 0:.1f}/s): {summary.get('COMPLETED', 0)} completed, "
+                f"{summary.get('FAILED', 0)} failed, {summary.get('errors', 0)} lookups failed"
+            )
+            if summary.get('stopped'):
+                self.stdout.write(f"Stopped early, the gateway is unavailable: {summary['stopped']}")
+            if not options['loop']:
+                return
+            time.sleep(options['loop'])
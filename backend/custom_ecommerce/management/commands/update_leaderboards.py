@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from custom_ecommerce.leaderboards import update_leaderboards
+
+
+class Command(BaseCommand):
+    help = "Count newly paid orders into the best-seller and trending leaderboards, run it every few minutes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Orders counted per transaction")
+        parser.add_argument(
+            '--rebuild', action='store_true',
+            help="Zero the leaderboards and recount every paid order, run it while no orders are being paid"
+        )
+
+    def handle(self, *args, **options):
+        total = update_leaderboards(
+            batch_size=options['batch_size'], rebuild=options['rebuild'], stdout=self.stdout
+        )
+        self.stdout.write(f"Counted {total} orders")
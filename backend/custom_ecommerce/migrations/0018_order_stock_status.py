@@ -0,0 +1,23 @@
+# Generated by Django 4.2.1 on 2026-10-19 13:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('custom_ecommerce', '0017_stockhold'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='stock_shortfall',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='stock_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('committed', 'Committed'), ('short', 'Short')], default='pending', max_length=10),
+        ),
+    ]
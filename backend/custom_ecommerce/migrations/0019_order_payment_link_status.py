@@ -0,0 +1,24 @@
+# Generated by Django 4.2.1 on 2026-10-19 13:11
+
+from django.db import migrations, models
+
+
+def mark_existing_links_ready(apps, schema_editor):
+    Order = apps.get_model('custom_ecommerce', 'Order')
+    Order.objects.exclude(payment_url__isnull=True).exclude(payment_url='').update(payment_link_status='ready')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('custom_ecommerce', '0018_order_stock_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='payment_link_status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('ready', 'Ready'), ('failed', 'Failed')], default='queued', max_length=10),
+        ),
+        migrations.RunPython(mark_existing_links_ready, migrations.RunPython.noop),
+    ]
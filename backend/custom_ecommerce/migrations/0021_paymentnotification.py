@@ -0,0 +1,33 @@
+# Generated by Django 4.2.1 on 2026-10-19 13:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('custom_ecommerce', '0020_ordernumberblock'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentNotification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('updated_on', models.DateTimeField(auto_now=True)),
+                ('order_tracking_id', models.CharField(max_length=100)),
+                ('merchant_reference', models.CharField(blank=True, max_length=100)),
+                ('notification_type', models.CharField(blank=True, max_length=50)),
+                ('payload', models.JSONField(default=dict)),
+                ('status', models.CharField(choices=[('received', 'Received'), ('processing', 'Processing'), ('processed', 'Processed'), ('failed', 'Failed')], default='received', max_length=10)),
+                ('claim_token', models.CharField(blank=True, max_length=32)),
+                ('processed_on', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+            ],
+            options={
+                'ordering': ['-id'],
+                'indexes': [models.Index(fields=['order_tracking_id', 'status'], name='paymentnotif_tracking_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.2.1 on 2026-10-19 15:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('custom_ecommerce', '0021_paymentnotification'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='transaction',
+            old_name='pesapal_merchant_reference',
+            new_name='merchant_reference',
+        ),
+        migrations.RenameField(
+            model_name='transaction',
+            old_name='pesapal_order_tracking_id',
+            new_name='gateway_reference',
+        ),
+        migrations.RenameField(
+            model_name='transaction',
+            old_name='pesapal_redirect_url',
+            new_name='redirect_url',
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='gateway',
+            field=models.CharField(default='pesapal', help_text='Payment gateway that handled the transaction, see utils/gateways.py', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='merchant_reference',
+            field=models.CharField(blank=True, help_text='Our reference for the payment as sent to the gateway, the order number', max_length=100, null=True),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='gateway_reference',
+            field=models.TextField(help_text="The gateway's id of the payment", null=True),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='transaction_id',
+            field=models.CharField(help_text="The gateway's unique transaction ID", max_length=100, unique=True),
+        ),
+    ]
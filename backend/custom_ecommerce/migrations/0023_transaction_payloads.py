@@ -0,0 +1,84 @@
+# Generated by Django 4.2.1 on 2026-10-19 13:26
+
+import custom_ecommerce.models
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Old Transaction column -> TransactionPayload event
+PAYLOAD_FIELDS = [
+    ('transaction_init_info', 'init'),
+    ('ipn_data', 'ipn'),
+    ('all_transaction_info_after_callback', 'status'),
+]
+
+
+def move_payloads(apps, schema_editor):
+    Transaction = apps.get_model('custom_ecommerce', 'Transaction')
+    TransactionPayload = apps.get_model('custom_ecommerce', 'TransactionPayload')
+
+    batch = []
+    accounts = []
+    columns = ['pk'] + [column for column, event in PAYLOAD_FIELDS]
+    for row in Transaction.objects.values(*columns).iterator(chunk_size=500):
+        for column, event in PAYLOAD_FIELDS:
+            if row[column]:
+                batch.append(TransactionPayload(transaction_id=row['pk'], event=event, data=row[column]))
+        status = row['all_transaction_info_after_callback']
+        if isinstance(status, dict) and status.get('payment_account'):
+            accounts.append(Transaction(pk=row['pk'], payment_account=str(status['payment_account'])[:100]))
+        if len(batch) >= 500:
+            TransactionPayload.objects.bulk_create(batch)
+            batch = []
+    TransactionPayload.objects.bulk_create(batch)
+    Transaction.objects.bulk_update(accounts, ['payment_account'], batch_size=500)
+
+
+def restore_payloads(apps, schema_editor):
+    Transaction = apps.get_model('custom_ecommerce', 'Transaction')
+    TransactionPayload = apps.get_model('custom_ecommerce', 'TransactionPayload')
+
+    events = {event: column for column, event in PAYLOAD_FIELDS}
+    for payload in TransactionPayload.objects.order_by('id').iterator(chunk_size=500):
+        Transaction.objects.filter(pk=payload.transaction_id).update(**{events[payload.event]: payload.data})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('custom_ecommerce', '0022_transaction_gateway_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='payment_account',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.CreateModel(
+            name='TransactionPayload',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event', models.CharField(choices=[('init', 'Payment initiated'), ('ipn', 'Notification received'), ('status', 'Status looked up')], max_length=10)),
+                ('data', custom_ecommerce.models.CompressedJSONField()),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('transaction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payloads', to='custom_ecommerce.transaction')),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['transaction', 'event'], name='txpayload_tx_event_idx')],
+            },
+        ),
+        migrations.RunPython(move_payloads, restore_payloads),
+        migrations.RemoveField(
+            model_name='transaction',
+            name='all_transaction_info_after_callback',
+        ),
+        migrations.RemoveField(
+            model_name='transaction',
+            name='ipn_data',
+        ),
+        migrations.RemoveField(
+            model_name='transaction',
+            name='transaction_init_info',
+        ),
+    ]
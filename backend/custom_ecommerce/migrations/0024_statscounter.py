@@ -0,0 +1,41 @@
+# Generated by Django 4.2.1 on 2026-10-19 13:30
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def seed_counters(apps, schema_editor):
+    StatsCounter = apps.get_model('custom_ecommerce', 'StatsCounter')
+    Order = apps.get_model('custom_ecommerce', 'Order')
+    Transaction = apps.get_model('custom_ecommerce', 'Transaction')
+
+    orders = Order.objects.aggregate(orders=Count('id'), sales=Sum('total'))
+    values = {
+        'orders': orders['orders'],
+        'sales': orders['sales'] or 0,
+        'products': apps.get_model('custom_ecommerce', 'Product').objects.count(),
+        'categories': apps.get_model('custom_ecommerce', 'ProductCategory').objects.count(),
+        'discounts': apps.get_model('custom_ecommerce', 'Discount').objects.count(),
+    }
+    for status in ('PENDING', 'COMPLETED', 'FAILED'):
+        values[f'transactions.{status}'] = Transaction.objects.filter(status=status).count()
+    StatsCounter.objects.bulk_create([StatsCounter(name=name, value=value) for name, value in values.items()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('custom_ecommerce', '0023_transaction_payloads'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatsCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('value', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+            ],
+        ),
+        migrations.RunPython(seed_counters, migrations.RunPython.noop),
+    ]
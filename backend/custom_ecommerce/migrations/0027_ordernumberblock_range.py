@@ -0,0 +1,57 @@
+import uuid
+
+from django.db import migrations, models
+
+
+def store_ranges(apps, schema_editor):
+    # Blocks used to own (id - 1) * size + 1 to id * size, keep those ranges so no number is handed out again
+    OrderNumberBlock = apps.get_model('custom_ecommerce', 'OrderNumberBlock')
+    # and drop blocks whose whole range an earlier block already covers
+    stop = 1
+    blocks, covered = [], []
+    for block in OrderNumberBlock.objects.order_by('pk'):
+        block.start = max((block.pk - 1) * block.size + 1, stop)
+        block.stop = block.pk * block.size + 1
+        if block.stop <= block.start:
+            covered.append(block.pk)
+            continue
+        stop = block.stop
+        blocks.append(block)
+    OrderNumberBlock.objects.filter(pk__in=covered).delete()
+    OrderNumberBlock.objects.bulk_update(blocks, ['start', 'stop'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('custom_ecommerce', '0026_product_leaderboards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ordernumberblock',
+            name='start',
+            field=models.PositiveBigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='ordernumberblock',
+            name='stop',
+            field=models.PositiveBigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='ordernumberblock',
+            name='token',
+            field=models.UUIDField(default=uuid.uuid4, editable=False),
+        ),
+        migrations.RunPython(store_ranges, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='ordernumberblock',
+            name='start',
+            field=models.PositiveBigIntegerField(unique=True),
+        ),
+        migrations.AlterField(
+            model_name='ordernumberblock',
+            name='stop',
+            field=models.PositiveBigIntegerField(),
+        ),
+    ]
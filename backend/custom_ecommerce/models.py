@@ -1,6 +1,12 @@
+import json
+import uuid
+import zlib
 from decimal import Decimal
 
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.db.models import ExpressionWrapper, F, OuterRef, Prefetch, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
 from django.utils.text import slugify
 from django.core.validators import MinValueValidator
 from main.models import TimeStampedModel
@@ -27,17 +33,17 @@ class ProductCategory(TimeStampedModel):
         if not self.slug:
             self.slug = slugify(self.name)
             
-        # If this image has a file but no Cloudinary URL yet, upload it to Cloudinary
+        # If this image has a file but no stored URL yet, upload it to the media storage provider
         if self.image and not self.public_id and not self.cloudinary_url:
-            from utils.cloudinary_utils import upload_file_to_cloudinary
-            # Upload the file to Cloudinary
-            result = upload_file_to_cloudinary(
+            from utils.storage import get_media_storage
+            # Upload the file through the configured media storage provider
+            result = get_media_storage().upload(
                 file=self.image,
                 folder='categories',
                 resource_type='image'
             )
-            # Store the Cloudinary URL and public_id
-            self.cloudinary_url = result.get('secure_url')
+            # Store the provider URL and public_id
+            self.cloudinary_url = result.get('url')
             self.public_id = result.get('public_id')
             
             # Create a reference to the uploaded file before clearing it
@@ -48,14 +54,14 @@ class ProductCategory(TimeStampedModel):
         super().save(*args, **kwargs)
         
     def delete(self, *args, **kwargs):
-        # Delete from Cloudinary if we have a public_id
+        # Delete from the media storage provider if we have a public_id
         if self.public_id:
-            from utils.cloudinary_utils import delete_file_from_cloudinary
+            from utils.storage import get_media_storage
             try:
-                delete_file_from_cloudinary(self.public_id)
+                get_media_storage().delete(self.public_id)
             except Exception as e:
                 # Log the error but continue with deletion
-                print(f"Error deleting from Cloudinary: {e}")
+                print(f"Error deleting stored media: {e}")
         
         super().delete(*args, **kwargs)
 
@@ -63,6 +69,20 @@ class ProductCategory(TimeStampedModel):
         return self.name
 
 
+class ProductQuerySet(models.QuerySet):
+
+    def with_available(self):
+        """
+        Annotate ``held`` (units in active, unexpired stock holds) and ``available`` (stock minus held)
+        """
+        held = StockHold.objects.active().filter(product=OuterRef('pk')).order_by().values('product').annotate(
+            total=Sum('quantity')
+        ).values('total')
+        return self.annotate(
+            held=Coalesce(Subquery(held, output_field=models.IntegerField()), Value(0))
+        ).annotate(available=F('stock') - F('held'))
+
+
 class Product(TimeStampedModel):
     name = models.CharField(max_length=200)
     slug = models.SlugField(unique=True, blank=True)
@@ -78,6 +98,12 @@ class Product(TimeStampedModel):
     stock = models.PositiveIntegerField(default=0)
 
     is_active = models.BooleanField(default=True)
+    # Leaderboard columns kept up to date in batches by custom_ecommerce/leaderboards.py, indexed so
+    # ?ordering=popularity and ?ordering=trending are index scans
+    units_sold = models.PositiveIntegerField(default=0, db_index=True)
+    trending_score = models.FloatField(default=0, db_index=True)
+
+    objects = ProductQuerySet.as_manager()
 
     class Meta:
         ordering = ['-created_on']
@@ -109,17 +135,17 @@ class ProductImage(TimeStampedModel):
         return f"{self.product.name} - Image {self.order}"
         
     def save(self, *args, **kwargs):
-        # If this image has a file but no Cloudinary URL yet, upload it to Cloudinary
+        # If this image has a file but no stored URL yet, upload it to the media storage provider
         if self.image and not self.public_id and not self.cloudinary_url:
-            from utils.cloudinary_utils import upload_file_to_cloudinary
-            # Upload the file to Cloudinary
-            result = upload_file_to_cloudinary(
+            from utils.storage import get_media_storage
+            # Upload the file through the configured media storage provider
+            result = get_media_storage().upload(
                 file=self.image,
                 folder='products',
                 resource_type='image'
             )
-            # Store the Cloudinary URL and public_id
-            self.cloudinary_url = result.get('secure_url')
+            # Store the provider URL and public_id
+            self.cloudinary_url = result.get('url')
             self.public_id = result.get('public_id')
             
             # Create a reference to the uploaded file before clearing it
@@ -127,27 +153,63 @@ class ProductImage(TimeStampedModel):
             # Clear the image field to prevent local storage
             self.image = None
             
-            # Save the model with Cloudinary data but no local file
+            # Save the model with the stored media data but no local file
             super().save(*args, **kwargs)
         else:
             # Normal save for other cases
             super().save(*args, **kwargs)
     
     def delete(self, *args, **kwargs):
-        # Delete from Cloudinary if we have a public_id
+        # Delete from the media storage provider if we have a public_id
         if self.public_id:
-            from utils.cloudinary_utils import delete_file_from_cloudinary
+            from utils.storage import get_media_storage
             try:
-                delete_file_from_cloudinary(self.public_id)
+                get_media_storage().delete(self.public_id)
             except Exception as e:
                 # Log the error but continue with deletion
-                print(f"Error deleting from Cloudinary: {e}")
+                print(f"Error deleting stored media: {e}")
         
         super().delete(*args, **kwargs)
 
 
+def primary_images_prefetch(lookup='images'):
+    """Prefetch product images with the primary image first"""
+    return Prefetch(lookup, queryset=ProductImage.objects.order_by('-is_primary', 'order', 'created_on'))
+
+
+class CartQuerySet(models.QuerySet):
+
+    def with_totals(self):
+        """
+        Annotate item count and subtotal in the cart query itself so that the
+        ``total_items``/``subtotal`` properties do not need to load the items.
+        """
+        line_total = ExpressionWrapper(
+            F('items__quantity') * F('items__price'),
+            output_field=models.DecimalField(max_digits=12, decimal_places=2)
+        )
+        return self.annotate(
+            items_quantity=Coalesce(Sum('items__quantity'), Value(0)),
+            items_subtotal=Coalesce(
+                Sum(line_total),
+                Value(Decimal('0.00')),
+                output_field=models.DecimalField(max_digits=12, decimal_places=2)
+            ),
+        )
+
+    def with_items(self):
+        """
+        Prefetch the cart lines with their product and images ordered primary image first.
+        """
+        items = CartItem.objects.select_related('product').prefetch_related(
+            primary_images_prefetch('product__images')
+        )
+        return self.prefetch_related(Prefetch('items', queryset=items))
+
+
 class Cart(TimeStampedModel):
     session_id = models.CharField(max_length=100, blank=True, null=True)
+    user = models.ForeignKey('auth.User', on_delete=models.SET_NULL, null=True, blank=True, related_name='carts')
     email = models.EmailField(null=True, blank=True)
     phone_number = models.CharField(max_length=20, null=True, blank=True)
     first_name = models.CharField(max_length=100, null=True, blank=True)
@@ -159,15 +221,22 @@ class Cart(TimeStampedModel):
     total = models.DecimalField(blank=True, null=True, max_digits=10, decimal_places=2)
     subtotal = models.DecimalField(blank=True, null=True, max_digits=10, decimal_places=2)
 
+    objects = CartQuerySet.as_manager()
+
     def __str__(self):
         return f"Cart {self.id} - {self.session_id}"
 
     @property
     def total_items(self):
+        # Use the value annotated by CartQuerySet.with_totals when available
+        if hasattr(self, 'items_quantity'):
+            return self.items_quantity
         return sum(item.quantity for item in self.items.all())
 
     @property
     def subtotal(self):
+        if hasattr(self, 'items_subtotal'):
+            return self.items_subtotal
         return sum(item.total_price for item in self.items.all())
 
 
@@ -255,6 +324,38 @@ class Discount(TimeStampedModel):
         return discount
 
 
+class OrderNumberBlock(models.Model):
+    """
+    A reserved range of order numbers, ``start`` up to but excluding ``stop``, one row per block. Each block
+    starts where the previous one stopped. Only ever inserted, see custom_ecommerce/numbering.py
+    """
+    start = models.PositiveBigIntegerField(unique=True)
+    stop = models.PositiveBigIntegerField()
+    size = models.PositiveIntegerField()
+    # Tells a block apart from one reserved for the same range after a rollback
+    token = models.UUIDField(default=uuid.uuid4, editable=False)
+    created_on = models.DateTimeField()
+
+    def __str__(self):
+        return f"Order number block {self.pk}"
+
+
+class OrderQuerySet(models.QuerySet):
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        missing = [obj for obj in objs if not obj.order_number]
+        if missing:
+            from .numbering import allocate_order_numbers
+            for obj, order_number in zip(missing, allocate_order_numbers(len(missing))):
+                obj.order_number = order_number
+        created = super().bulk_create(objs, *args, **kwargs)
+        # No post_save for bulk inserts, count them here
+        from .stats import bump_counters
+        bump_counters({'orders': len(created), 'sales': sum(obj.total or 0 for obj in created)})
+        return created
+
+
 class Order(TimeStampedModel):
     STATUS_CHOICES = [
         ('pending', 'Pending'),
@@ -288,17 +389,45 @@ class Order(TimeStampedModel):
 
     is_paid = models.BooleanField(default=False)
 
+    # Progress of the background job that fetches ``payment_url`` from the gateway, see custom_ecommerce/payments.py
+    PAYMENT_LINK_QUEUED = 'queued'
+    PAYMENT_LINK_READY = 'ready'
+    PAYMENT_LINK_FAILED = 'failed'
+    PAYMENT_LINK_STATUS_CHOICES = [
+        (PAYMENT_LINK_QUEUED, 'Queued'),
+        (PAYMENT_LINK_READY, 'Ready'),
+        (PAYMENT_LINK_FAILED, 'Failed'),
+    ]
+    payment_link_status = models.CharField(
+        max_length=10, choices=PAYMENT_LINK_STATUS_CHOICES, default=PAYMENT_LINK_QUEUED
+    )
+
+    # Set once the paid order is counted in the daily sales rollups, see custom_ecommerce/rollups.py
+    sales_rolled_up = models.BooleanField(default=False)
+    # Set once the paid order's units are counted in the product leaderboards
+    popularity_counted = models.BooleanField(default=False)
+    # Outcome of taking the order's units out of stock when it is paid, see custom_ecommerce/inventory.py
+    STOCK_PENDING = 'pending'
+    STOCK_COMMITTED = 'committed'
+    STOCK_SHORT = 'short'
+    STOCK_STATUS_CHOICES = [
+        (STOCK_PENDING, 'Pending'),
+        (STOCK_COMMITTED, 'Committed'),
+        (STOCK_SHORT, 'Short'),
+    ]
+    stock_status = models.CharField(max_length=10, choices=STOCK_STATUS_CHOICES, default=STOCK_PENDING)
+    # Lines that could not be taken out of stock, [{"product_id", "requested", "available"}]
+    stock_shortfall = models.JSONField(blank=True, null=True)
+
+    objects = OrderQuerySet.as_manager()
+
     def __str__(self):
         return f"Order {self.order_number}"
 
     def save(self, *args, **kwargs):
         if not self.order_number:
-            # Generate order number based on timestamp and random string
-            import random
-            import string
-            timestamp = timezone.now().strftime('%Y%m%d%H%M%S')
-            random_str = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-            self.order_number = f"ORD-{timestamp}-{random_str}"
+            from .numbering import next_order_number
+            self.order_number = next_order_number()
         super().save(*args, **kwargs)
 
 
@@ -318,7 +447,7 @@ class OrderItem(TimeStampedModel):
 
 
 class Transaction(TimeStampedModel):
-    # Transaction status choices (based on Pesapal's response)
+    # Transaction status choices, gateway statuses are normalised to these (see utils/gateways.py)
     STATUS_CHOICES = [
         ('PENDING', 'Pending'),
         ('COMPLETED', 'Completed'),
@@ -336,7 +465,7 @@ class Transaction(TimeStampedModel):
     transaction_id = models.CharField(
         max_length=100,
         unique=True,
-        help_text="Pesapal's unique transaction ID"
+        help_text="The gateway's unique transaction ID"
     )
 
     # We will obtain the amount after the callback and then compare it with what is in the order and confirm the order as paid
@@ -365,44 +494,243 @@ class Transaction(TimeStampedModel):
         null=True,
         help_text="e.g., M-Pesa, Credit Card"
     )
-    pesapal_merchant_reference = models.CharField(
-        max_length=100,
-        blank=True,
-        null=True,
-        help_text="Pesapal's merchant reference (if needed)"
-    )
-    pesapal_order_tracking_id = models.TextField(null=True)
-    pesapal_redirect_url = models.TextField(null=True)
-    transaction_init_info = models.JSONField(
-        blank=True,
-        null=True,
-        help_text="Information received from pesapal when the tx was started"
-    )
-
-    # Call back information
-    ipn_data = models.JSONField(
-        blank=True,
-        null=True,
-        help_text="Raw IPN callback data from Pesapal for debugging"
+    gateway = models.CharField(
+        max_length=20,
+        default='pesapal',
+        help_text="Payment gateway that handled the transaction, see utils/gateways.py"
     )
-    all_transaction_info_after_callback = models.JSONField(
+    merchant_reference = models.CharField(
+        max_length=100,
         blank=True,
         null=True,
-        help_text="This field will be updated after we query the actual tx from pesapal and update transaction status here"
+        help_text="Our reference for the payment as sent to the gateway, the order number"
     )
+    gateway_reference = models.TextField(null=True, help_text="The gateway's id of the payment")
+    redirect_url = models.TextField(null=True)
+    # Account the customer paid from, e.g. a masked phone number, the raw gateway payloads are TransactionPayload rows
+    payment_account = models.CharField(blank=True, null=True, max_length=100)
     confirmation_code = models.CharField(blank=True, null=True, max_length=50)
 
     def __str__(self):
         return f"Transaction #{self.transaction_id} ({self.status})"
 
+    def add_payload(self, event, data):
+        """Append a raw gateway payload, see TransactionPayload"""
+        return TransactionPayload.objects.create(transaction=self, event=event, data=data)
+
+    def latest_payloads(self):
+        """{event: data} of the newest payload of each event, uses prefetched ``payloads`` when there are any"""
+        latest = {}
+        for payload in sorted(self.payloads.all(), key=lambda payload: payload.pk):
+            latest[payload.event] = payload.data
+        return latest
+
     class Meta:
         ordering = ['-created_on']
         verbose_name = "Payment Transaction"
         verbose_name_plural = "Payment Transactions"
 
 
+class CompressedJSONField(models.BinaryField):
+    """JSON stored zlib compressed, for bulky payloads that are written once and rarely read"""
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return json.loads(zlib.decompress(bytes(value)))
+
+    def to_python(self, value):
+        if isinstance(value, (bytes, memoryview)):
+            return json.loads(zlib.decompress(bytes(value)))
+        return value
+
+    def get_prep_value(self, value):
+        if value is None:
+            return value
+        return zlib.compress(json.dumps(value, cls=DjangoJSONEncoder, separators=(',', ':')).encode())
+
+
+class TransactionPayload(models.Model):
+    """
+    Raw data exchanged with the payment gateway about a transaction, kept out of the Transaction table so
+    listing and scanning transactions does not drag it along. Rows are append-only, every initiation,
+    notification and status lookup adds one.
+    """
+    EVENT_INIT = 'init'
+    EVENT_IPN = 'ipn'
+    EVENT_STATUS = 'status'
+    EVENT_CHOICES = [
+        (EVENT_INIT, 'Payment initiated'),
+        (EVENT_IPN, 'Notification received'),
+        (EVENT_STATUS, 'Status looked up'),
+    ]
+
+    transaction = models.ForeignKey(Transaction, on_delete=models.CASCADE, related_name='payloads')
+    event = models.CharField(max_length=10, choices=EVENT_CHOICES)
+    data = CompressedJSONField()
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['transaction', 'event'], name='txpayload_tx_event_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            raise ValueError("Transaction payloads are append-only")
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.get_event_display()} for transaction {self.transaction_id}"
+
+
 class CallBackUrls(TimeStampedModel):
     url = models.URLField(blank=False, null=True, max_length=200)
     callback_url_id = models.TextField(blank=False, null=True)
     identifier = models.CharField(blank=True, default="active", max_length=20)
-    name = models.CharField(blank=True, default="CallBack", max_length=20)
\ No newline at end of file
+    name = models.CharField(blank=True, default="CallBack", max_length=20)
+
+
+class StockHoldQuerySet(models.QuerySet):
+
+    def active(self):
+        return self.filter(status=StockHold.STATUS_ACTIVE, expires_at__gt=timezone.now())
+
+
+class StockHold(TimeStampedModel):
+    """
+    Units of a product reserved for an order (or cart) until ``expires_at``. Active holds are subtracted from
+    ``Product.stock`` to get what can still be sold, they are converted when the order is paid.
+    """
+    STATUS_ACTIVE = 'active'
+    STATUS_CONVERTED = 'converted'
+    STATUS_RELEASED = 'released'
+    STATUS_EXPIRED = 'expired'
+    STATUS_CHOICES = [
+        (STATUS_ACTIVE, 'Active'),
+        (STATUS_CONVERTED, 'Converted'),
+        (STATUS_RELEASED, 'Released'),
+        (STATUS_EXPIRED, 'Expired'),
+    ]
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_holds')
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_ACTIVE)
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, null=True, blank=True, related_name='stock_holds')
+    cart = models.ForeignKey(Cart, on_delete=models.SET_NULL, null=True, blank=True, related_name='stock_holds')
+
+    objects = StockHoldQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['-id']
+        indexes = [
+            # Serves the per product "sum of active holds" used by ProductQuerySet.with_available
+            models.Index(fields=['product', 'status', 'expires_at'], name='stockhold_product_active_idx'),
+            # Serves the expiry sweeper
+            models.Index(fields=['status', 'expires_at'], name='stockhold_status_expiry_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} ({self.status})"
+
+
+class PaymentNotification(TimeStampedModel):
+    """
+    Raw Pesapal IPN as received by ``payment_callback``. Notifications are acknowledged as soon as they are
+    stored and applied later by a background job, see custom_ecommerce/notifications.py.
+    """
+    STATUS_RECEIVED = 'received'
+    STATUS_PROCESSING = 'processing'
+    STATUS_PROCESSED = 'processed'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_RECEIVED, 'Received'),
+        (STATUS_PROCESSING, 'Processing'),
+        (STATUS_PROCESSED, 'Processed'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    order_tracking_id = models.CharField(max_length=100)
+    merchant_reference = models.CharField(max_length=100, blank=True)
+    notification_type = models.CharField(max_length=50, blank=True)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_RECEIVED)
+    # Set by the job that claimed the notification so concurrent jobs only ever see their own claims
+    claim_token = models.CharField(max_length=32, blank=True)
+    processed_on = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['-id']
+        indexes = [
+            models.Index(fields=['order_tracking_id', 'status'], name='paymentnotif_tracking_idx'),
+        ]
+
+    def __str__(self):
+        return f"IPN {self.order_tracking_id} ({self.status})"
+
+
+class StatsCounter(models.Model):
+    """A running dashboard number kept up to date by signals, see custom_ecommerce/stats.py"""
+    name = models.CharField(max_length=50, unique=True)
+    value = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
+
+
+class DailySales(models.Model):
+    """Paid orders per day (of the order's creation), maintained by custom_ecommerce/rollups.py"""
+    day = models.DateField(unique=True)
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        ordering = ['day']
+
+
+class DailyProductSales(models.Model):
+    """Paid order lines per day and product, ``revenue`` is the lines' price times quantity"""
+    day = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='daily_sales')
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        ordering = ['day']
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'product'], name='dailyproductsales_day_product_uniq'),
+        ]
+
+
+class DailyCategorySales(models.Model):
+    """Paid order lines per day and product category, ``orders`` counts each order once per category"""
+    day = models.DateField()
+    category = models.ForeignKey(ProductCategory, on_delete=models.CASCADE, related_name='daily_sales')
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        ordering = ['day']
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'category'], name='dailycategorysales_day_cat_uniq'),
+        ]
+
+
+class Leaderboard(models.Model):
+    """
+    A precomputed top-N product list, e.g. best sellers, stored as the ordered product ids.
+    ``landmark`` is the reference time of the trending scores, see custom_ecommerce/leaderboards.py.
+    """
+    name = models.CharField(max_length=50, unique=True)
+    product_ids = models.JSONField(default=list)
+    landmark = models.DateTimeField(null=True, blank=True)
+    computed_on = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,84 @@
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from utils.gateways import get_payment_gateway
+from utils.jobs import RetryLater, enqueue
+from utils.resilience import GatewayUnavailable
+from .models import PaymentNotification
+from .payments import apply_payment_status
+
+
+class NotificationProcessingError(Exception):
+    """Raised when a notification could not be applied, the job queue retries it with backoff"""
+
+
+def record_notification(data):
+    """Store a raw IPN and queue its processing, returns the stored notification"""
+    notice = get_payment_gateway().parse_notification(data)
+    notification = PaymentNotification.objects.create(
+        order_tracking_id=notice.reference,
+        merchant_reference=notice.merchant_reference,
+        notification_type=notice.event,
+        payload=notice.raw,
+    )
+    enqueue(process_notifications, on_failure=notifications_failed, order_tracking_id=notification.order_tracking_id)
+    return notification
+
+
+def process_notifications(order_tracking_id):
+    """
+    Background job: apply the pending notifications of one payment.
+
+    Every received notification for the tracking id is claimed with one conditional UPDATE, so redelivered
+    IPNs are folded into a single status lookup and concurrent jobs for the same payment do not both run.
+    Applying the payment is idempotent (see payments.apply_payment_status), a repeat changes nothing.
+    """
+    now = timezone.now()
+    claim_token = uuid.uuid4().hex
+    # Notifications left processing by a worker that died are claimed again once the job lock has expired
+    stale = now - timedelta(seconds=settings.BACKGROUND_JOBS_LOCK_SECONDS)
+    claimed_count = PaymentNotification.objects.filter(
+        Q(status=PaymentNotification.STATUS_RECEIVED) |
+        Q(status=PaymentNotification.STATUS_PROCESSING, updated_on__lt=stale),
+        order_tracking_id=order_tracking_id,
+    ).update(status=PaymentNotification.STATUS_PROCESSING, claim_token=claim_token, updated_on=now)
+    if not claimed_count:
+        return
+
+    claimed = PaymentNotification.objects.filter(order_tracking_id=order_tracking_id, claim_token=claim_token)
+    latest = claimed.order_by('-id').first()
+    gateway = get_payment_gateway()
+    notice = gateway.parse_notification(latest.payload)
+    error = None
+    try:
+        # The status is looked up before apply_payment_status locks any rows
+        apply_payment_status(notice, gateway.get_status(notice.reference))
+    except GatewayUnavailable as e:
+        claimed.update(status=PaymentNotification.STATUS_RECEIVED, last_error=str(e), updated_on=timezone.now())
+        raise RetryLater(e.retry_after or 30, str(e))
+    except Exception as e:
+        print(f"Error handling payment notification {order_tracking_id}: {e}")
+        error = str(e)
+    if error is None:
+        claimed.update(
+            status=PaymentNotification.STATUS_PROCESSED, processed_on=timezone.now(), updated_on=timezone.now()
+        )
+        return
+
+    # Hand the notifications back so the retry picks them up again
+    claimed.update(
+        status=PaymentNotification.STATUS_RECEIVED, last_error=error,
+        updated_on=timezone.now()
+    )
+    raise NotificationProcessingError(f"Could not apply payment notification {order_tracking_id}: {error}")
+
+
+def notifications_failed(order_tracking_id):
+    """Called by the job queue once a payment's notifications failed on every attempt"""
+    PaymentNotification.objects.filter(
+        order_tracking_id=order_tracking_id, status=PaymentNotification.STATUS_RECEIVED
+    ).update(status=PaymentNotification.STATUS_FAILED, updated_on=timezone.now())
@@ -0,0 +1,142 @@
+import os
+import threading
+import uuid
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import OrderNumberBlock
+
+
+class OrderNumberAllocator:
+    """
+    Hands out monotonic order numbers like ``ORD-00001234`` from blocks of ORDER_NUMBER_BLOCK_SIZE numbers.
+
+    A block is reserved by inserting an OrderNumberBlock row that starts where the last stored block stopped,
+    the unique ``start`` makes concurrent reservations of the same range fail and retry. Processes only touch
+    the database once per block, numbers left in a block when a process exits are skipped.
+
+    Blocks are reserved on a connection of their own and committed right away, so a request rolling back
+    cannot take its block with it while the process keeps using the numbers. SQLite only allows one writer,
+    a second connection would wait for the request's own lock, so there the block is reserved inside the
+    caller's transaction and checked to still exist until that transaction commits.
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.using = using
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pid = None
+        self._next = 0
+        self._end = 0
+        self._block = None
+        self._confirmed = True
+
+    def _reservation_connection(self):
+        """A connection of this thread's own, in autocommit mode"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = connections.create_connection(self.using)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _insert_block_apart(self, size, floor):
+        connection = self._reservation_connection()
+        table = connection.ops.quote_name(OrderNumberBlock._meta.db_table)
+        start, stop = (connection.ops.quote_name(name) for name in ('start', 'stop'))
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(f"SELECT MAX({stop}) FROM {table}")
+                first = max(cursor.fetchone()[0] or 1, floor)
+                cursor.execute(
+                    f"INSERT INTO {table} ({start}, {stop}, size, token, created_on) VALUES (%s, %s, %s, %s, %s)",
+                    [first, first + size, size, uuid.uuid4().hex, timezone.now()]
+                )
+        except IntegrityError:
+            return None
+        except Exception:
+            # Start over with a new connection next time, e.g. after the server dropped it
+            connection.close()
+            self._local.connection = None
+            raise
+        return first
+
+    def _insert_block_inline(self, size, floor):
+        first = max(OrderNumberBlock.objects.using(self.using).aggregate(stop=Max('stop'))['stop'] or 1, floor)
+        try:
+            with transaction.atomic(using=self.using):
+                block = OrderNumberBlock.objects.using(self.using).create(
+                    start=first, stop=first + size, size=size, created_on=timezone.now()
+                )
+        except IntegrityError:
+            return None
+        self._block = block.token
+        self._confirmed = not connections[self.using].in_atomic_block
+        if not self._confirmed:
+            transaction.on_commit(lambda: self._confirm(block.token), using=self.using)
+        return first
+
+    def _confirm(self, token):
+        if self._block == token:
+            self._confirmed = True
+
+    def _block_lost(self):
+        """True when the inline reserved block was rolled back with the transaction that inserted it"""
+        if self._confirmed:
+            return False
+        # By token, another process may have reserved the same range with the same id since the rollback
+        if OrderNumberBlock.objects.using(self.using).filter(token=self._block).exists():
+            return False
+        self._next = self._end = 0
+        return True
+
+    def _reserve_block(self):
+        size = settings.ORDER_NUMBER_BLOCK_SIZE
+        inline = connections[self.using].vendor == 'sqlite'
+        # Never go below numbers this process already handed out
+        floor = self._end
+        while True:
+            insert = self._insert_block_inline if inline else self._insert_block_apart
+            first = insert(size, floor)
+            if first is not None:
+                break
+        if not inline:
+            self._confirmed = True
+        self._next = first
+        self._end = first + size
+
+    def allocate(self, count=1):
+        """Return ``count`` unused order numbers in increasing order"""
+        numbers = []
+        with self._lock:
+            if self._pid != os.getpid():
+                # Blocks must not be shared with a parent or sibling process after a fork
+                self._pid = os.getpid()
+                self._next = self._end = 0
+                self._confirmed = True
+            self._block_lost()
+            while len(numbers) < count:
+                if self._next >= self._end:
+                    self._reserve_block()
+                take = min(count - len(numbers), self._end - self._next)
+                numbers.extend(range(self._next, self._next + take))
+                self._next += take
+        return [format_order_number(number) for number in numbers]
+
+
+def format_order_number(number):
+    return f"{settings.ORDER_NUMBER_PREFIX}{number:0{settings.ORDER_NUMBER_WIDTH}d}"
+
+
+order_numbers = OrderNumberAllocator()
+
+
+def next_order_number():
+    return order_numbers.allocate()[0]
+
+
+def allocate_order_numbers(count):
+    return order_numbers.allocate(count)
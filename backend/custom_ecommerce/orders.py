@@ -0,0 +1,140 @@
+from decimal import Decimal
+
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+
+from .models import Cart, CartItem, Discount, OrderItem
+from .reservations import availability_errors, create_holds, lock_products
+from .utils import is_not_non_or_zero
+
+
+def parse_order_lines(items_data):
+    """
+    Turn the ``cart_items`` payload into a product id to quantity mapping, summing repeated products.
+    Raises ValidationError with every malformed line at once.
+    """
+    quantities, errors = {}, []
+    for index, item in enumerate(items_data):
+        try:
+            product_id = int(item.get("product_id"))
+            quantity = int(item.get("quantity"))
+        except (TypeError, ValueError):
+            errors.append(f"Item {index} needs a product_id and a whole number quantity")
+            continue
+        if quantity < 1:
+            errors.append(f"Item {index} needs a quantity of at least 1")
+            continue
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+
+    if errors:
+        raise ValidationError({'cart_items': errors})
+    if not quantities:
+        raise ValidationError({'cart_items': ["At least one item is required"]})
+    return quantities
+
+
+def resolve_discount(discount_code, user, subtotal):
+    """
+    Look up and validate a discount code for ``subtotal``.
+    Returns (discount or None, discount amount, message to store on the order).
+    """
+    if not discount_code:
+        return None, Decimal("0.00"), "No discount code provided."
+
+    discount_obj = Discount.objects.filter(code=discount_code).first()
+    if not discount_obj:
+        return None, Decimal("0.00"), f"Discount code '{discount_code}' not found."
+
+    is_valid, message = discount_obj.is_valid(user=user, cart_total=subtotal)
+    if not is_valid:
+        return None, Decimal("0.00"), f"Discount code '{discount_code}' is not valid: {message}"
+
+    discount_amount = discount_obj.calculate_discount(subtotal)
+    if discount_amount > Decimal("0.00"):
+        # The discount usage is recorded in the IPN once the order is paid
+        return discount_obj, discount_amount, \
+            f"Discount code '{discount_code}' applied successfully. You saved {discount_amount}."
+
+    # Discount code is valid but no discount was applied (e.g., minimum purchase not met)
+    if discount_obj.min_purchase and subtotal < discount_obj.min_purchase:
+        return None, Decimal("0.00"), \
+            f"Minimum purchase of {discount_obj.min_purchase} required for discount code '{discount_code}'."
+    return None, Decimal("0.00"), f"Discount code '{discount_code}' could not be applied."
+
+
+def create_order(serializer, items_data, discount_code=None, user=None, source_cart=None, guest_key=None):
+    """
+    Create the cart, order, order items and stock holds for an order request in one transaction.
+    ``source_cart`` is the caller's open cart the order was placed from, it becomes the order's cart and is
+    marked ordered so it is not offered to the caller again. Otherwise a new cart is made for the order,
+    owned by ``user`` or stored under the guest's ``guest_key``, so only they can look the order up.
+
+    All products are loaded and locked with one query and validated together, then every table is written
+    with a single insert or ``bulk_create``, so the number of queries does not grow with the number of lines.
+    Raises ValidationError listing every line that cannot be ordered, in which case nothing is written.
+    """
+    quantities = parse_order_lines(items_data)
+
+    with transaction.atomic():
+        products = lock_products(quantities)
+        errors = availability_errors(products, quantities)
+        if errors:
+            raise ValidationError({'cart_items': errors})
+
+        prices = {}
+        subtotal = Decimal("0.00")
+        for product_id, quantity in quantities.items():
+            product = products[product_id]
+            prices[product_id] = product.sale_price if is_not_non_or_zero(product.sale_price) else product.price
+            subtotal += prices[product_id] * quantity
+
+        shipping_cost = Decimal("0.00")
+        tax = Decimal("0.00")
+        discount_obj, discount, discount_message = resolve_discount(discount_code, user, subtotal)
+        total = subtotal + shipping_cost + tax - discount
+
+        cart = None
+        if source_cart is not None:
+            cart = Cart.objects.select_for_update().filter(pk=source_cart.pk, is_ordered=False).first()
+        if cart is None:
+            cart = Cart.objects.create(
+                total=total, is_ordered=True, user=user, is_guest=user is None,
+                session_id=None if user else guest_key
+            )
+        else:
+            cart.total = total
+            cart.is_ordered = True
+            cart.save(update_fields=['total', 'is_ordered', 'updated_on'])
+            # The cart keeps exactly what was ordered
+            CartItem.objects.filter(cart=cart).delete()
+        CartItem.objects.bulk_create([
+            CartItem(cart=cart, product_id=product_id, quantity=quantity, price=prices[product_id])
+            for product_id, quantity in quantities.items()
+        ])
+
+        computed = {
+            'subtotal': subtotal,
+            'shipping_cost': shipping_cost,
+            'tax': tax,
+            'discount': discount,
+            'total': total,
+            'discount_message': discount_message,
+            'cart': cart,
+        }
+        if discount_obj:
+            computed['discount_code'] = discount_obj
+        order = serializer.save(**computed)
+
+        OrderItem.objects.bulk_create([
+            OrderItem(
+                order=order,
+                product_id=product_id,
+                quantity=quantity,
+                price=prices[product_id],
+                product_name=products[product_id].name
+            )
+            for product_id, quantity in quantities.items()
+        ])
+        create_holds(order, quantities, cart=cart)
+
+    return order
@@ -0,0 +1,119 @@
+from django.db import transaction
+from django.db.models import F
+
+from utils.gateways import COMPLETED, FAILED, PaymentGatewayError, get_payment_gateway
+from utils.jobs import RetryLater, enqueue
+from utils.resilience import GatewayUnavailable
+from .inventory import commit_order_stock
+from .models import Discount, Order, Transaction, TransactionPayload
+from .reservations import release_order_holds
+from .rollups import rollup_orders
+
+
+class PaymentInitiationError(Exception):
+    """Raised when the gateway did not return a redirect URL, the job is retried with backoff"""
+
+
+def queue_payment_initiation(order):
+    """Ask the job queue to start the order's payment once the current transaction commits"""
+    return enqueue(initiate_order_payment, on_failure=payment_initiation_failed, order_id=order.pk)
+
+
+def initiate_order_payment(order_id):
+    """
+    Background job: submit the order to the payment gateway, record the Transaction and fill
+    ``Order.payment_url``. Raises PaymentInitiationError so the job queue retries with backoff, the order is
+    marked failed by ``payment_initiation_failed`` once the attempts run out.
+    """
+    order = Order.objects.filter(pk=order_id).first()
+    if order is None or order.payment_link_status == Order.PAYMENT_LINK_READY:
+        return
+
+    gateway = get_payment_gateway()
+    try:
+        payment = gateway.initiate_payment(order)
+    except GatewayUnavailable as e:
+        # The order stays queued (payment pending) until the gateway recovers
+        raise RetryLater(e.retry_after or 30, str(e))
+    except PaymentGatewayError as e:
+        raise PaymentInitiationError(str(e))
+
+    with transaction.atomic():
+        tx, created = Transaction.objects.update_or_create(
+            order=order,
+            defaults={
+                'transaction_id': payment.reference,
+                'amount': order.total,
+                'currency': "KES",
+                'status': "PENDING",
+                'gateway': gateway.name,
+                'gateway_reference': payment.reference,
+                'redirect_url': payment.redirect_url,
+                'merchant_reference': payment.merchant_reference,
+            }
+        )
+        tx.add_payload(TransactionPayload.EVENT_INIT, payment.raw)
+        order.payment_url = payment.redirect_url
+        order.payment_link_status = Order.PAYMENT_LINK_READY
+        order.save(update_fields=["payment_url", "payment_link_status", "updated_on"])
+
+
+def payment_initiation_failed(order_id):
+    """Called by the job queue once every attempt to initiate the order's payment has failed"""
+    Order.objects.filter(pk=order_id).exclude(payment_link_status=Order.PAYMENT_LINK_READY).update(
+        payment_link_status=Order.PAYMENT_LINK_FAILED
+    )
+
+
+def apply_payment_status(notice, payment):
+    """
+    Apply the gateway's ``payment`` status to the order named by the ``notice`` (a PaymentNotice).
+
+    Safe to run again for a redelivered notification: the order and transaction rows are locked while
+    they are updated, a completed payment is never turned back into a failed one and the discount usage
+    and stock are only counted the first time the payment completes. A payment the gateway still reports
+    as pending leaves the transaction PENDING with the order's holds, reconciliation picks it up later.
+    """
+    with transaction.atomic():
+        order = Order.objects.select_for_update().get(order_number=notice.merchant_reference)
+        tx, created = Transaction.objects.select_for_update().get_or_create(
+            order=order,
+            defaults={"transaction_id": notice.reference, "gateway_reference": notice.reference}
+        )
+        already_completed = tx.status == COMPLETED
+        payloads = [
+            TransactionPayload(transaction=tx, event=TransactionPayload.EVENT_IPN, data=notice.raw),
+            TransactionPayload(transaction=tx, event=TransactionPayload.EVENT_STATUS, data=payment.raw),
+        ]
+
+        if not payment.settled and not already_completed:
+            TransactionPayload.objects.bulk_create(payloads)
+            return
+
+        if payment.status == COMPLETED or already_completed:
+            tx.status = COMPLETED
+            order.is_paid = True
+            order.status = "paid"
+        elif payment.status == FAILED:
+            tx.status = FAILED
+
+        tx.amount = payment.amount
+        tx.payment_method = payment.payment_method
+        tx.payment_account = payment.payment_account
+        tx.confirmation_code = payment.confirmation_code
+
+        # Update discount, once per paid order
+        if tx.status == COMPLETED and not already_completed and order.discount_code_id:
+            Discount.objects.filter(pk=order.discount_code_id).update(times_used=F("times_used") + 1)
+
+        tx.save()
+        order.save()
+        TransactionPayload.objects.bulk_create(payloads)
+
+        # Paid orders take their units out of stock and count in the sales rollups, failed ones give their
+        # holds back
+        if tx.status == COMPLETED:
+            commit_order_stock(order)
+            rollup_orders([order.pk])
+        elif tx.status == FAILED:
+            release_order_holds(order)
@@ -1,5 +1,7 @@
 from rest_framework import permissions
 
+from .cartstore import get_guest_cart_key
+
 
 class IsAdminOrReadOnly(permissions.BasePermission):
     """
@@ -24,9 +26,11 @@ class IsOwnerOrAdmin(permissions.BasePermission):
         if request.user and request.user.is_staff:
             return True
 
-        # For carts, check if the session_id matches
+        # Carts belong to their user, or to the guest whose guest cart key they were stored under
         if hasattr(obj, 'session_id'):
-            return obj.session_id == request.session.session_key
+            if obj.user_id:
+                return obj.user_id == request.user.pk
+            return obj.session_id is not None and obj.session_id == get_guest_cart_key(request, create=False)
 
         # For orders, check if the email matches
         if hasattr(obj, 'email'):
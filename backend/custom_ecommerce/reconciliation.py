@@ -0,0 +1,160 @@
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from utils.gateways import COMPLETED
+from utils.resilience import GatewayUnavailable
+from .inventory import commit_order_stock
+from .models import Discount, Order, Transaction, TransactionPayload
+from .reservations import release_order_holds
+from .rollups import rollup_orders
+from .stats import bump_counters, transaction_status_deltas
+
+
+class RateLimiter:
+    """Spaces calls at least ``1 / rate`` seconds apart across threads"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def stale_pending_batches(older_than, batch_size):
+    """
+    Yield {id: gateway reference} for PENDING transactions created before ``older_than``, walking the
+    table by primary key (keyset pagination) so every batch is an index range scan however far in it is.
+    """
+    last_id = 0
+    while True:
+        batch = list(
+            Transaction.objects.filter(status='PENDING', created_on__lt=older_than, pk__gt=last_id)
+            .order_by('pk').values_list('pk', 'gateway_reference', 'transaction_id')[:batch_size]
+        )
+        if not batch:
+            return
+        last_id = batch[-1][0]
+        yield {pk: reference or transaction_id for pk, reference, transaction_id in batch}
+
+
+def fetch_statuses(gateway, rows, concurrency, rate_limiter):
+    """
+    Look up the payments of ``rows`` ({transaction id: gateway reference}) with one batched gateway call
+    making at most ``concurrency`` requests at once. Returns ({transaction id: PaymentStatus}, failed lookups).
+    """
+    found = gateway.get_statuses(set(rows.values()), concurrency=concurrency, throttle=rate_limiter.wait)
+    statuses = {pk: found[reference] for pk, reference in rows.items() if reference in found}
+    return statuses, len(rows) - len(statuses)
+
+
+def apply_statuses(statuses):
+    """
+    Write the settled statuses in ``statuses`` ({transaction id: PaymentStatus}) with bulk updates. Rows are
+    locked and re-checked first (orders before transactions, like the IPN path), so a transaction that an IPN
+    settled in the meantime is left alone and nothing is counted twice. Returns a Counter of the new statuses.
+    """
+    settled = {pk: payment for pk, payment in statuses.items() if payment.settled}
+    if not settled:
+        return Counter()
+
+    with transaction.atomic():
+        orders = {
+            order.pk: order
+            for order in Order.objects.select_for_update().filter(transaction__pk__in=settled).order_by('pk')
+        }
+        transactions = list(
+            Transaction.objects.select_for_update().filter(pk__in=settled, status='PENDING').order_by('pk')
+        )
+
+        paid_orders, failed_orders = [], []
+        for tx in transactions:
+            payment = settled[tx.pk]
+            tx.status = payment.status
+            tx.amount = payment.amount
+            tx.payment_method = payment.payment_method
+            tx.payment_account = payment.payment_account
+            tx.confirmation_code = payment.confirmation_code
+            tx.updated_on = timezone.now()
+
+            order = orders.get(tx.order_id)
+            if order is None:
+                continue
+            if tx.status == COMPLETED:
+                order.is_paid = True
+                order.status = 'paid'
+                order.updated_on = timezone.now()
+                paid_orders.append(order)
+            else:
+                failed_orders.append(order)
+
+        Transaction.objects.bulk_update(
+            transactions,
+            ['status', 'amount', 'payment_method', 'payment_account', 'confirmation_code', 'updated_on']
+        )
+        TransactionPayload.objects.bulk_create([
+            TransactionPayload(transaction=tx, event=TransactionPayload.EVENT_STATUS, data=settled[tx.pk].raw)
+            for tx in transactions
+        ])
+        Order.objects.bulk_update(paid_orders, ['is_paid', 'status', 'updated_on'])
+        # bulk_update sends no post_save, so the dashboard counters are moved here
+        bump_counters(transaction_status_deltas(('PENDING', tx.status) for tx in transactions))
+
+        discount_uses = Counter(order.discount_code_id for order in paid_orders if order.discount_code_id)
+        for discount_id, uses in discount_uses.items():
+            Discount.objects.filter(pk=discount_id).update(times_used=F('times_used') + uses)
+
+        for order in paid_orders:
+            commit_order_stock(order)
+        rollup_orders([order.pk for order in paid_orders])
+        for order in failed_orders:
+            release_order_holds(order)
+
+    return Counter(tx.status for tx in transactions)
+
+
+def reconcile_pending_transactions(gateway, stale_after=timedelta(minutes=30), batch_size=100, concurrency=8,
+                                   rate=10, stdout=None):
+    """
+    Check every PENDING transaction older than ``stale_after`` with the gateway and apply the settled ones.
+    ``rate`` caps status requests per second across all threads. Returns a summary dict, with ``stopped``
+    set when the gateway became unavailable and the pass ended early, the next pass picks the rest up.
+    """
+    started = time.monotonic()
+    rate_limiter = RateLimiter(rate)
+    summary = Counter()
+
+    for rows in stale_pending_batches(timezone.now() - stale_after, batch_size):
+        try:
+            statuses, errors = fetch_statuses(gateway, rows, concurrency, rate_limiter)
+        except GatewayUnavailable as e:
+            summary['stopped'] = str(e)
+            break
+        changed = apply_statuses(statuses)
+        summary['checked'] += len(rows)
+        summary['errors'] += errors
+        summary.update(changed)
+
+        if stdout:
+            elapsed = time.monotonic() - started
+            stdout.write(
+                f"Checked {summary['checked']} transactions in {elapsed:.1f}s "
+                f"({summary['checked'] / elapsed:.1f}/s), {sum(changed.values())} settled in this batch"
+            )
+
+    summary['seconds'] = round(time.monotonic() - started, 2)
+    return dict(summary)
@@ -0,0 +1,73 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Product, StockHold
+
+
+def lock_products(product_ids):
+    """
+    Lock ``product_ids`` for the rest of the transaction and return them by id, annotated with ``available``.
+    Rows are locked in id order so concurrent checkouts of the same products queue up instead of deadlocking,
+    and each one sees the holds committed before it, which keeps the last units from being sold twice.
+    """
+    return Product.objects.select_for_update().with_available().order_by('pk').in_bulk(product_ids)
+
+
+def availability_errors(products, quantities):
+    """One message per product in ``quantities`` that is missing from ``products`` or short of stock"""
+    errors = []
+    for product_id, quantity in quantities.items():
+        product = products.get(product_id)
+        if product is None:
+            errors.append(f"Product {product_id} not found")
+        elif product.available < quantity:
+            errors.append(f"Only {max(product.available, 0)} items of product {product_id} available")
+    return errors
+
+
+def create_holds(order, quantities, cart=None):
+    """Hold ``quantities`` (product id to quantity) for ``order`` until STOCK_HOLD_TTL_SECONDS from now"""
+    expires_at = timezone.now() + timedelta(seconds=settings.STOCK_HOLD_TTL_SECONDS)
+    return StockHold.objects.bulk_create([
+        StockHold(product_id=product_id, quantity=quantity, expires_at=expires_at, order=order, cart=cart)
+        for product_id, quantity in quantities.items()
+    ])
+
+
+def convert_order_holds(order):
+    """
+    Mark the order's holds converted once its stock has been taken by inventory.commit_order_stock.
+    Holds that expired before the payment arrived are converted too.
+    """
+    return StockHold.objects.filter(
+        order=order, status__in=[StockHold.STATUS_ACTIVE, StockHold.STATUS_EXPIRED]
+    ).update(status=StockHold.STATUS_CONVERTED, updated_on=timezone.now())
+
+
+def release_order_holds(order):
+    """Give the order's active holds back, e.g. when its payment failed or it was cancelled"""
+    return StockHold.objects.filter(order=order, status=StockHold.STATUS_ACTIVE).update(
+        status=StockHold.STATUS_RELEASED, updated_on=timezone.now()
+    )
+
+
+def expire_stale_holds(batch_size=1000):
+    """
+    Mark holds past ``expires_at`` as expired in batches of ``batch_size`` rows so the sweeper never holds
+    long locks. Expired holds already stop counting against stock, this only keeps the active set small.
+    Returns the number of holds expired.
+    """
+    total = 0
+    while True:
+        now = timezone.now()
+        ids = list(
+            StockHold.objects.filter(status=StockHold.STATUS_ACTIVE, expires_at__lte=now)
+            .order_by('expires_at').values_list('pk', flat=True)[:batch_size]
+        )
+        if not ids:
+            return total
+        total += StockHold.objects.filter(pk__in=ids, status=StockHold.STATUS_ACTIVE).update(
+            status=StockHold.STATUS_EXPIRED, updated_on=now
+        )
@@ -0,0 +1,159 @@
+"""
+Daily sales rollups behind the sales analytics API.
+
+Paid orders are added to DailySales, DailyProductSales and DailyCategorySales exactly once, when they become
+paid (``rollup_orders``) or by ``manage.py backfill_sales_rollups`` for history. Each batch of orders is
+aggregated by the database with one GROUP BY per rollup table and the totals are added to the rollup rows,
+so analytics queries only read a handful of rows per day however many orders there were.
+Orders count on the day they were placed.
+"""
+from django.db import transaction
+from django.db.models import Count, DecimalField, F, Sum
+from django.db.models.functions import TruncDate, TruncMonth, TruncWeek
+
+from .models import DailyCategorySales, DailyProductSales, DailySales, Order, OrderItem
+
+METRICS = ('orders', 'units', 'revenue')
+
+INTERVALS = {
+    'day': None,
+    'week': TruncWeek,
+    'month': TruncMonth,
+}
+
+GROUPS = {
+    # group: (rollup model, fields identifying a row of the group in the response)
+    None: (DailySales, []),
+    'category': (DailyCategorySales, ['category_id', 'category__name']),
+    'product': (DailyProductSales, ['product_id', 'product__name']),
+}
+
+
+def _line_revenue():
+    return Sum(F('price') * F('quantity'), output_field=DecimalField(max_digits=14, decimal_places=2))
+
+
+def aggregate_orders(order_ids):
+    """
+    Totals of the orders grouped like each rollup table: {model: [row, ...]} where a row holds the table's
+    key fields and its metrics.
+    """
+    orders = Order.objects.filter(pk__in=order_ids).annotate(day=TruncDate('created_on'))
+    items = OrderItem.objects.filter(order_id__in=order_ids).annotate(day=TruncDate('order__created_on'))
+
+    daily = {
+        row['day']: {**row, 'units': 0}
+        for row in orders.values('day').annotate(orders=Count('id'), revenue=Sum('total')).order_by()
+    }
+    for row in items.values('day').annotate(units=Sum('quantity')).order_by():
+        daily[row['day']]['units'] = row['units']
+
+    products = items.values('day', 'product_id').annotate(
+        orders=Count('order_id', distinct=True), units=Sum('quantity'), revenue=_line_revenue()
+    ).order_by()
+    categories = items.values('day', category_id=F('product__category_id')).annotate(
+        orders=Count('order_id', distinct=True), units=Sum('quantity'), revenue=_line_revenue()
+    ).order_by()
+
+    return {
+        DailySales: list(daily.values()),
+        DailyProductSales: list(products),
+        DailyCategorySales: list(categories),
+    }
+
+
+def _key_fields(model):
+    return ['day'] + [field.attname for field in model._meta.concrete_fields if field.is_relation]
+
+
+def add_to_rollups(model, rows):
+    """
+    Add the metrics of ``rows`` to ``model``'s rollup rows. Missing rows are inserted first (ignoring the
+    ones a concurrent writer just inserted), then every affected row is locked in key order and updated.
+    """
+    if not rows:
+        return
+    key_fields = _key_fields(model)
+    totals = {tuple(row[field] for field in key_fields): row for row in rows}
+
+    model.objects.bulk_create(
+        [model(**dict(zip(key_fields, key))) for key in totals], ignore_conflicts=True
+    )
+    # A superset of the keys, narrowed down below, keeps the query small for big batches
+    filters = {f'{field}__in': {key[i] for key in totals} for i, field in enumerate(key_fields)}
+    rollups = []
+    for rollup in model.objects.select_for_update().filter(**filters).order_by(*key_fields):
+        row = totals.get(tuple(getattr(rollup, field) for field in key_fields))
+        if row is None:
+            continue
+        for metric in METRICS:
+            setattr(rollup, metric, getattr(rollup, metric) + (row[metric] or 0))
+        rollups.append(rollup)
+    model.objects.bulk_update(rollups, METRICS)
+
+
+@transaction.atomic
+def rollup_orders(order_ids):
+    """
+    Count the paid orders among ``order_ids`` that are not in the rollups yet, returns how many were added.
+    Safe to call again for the same orders, the claim on ``Order.sales_rolled_up`` makes it a no-op.
+    """
+    claimed = list(
+        Order.objects.select_for_update()
+        .filter(pk__in=order_ids, is_paid=True, sales_rolled_up=False)
+        .order_by('pk').values_list('pk', flat=True)
+    )
+    if not claimed:
+        return 0
+    Order.objects.filter(pk__in=claimed).update(sales_rolled_up=True)
+
+    for model, rows in aggregate_orders(claimed).items():
+        add_to_rollups(model, rows)
+    return len(claimed)
+
+
+def backfill_rollups(chunk_size=1000, rebuild=False, stdout=None):
+    """
+    Roll up every paid order not counted yet, ``chunk_size`` orders per transaction walking by primary key.
+    ``rebuild`` empties the rollups first so everything is recounted, run it while no orders are being paid.
+    """
+    if rebuild:
+        with transaction.atomic():
+            for model in (DailySales, DailyProductSales, DailyCategorySales):
+                model.objects.all().delete()
+            Order.objects.filter(sales_rolled_up=True).update(sales_rolled_up=False)
+
+    last_id = 0
+    total = 0
+    while True:
+        chunk = list(
+            Order.objects.filter(is_paid=True, sales_rolled_up=False, pk__gt=last_id)
+            .order_by('pk').values_list('pk', flat=True)[:chunk_size]
+        )
+        if not chunk:
+            return total
+        last_id = chunk[-1]
+        total += rollup_orders(chunk)
+        if stdout:
+            stdout.write(f"Rolled up {total} orders (up to order id {last_id})")
+
+
+def sales_series(start, end, interval='day', group=None):
+    """
+    Revenue, orders, units and average order value per ``interval`` between the ``start`` and ``end`` days,
+    overall or per ``group`` ('category' or 'product'), read from the rollups.
+    """
+    model, group_fields = GROUPS[group]
+    trunc = INTERVALS[interval]
+    rows = (
+        model.objects.filter(day__range=(start, end))
+        .annotate(period=trunc('day') if trunc else F('day'))
+        .values('period', *group_fields)
+        .annotate(revenue=Sum('revenue'), orders=Sum('orders'), units=Sum('units'))
+        .order_by('period', *group_fields)
+    )
+    series = []
+    for row in rows:
+        row['aov'] = round(row['revenue'] / row['orders'], 2) if row['orders'] else 0
+        series.append(row)
+    return series
@@ -1,9 +1,12 @@
+from datetime import timedelta
+
+from django.utils import timezone
 from rest_framework import serializers
 from drf_writable_nested import WritableNestedModelSerializer, UniqueFieldsMixin
 from main.utils import BaseSerializer
 from .models import (
     ProductCategory, Product, ProductImage,
-    Cart, CartItem, Order, OrderItem, Discount, Transaction, CallBackUrls
+    Cart, CartItem, Order, OrderItem, Discount, Transaction, TransactionPayload, CallBackUrls
 )
 
 
@@ -53,9 +56,10 @@ class ProductSerializer(BaseSerializer, WritableNestedModelSerializer):
         model = Product
         fields = ['id', 'name', 'slug', 'description', 'top_notes', 'middle_notes', 'base_notes',
                     'price', 'sale_price', 'category', 'category_id', 'stock', 'is_active', '_images',
-                  'images', 'is_on_sale', 'discount_percentage', 'created_on', 'updated_on']
+                  'images', 'is_on_sale', 'discount_percentage', 'units_sold', 'created_on', 'updated_on']
         extra_kwargs = {
-            'slug': {'read_only': True}
+            'slug': {'read_only': True},
+            'units_sold': {'read_only': True},
         }
 
     def get_is_on_sale(self, obj):
@@ -121,8 +125,29 @@ class ProductSerializer(BaseSerializer, WritableNestedModelSerializer):
         return data
 
 
+class CartProductSerializer(serializers.ModelSerializer):
+    """
+    Compact product representation for cart lines. Expects ``images`` to be
+    prefetched (see CartQuerySet.with_items) so the image lookup is free.
+    """
+    image = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Product
+        fields = ['id', 'name', 'slug', 'price', 'sale_price', 'stock', 'is_active', 'image']
+
+    def get_image(self, obj):
+        images = obj.images.all()
+        primary = next((image for image in images if image.is_primary), images[0] if images else None)
+        if primary is None:
+            return None
+        if primary.cloudinary_url:
+            return primary.cloudinary_url
+        return primary.image.url if primary.image else None
+
+
 class CartItemSerializer(BaseSerializer, serializers.ModelSerializer):
-    product = ProductSerializer(read_only=True)
+    product = CartProductSerializer(read_only=True)
     product_id = serializers.PrimaryKeyRelatedField(
         queryset=Product.objects.filter(is_active=True),
         write_only=True,
@@ -156,6 +181,42 @@ class CartItemSerializer(BaseSerializer, serializers.ModelSerializer):
         return data
 
 
+class CartLineChangeSerializer(serializers.Serializer):
+    """Response of the single line cart actions: the changed line and the recomputed cart totals"""
+    cart = serializers.IntegerField()
+    item = CartItemSerializer(allow_null=True)
+    total_items = serializers.IntegerField()
+    subtotal = serializers.DecimalField(max_digits=12, decimal_places=2)
+
+
+class CartOperationSerializer(serializers.Serializer):
+    OPERATION_CHOICES = ['add', 'set', 'remove']
+
+    op = serializers.ChoiceField(choices=OPERATION_CHOICES)
+    product_id = serializers.IntegerField()
+    quantity = serializers.IntegerField(required=False, min_value=0)
+
+    def validate(self, data):
+        if data['op'] == 'add' and data.get('quantity', 1) < 1:
+            raise serializers.ValidationError("Quantity must be at least 1")
+        if data['op'] == 'set' and 'quantity' not in data:
+            raise serializers.ValidationError("Quantity is required for set operations")
+        return data
+
+
+class CartBatchSerializer(serializers.Serializer):
+    operations = CartOperationSerializer(many=True, allow_empty=False)
+
+
+class StoredCartSerializer(serializers.Serializer):
+    """A cart held by the guest cart store, ``id`` is set once it has been written to the database"""
+    id = serializers.IntegerField(allow_null=True)
+    is_guest = serializers.BooleanField()
+    items = CartItemSerializer(many=True)
+    total_items = serializers.IntegerField()
+    subtotal = serializers.DecimalField(max_digits=12, decimal_places=2)
+
+
 class CartSerializer(BaseSerializer, WritableNestedModelSerializer):
     items = CartItemSerializer(many=True, required=False)
     total_items = serializers.IntegerField(read_only=True)
@@ -222,32 +283,58 @@ class DiscountSerializer(BaseSerializer, serializers.ModelSerializer):
         return message
 
 
-class TransactionSerializer(BaseSerializer, serializers.ModelSerializer):
+class DiscountSummarySerializer(serializers.ModelSerializer):
+    """The discount as applied to an order, without the per-user validity checks of DiscountSerializer"""
+
+    class Meta:
+        model = Discount
+        fields = ['id', 'code', 'description', 'discount_type', 'value']
+        read_only_fields = fields
+
+
+class TransactionPayloadsMixin:
+    """
+    Adds the newest raw gateway payloads, under the names they had as Transaction columns, when the view put
+    ``include_payloads`` in the context. Prefetch ``payloads`` when serializing many transactions.
+    """
+    PAYLOAD_FIELDS = [
+        ('transaction_init_info', TransactionPayload.EVENT_INIT),
+        ('ipn_data', TransactionPayload.EVENT_IPN),
+        ('all_transaction_info_after_callback', TransactionPayload.EVENT_STATUS),
+    ]
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if self.context.get('include_payloads'):
+            latest = instance.latest_payloads()
+            for name, event in self.PAYLOAD_FIELDS:
+                data[name] = latest.get(event)
+        return data
+
+
+class TransactionSerializer(TransactionPayloadsMixin, BaseSerializer, serializers.ModelSerializer):
     status_display = serializers.CharField(source='get_status_display', read_only=True)
+    # Pre-gateway field names, still read by API clients
+    pesapal_merchant_reference = serializers.CharField(source='merchant_reference', read_only=True)
+    pesapal_order_tracking_id = serializers.CharField(source='gateway_reference', read_only=True)
+    pesapal_redirect_url = serializers.CharField(source='redirect_url', read_only=True)
     
     class Meta:
         model = Transaction
         fields = [
             'id', 'order', 'transaction_id', 'amount', 'currency', 'status', 'status_display',
-            'payment_method', 'pesapal_merchant_reference', 'pesapal_order_tracking_id',
-            'pesapal_redirect_url', 'transaction_init_info', 'ipn_data', 
-            'all_transaction_info_after_callback', 'confirmation_code',
+            'payment_method', 'gateway', 'pesapal_merchant_reference', 'pesapal_order_tracking_id',
+            'pesapal_redirect_url', 'payment_account', 'confirmation_code',
             'created_on', 'updated_on'
         ]
         read_only_fields = fields  # Make all fields read-only
         extra_kwargs = {
-            'transaction_init_info': {'read_only': True},
-            'ipn_data': {'read_only': True},
-            'all_transaction_info_after_callback': {'read_only': True},
             'order': {'read_only': True},
             'transaction_id': {'read_only': True},
             'amount': {'read_only': True},
             'currency': {'read_only': True},
             'status': {'read_only': True},
             'payment_method': {'read_only': True},
-            'pesapal_merchant_reference': {'read_only': True},
-            'pesapal_order_tracking_id': {'read_only': True},
-            'pesapal_redirect_url': {'read_only': True},
             'confirmation_code': {'read_only': True},
             'created_on': {'read_only': True},
             'updated_on': {'read_only': True}
@@ -260,7 +347,8 @@ class OrderSerializer(BaseSerializer, UniqueFieldsMixin, WritableNestedModelSeri
     )
     items = OrderItemSerializer(many=True, read_only=True)
     status_display = serializers.CharField(source='get_status_display', read_only=True)
-    discount_code = DiscountSerializer(read_only=True)
+    discount_code = DiscountSummarySerializer(read_only=True)
+    transaction = TransactionSerializer(read_only=True)
     discount_code_id = serializers.PrimaryKeyRelatedField(
         queryset=Discount.objects.filter(is_active=True),
         write_only=True,
@@ -276,7 +364,7 @@ class OrderSerializer(BaseSerializer, UniqueFieldsMixin, WritableNestedModelSeri
                  'tax', 'discount', 'discount_code', 'discount_code_id', 'discount_message',
                  'total', 'notes', 'tracking_number', 'is_paid',
                  'estimated_delivery', 'payment_url', 'items', 'created_on', 'updated_on', 'cart_items',
-                  "transaction"]
+                  "transaction", 'payment_link_status', 'stock_status', 'stock_shortfall']
         extra_kwargs = {
             'order_number': {'read_only': True},
             'status': {'read_only': True},
@@ -284,17 +372,12 @@ class OrderSerializer(BaseSerializer, UniqueFieldsMixin, WritableNestedModelSeri
             'total': {'read_only': True},
             'discount': {'read_only': True},
             'cart': {'read_only': True},
-            'transaction': {'read_only': True},
             'is_paid': {'read_only': True},
+            'payment_link_status': {'read_only': True},
+            'stock_status': {'read_only': True},
+            'stock_shortfall': {'read_only': True},
         }
 
-    def to_representation(self, instance):
-        fields = self.get_fields()
-        required_fields = set(fields.keys())
-        if 'transaction' in required_fields:
-            self.fields['transaction'] = TransactionSerializer(many=False)
-        return super(OrderSerializer, self).to_representation(instance)
-
 
 class CallBackUrlsSerializer(BaseSerializer, serializers.ModelSerializer):
 
@@ -303,17 +386,20 @@ class CallBackUrlsSerializer(BaseSerializer, serializers.ModelSerializer):
         fields = ['id', 'url', 'callback_url_id', 'identifier', 'name', 'created_on', 'updated_on']
 
 
-class TransactionSerializerBasic(BaseSerializer, serializers.ModelSerializer):
+class TransactionSerializerBasic(TransactionPayloadsMixin, BaseSerializer, serializers.ModelSerializer):
     order_amount = serializers.SerializerMethodField()
     order_items = serializers.SerializerMethodField()
     order_number = serializers.SerializerMethodField()
-    
+    # Pre-gateway field names, still read by API clients
+    pesapal_merchant_reference = serializers.CharField(source='merchant_reference', read_only=True)
+    pesapal_order_tracking_id = serializers.CharField(source='gateway_reference', read_only=True)
+    pesapal_redirect_url = serializers.CharField(source='redirect_url', read_only=True)
+
     class Meta:
         model = Transaction
         fields = ['id', 'transaction_id', 'amount', 'currency', 'status',
-                 'payment_method', 'pesapal_merchant_reference', 'pesapal_order_tracking_id',
-                 'pesapal_redirect_url', 'transaction_init_info', 'ipn_data', 
-                 'all_transaction_info_after_callback', 'confirmation_code',
+                 'payment_method', 'gateway', 'pesapal_merchant_reference', 'pesapal_order_tracking_id',
+                 'pesapal_redirect_url', 'payment_account', 'confirmation_code',
                  'order_amount', 'order_items', 'order_number',
                  'created_on', 'updated_on']
         read_only_fields = fields  # Make all fields read-only
@@ -323,12 +409,6 @@ class TransactionSerializerBasic(BaseSerializer, serializers.ModelSerializer):
             'currency': {'read_only': True},
             'status': {'read_only': True},
             'payment_method': {'read_only': True},
-            'pesapal_merchant_reference': {'read_only': True},
-            'pesapal_order_tracking_id': {'read_only': True},
-            'pesapal_redirect_url': {'read_only': True},
-            'transaction_init_info': {'read_only': True},
-            'ipn_data': {'read_only': True},
-            'all_transaction_info_after_callback': {'read_only': True},
             'confirmation_code': {'read_only': True},
             'created_on': {'read_only': True},
             'updated_on': {'read_only': True}
@@ -347,4 +427,18 @@ class TransactionSerializerBasic(BaseSerializer, serializers.ModelSerializer):
     def get_order_number(self, obj):
         if obj.order:
             return obj.order.order_number
-        return None
\ No newline at end of file
+        return None
+
+
+class SalesAnalyticsQuerySerializer(serializers.Serializer):
+    start = serializers.DateField(required=False)
+    end = serializers.DateField(required=False)
+    interval = serializers.ChoiceField(choices=['day', 'week', 'month'], default='day')
+    group = serializers.ChoiceField(choices=['category', 'product'], required=False)
+
+    def validate(self, attrs):
+        attrs.setdefault('end', timezone.localdate())
+        attrs.setdefault('start', attrs['end'] - timedelta(days=29))
+        if attrs['start'] > attrs['end']:
+            raise serializers.ValidationError({'start': 'start must not be after end'})
+        return attrs
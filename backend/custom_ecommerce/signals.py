@@ -0,0 +1,79 @@
+from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from .cartstore import CartBusyError, get_guest_cart_key, merge_guest_cart
+from .models import Discount, Order, Product, ProductCategory, Transaction
+from .stats import bump_counters, sales_delta, transaction_status_deltas
+
+
+@receiver(user_logged_in)
+def merge_guest_cart_on_login(sender, request, user, **kwargs):
+    if request is None:
+        return
+    key = get_guest_cart_key(request, create=False)
+    if key:
+        try:
+            merge_guest_cart(key, user)
+        except CartBusyError:
+            # Signing in must not fail over the cart, the guest cart is merged on the next login
+            print(f"Guest cart {key} was busy, not merged into the cart of user {user.pk}")
+
+
+# Dashboard counters (custom_ecommerce/stats.py). The values a row was loaded with are remembered in
+# post_init, read from __dict__ so deferred fields are not fetched, and compared on save.
+
+@receiver(post_init, sender=Order)
+def remember_order_total(sender, instance, **kwargs):
+    instance._stats_total = instance.__dict__.get('total') if instance.pk else None
+
+
+@receiver(post_save, sender=Order)
+def count_order(sender, instance, created, **kwargs):
+    if created:
+        bump_counters({'orders': 1, 'sales': sales_delta(0, instance.total)})
+    elif instance._stats_total is not None and 'total' in instance.__dict__:
+        bump_counters({'sales': sales_delta(instance._stats_total, instance.total)})
+    instance._stats_total = instance.__dict__.get('total')
+
+
+@receiver(post_delete, sender=Order)
+def uncount_order(sender, instance, **kwargs):
+    bump_counters({'orders': -1, 'sales': -sales_delta(0, instance.total)})
+
+
+@receiver(post_init, sender=Transaction)
+def remember_transaction_status(sender, instance, **kwargs):
+    instance._stats_status = instance.__dict__.get('status') if instance.pk else None
+
+
+@receiver(post_save, sender=Transaction)
+def count_transaction(sender, instance, created, **kwargs):
+    if created:
+        bump_counters({f'transactions.{instance.status}': 1})
+    elif instance._stats_status is not None and 'status' in instance.__dict__:
+        bump_counters(transaction_status_deltas([(instance._stats_status, instance.status)]))
+    instance._stats_status = instance.__dict__.get('status')
+
+
+@receiver(post_delete, sender=Transaction)
+def uncount_transaction(sender, instance, **kwargs):
+    bump_counters({f'transactions.{instance.status}': -1})
+
+
+CATALOGUE_COUNTERS = {Product: 'products', ProductCategory: 'categories', Discount: 'discounts'}
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=ProductCategory)
+@receiver(post_save, sender=Discount)
+def count_catalogue_row(sender, instance, created, **kwargs):
+    if created:
+        bump_counters({CATALOGUE_COUNTERS[sender]: 1})
+
+
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=ProductCategory)
+@receiver(post_delete, sender=Discount)
+def uncount_catalogue_row(sender, instance, **kwargs):
+    bump_counters({CATALOGUE_COUNTERS[sender]: -1})
@@ -0,0 +1,123 @@
+"""
+Dashboard numbers for EcommerceStatsView.
+
+The numbers are kept as StatsCounter rows that signals adjust as orders, transactions and catalogue rows
+change, so reading them is one small query. ``compute_stats`` gets the exact values with one conditional
+aggregate per table, it seeds and repairs the counters (``manage.py rebuild_stats_counters``).
+"""
+from collections import Counter
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, DecimalField, F, Q, Sum, Value
+from django.db.models.functions import Coalesce
+
+from .models import Discount, Order, Product, ProductCategory, StatsCounter, Transaction
+
+TRANSACTION_STATUSES = [status for status, label in Transaction.STATUS_CHOICES]
+
+COUNTERS = [
+    'orders', 'sales', 'products', 'categories', 'discounts',
+    *(f'transactions.{status}' for status in TRANSACTION_STATUSES),
+]
+
+CACHE_KEY = 'ecommerce:stats:{source}'
+
+
+def compute_stats():
+    """Exact counter values, one aggregate query per table"""
+    orders = Order.objects.aggregate(
+        orders=Count('id'),
+        sales=Coalesce(Sum('total'), Value(0), output_field=DecimalField(max_digits=14, decimal_places=2)),
+    )
+    transactions = Transaction.objects.aggregate(**{
+        f'transactions.{status}': Count('id', filter=Q(status=status)) for status in TRANSACTION_STATUSES
+    })
+    return {
+        **orders,
+        **transactions,
+        'products': Product.objects.count(),
+        'categories': ProductCategory.objects.count(),
+        'discounts': Discount.objects.count(),
+    }
+
+
+def read_counters():
+    values = dict.fromkeys(COUNTERS, 0)
+    values.update(StatsCounter.objects.filter(name__in=COUNTERS).values_list('name', 'value'))
+    return values
+
+
+@transaction.atomic
+def rebuild_counters():
+    """Overwrite the counters with exact values, returns them"""
+    values = compute_stats()
+    existing = StatsCounter.objects.select_for_update().in_bulk(COUNTERS, field_name='name')
+    for name, value in values.items():
+        counter = existing.get(name) or StatsCounter(name=name)
+        counter.value = value
+        counter.save()
+    cache.delete_many([CACHE_KEY.format(source=source) for source in ('counters', 'live')])
+    return values
+
+
+def _apply(deltas):
+    for name, delta in sorted(deltas.items()):
+        if not delta:
+            continue
+        if not StatsCounter.objects.filter(name=name).update(value=F('value') + delta):
+            counter, created = StatsCounter.objects.get_or_create(name=name, defaults={'value': delta})
+            if not created:
+                StatsCounter.objects.filter(name=name).update(value=F('value') + delta)
+
+
+def bump_counters(deltas):
+    """
+    Add ``deltas`` ({counter: amount}) to the counters once the current transaction commits, so rolled back
+    changes are never counted and the counter rows are only locked for a moment.
+    """
+    deltas = {name: delta for name, delta in deltas.items() if delta}
+    if deltas:
+        transaction.on_commit(lambda: _apply(deltas))
+
+
+def transaction_status_deltas(changes):
+    """Counter deltas for transactions moving between statuses, ``changes`` is [(old, new)]"""
+    deltas = Counter()
+    for old, new in changes:
+        if old != new:
+            deltas[f'transactions.{old}'] -= 1
+            deltas[f'transactions.{new}'] += 1
+    return deltas
+
+
+def format_stats(values):
+    return {
+        'total_sales': values['sales'],
+        'total_orders': int(values['orders']),
+        'total_products': int(values['products']),
+        'total_categories': int(values['categories']),
+        'total_discounts': int(values['discounts']),
+        'transactions': {
+            'pending_transactions': int(values['transactions.PENDING']),
+            'completed_transactions': int(values['transactions.COMPLETED']),
+            'failed_transactions': int(values['transactions.FAILED']),
+        }
+    }
+
+
+def get_ecommerce_stats(live=False):
+    """The dashboard numbers from the counters, or the exact aggregates with ``live``, cached briefly"""
+    source = 'live' if live else 'counters'
+    key = CACHE_KEY.format(source=source)
+    stats = cache.get(key)
+    if stats is None:
+        stats = format_stats(compute_stats() if live else read_counters())
+        cache.set(key, stats, settings.ECOMMERCE_STATS_CACHE_SECONDS)
+    return stats
+
+
+def sales_delta(old_total, new_total):
+    return Decimal(new_total or 0) - Decimal(old_total or 0)
@@ -1,3 +1,978 @@
-from django.test import TestCase
+from datetime import timedelta
+from functools import partial
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_in
+from django.db import connection, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from utils.gateways import COMPLETED, FAILED, PaymentGatewayError, get_payment_gateway
+from utils.jobs import run_due_jobs
+from utils.models import Job
+from utils.resilience import CircuitOpenError, GatewayUnavailable
+from utils.testing import run_concurrently
+from .cart import add_to_cart, apply_cart_operations, fold_cart_operations
+from .cartstore import get_cart_store
+from .inventory import commit_order_stock
+from .leaderboards import current_trending_score, rebase_trending, update_leaderboards
+from .models import (
+    Cart, CartItem, DailyCategorySales, DailyProductSales, DailySales, Discount, Leaderboard, Order, OrderItem,
+    Product, ProductCategory, StockHold, Transaction, TransactionPayload
+)
+from .numbering import OrderNumberAllocator, next_order_number
+from .orders import create_order
+from .payments import initiate_order_payment
+from .reconciliation import apply_statuses, reconcile_pending_transactions
+from .reservations import expire_stale_holds
+from .rollups import backfill_rollups, rollup_orders
+from .serializers import OrderSerializer
+from .stats import compute_stats, read_counters, rebuild_counters
+
+
+def create_paid_order(product, quantity, is_paid=True):
+    order = Order.objects.create(
+        shipping_address='Street', billing_address='Street', email='buyer@example.com', phone_number='0700000000',
+        first_name='Buyer', last_name='One', subtotal=product.price * quantity, total=product.price * quantity,
+        is_paid=is_paid, status='paid' if is_paid else 'pending'
+    )
+    OrderItem.objects.create(
+        order=order, product=product, quantity=quantity, price=product.price, product_name=product.name
+    )
+    return order
+
+
+class CommitOrderStockTests(TestCase):
+
+    def setUp(self):
+        category = ProductCategory.objects.create(name='Candles')
+        self.product = Product.objects.create(name='Vanilla', price=10, stock=5, category=category)
+        self.other = Product.objects.create(name='Cedar', price=12, stock=1, category=category)
+
+    def test_commits_all_lines(self):
+        order = create_paid_order(self.product, 3)
+
+        self.assertEqual(commit_order_stock(order), Order.STOCK_COMMITTED)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 2)
+
+    def test_records_short_lines(self):
+        order = create_paid_order(self.product, 2)
+        OrderItem.objects.create(order=order, product=self.other, quantity=3, price=12, product_name='Cedar')
+
+        self.assertEqual(commit_order_stock(order), Order.STOCK_SHORT)
+        order.refresh_from_db()
+        self.assertEqual(order.stock_shortfall, [{'product_id': self.other.pk, 'requested': 3, 'available': 1}])
+        self.product.refresh_from_db()
+        self.other.refresh_from_db()
+        self.assertEqual((self.product.stock, self.other.stock), (3, 1))
+
+    def test_repeated_commit_is_ignored(self):
+        order = create_paid_order(self.product, 2)
+
+        commit_order_stock(order)
+        commit_order_stock(order)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 3)
+
+
+class OrderNumberAllocatorTests(TestCase):
+
+    def test_blocks_never_overlap_when_the_size_changes(self):
+        first, second = OrderNumberAllocator(), OrderNumberAllocator()
+        with override_settings(ORDER_NUMBER_BLOCK_SIZE=3):
+            numbers = first.allocate(5)
+        with override_settings(ORDER_NUMBER_BLOCK_SIZE=10):
+            numbers += second.allocate(4)
+        numbers += first.allocate(4)
+        self.assertEqual(len(set(numbers)), 13)
+
+    def test_block_rolled_back_with_the_request_is_not_reused(self):
+        first, second = OrderNumberAllocator(), OrderNumberAllocator()
+        with self.assertRaises(ZeroDivisionError):
+            with transaction.atomic():
+                first.allocate(2)
+                1 / 0
+        # The rolled back range is free again and the other process takes it
+        taken = second.allocate(3)
+        self.assertFalse(set(taken) & set(first.allocate(3)))
+
+    @override_settings(ORDER_NUMBER_BLOCK_SIZE=2)
+    def test_bulk_create_numbers_orders(self):
+        category = ProductCategory.objects.create(name='Candles')
+        product = Product.objects.create(name='Vanilla', price=10, stock=5, category=category)
+        single = create_paid_order(product, 1)
+        orders = Order.objects.bulk_create([
+            Order(shipping_address='Street', billing_address='Street', email='buyer@example.com',
+                  phone_number='0700000000', first_name='Buyer', last_name='One', subtotal=10, total=10)
+            for _ in range(5)
+        ])
+        numbers = [single.order_number] + [order.order_number for order in orders]
+        self.assertEqual(len(set(numbers)), 6)
+        self.assertEqual(numbers, sorted(numbers))
+
+
+class CommitOrderStockConcurrencyTests(TransactionTestCase):
+    """Many orders paid at once for the last units must never oversell"""
+
+    workers = 20
+    stock = 7
+
+    def test_concurrent_commits_never_oversell(self):
+        category = ProductCategory.objects.create(name='Candles')
+        product = Product.objects.create(name='Vanilla', price=10, stock=self.stock, category=category)
+        orders = [create_paid_order(product, 1) for _ in range(self.workers)]
+
+        errors = run_concurrently(commit_order_stock, [(order,) for order in orders])
+
+        self.assertEqual(errors, [])
+        product.refresh_from_db()
+        self.assertEqual(product.stock, 0)
+        statuses = list(Order.objects.values_list('stock_status', flat=True))
+        self.assertEqual(statuses.count(Order.STOCK_COMMITTED), self.stock)
+        self.assertEqual(statuses.count(Order.STOCK_SHORT), self.workers - self.stock)
+
+
+ORDER_DETAILS = {
+    'shipping_address': 'Street', 'billing_address': 'Street', 'email': 'buyer@example.com',
+    'phone_number': '0700000000', 'first_name': 'Buyer', 'last_name': 'One',
+}
+
+
+@override_settings(
+    GUEST_CART_STORE='custom_ecommerce.cartstore.LocMemCartStore', GUEST_CART_WRITE_BEHIND_SECONDS=0,
+    PAYMENT_GATEWAY='fake', BACKGROUND_JOBS_MODE='eager'
+)
+class GuestCartStoreTests(TestCase):
+
+    def setUp(self):
+        category = ProductCategory.objects.create(name='Candles')
+        self.vanilla = Product.objects.create(name='Vanilla', price=10, stock=5, category=category)
+        self.cedar = Product.objects.create(name='Cedar', price=12, stock=5, category=category)
+        self.client = APIClient()
+
+    def add(self, client, product, quantity=1):
+        return client.post('/api/commerce/carts/mine/', {
+            'operations': [{'op': 'add', 'product_id': product.pk, 'quantity': quantity}]
+        }, format='json')
+
+    def test_guest_cart_lives_in_the_store_without_sessions(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.add(self.client, self.vanilla, 2)
+            self.add(self.client, self.cedar)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('guest_cart', response.cookies)
+        self.assertFalse([query for query in queries.captured_queries if 'django_session' in query['sql']])
+        self.assertFalse(Cart.objects.exists())
+
+        cart = self.client.get('/api/commerce/carts/mine/').json()
+        self.assertEqual(cart['total_items'], 3)
+        # Another guest has a cart of their own
+        self.assertEqual(APIClient().get('/api/commerce/carts/mine/').json()['total_items'], 0)
+
+    def test_persisted_cart_is_found_by_its_owner_only(self):
+        self.add(self.client, self.vanilla, 2)
+        cart_id = self.client.post('/api/commerce/carts/mine/checkout/').json()['id']
+
+        self.assertEqual([cart['id'] for cart in self.client.get('/api/commerce/carts/').json()['results']], [cart_id])
+        self.assertEqual(self.client.get(f'/api/commerce/carts/{cart_id}/').status_code, 200)
+        self.assertEqual(APIClient().get(f'/api/commerce/carts/{cart_id}/').status_code, 404)
+
+    def test_order_closes_the_guest_cart(self):
+        self.add(self.client, self.vanilla, 2)
+        cart_id = self.client.post('/api/commerce/carts/mine/checkout/').json()['id']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/commerce/orders/', {
+                **ORDER_DETAILS, 'cart_items': [{'product_id': self.vanilla.pk, 'quantity': 2}],
+            }, format='json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['cart'], cart_id)
+        self.assertTrue(Cart.objects.get(pk=cart_id).is_ordered)
+        self.assertEqual(self.client.get('/api/commerce/carts/mine/').json()['total_items'], 0)
+
+    def test_order_closes_the_user_cart(self):
+        user = User.objects.create_user('buyer', email='buyer@example.com')
+        client = APIClient()
+        client.force_authenticate(user)
+        self.add(client, self.cedar, 1)
+        cart = Cart.objects.get(user=user)
+
+        client.post('/api/commerce/orders/', {
+            **ORDER_DETAILS, 'cart_items': [{'product_id': self.vanilla.pk, 'quantity': 1}],
+        }, format='json')
+
+        cart.refresh_from_db()
+        self.assertTrue(cart.is_ordered)
+        self.assertEqual(list(cart.items.values_list('product_id', 'quantity')), [(self.vanilla.pk, 1)])
+
+    def test_login_merges_the_guest_cart(self):
+        user = User.objects.create_user('buyer')
+        self.add(self.client, self.vanilla, 2)
+        request = RequestFactory().get('/')
+        request.COOKIES['guest_cart'] = self.client.cookies['guest_cart'].value
+
+        user_logged_in.send(sender=User, request=request, user=user)
+
+        cart = Cart.objects.get(user=user, is_ordered=False)
+        self.assertEqual(list(cart.items.values_list('product_id', 'quantity')), [(self.vanilla.pk, 2)])
+        self.assertEqual(self.client.get('/api/commerce/carts/mine/').json()['total_items'], 0)
+
+
+class CartOperationsTests(TestCase):
+
+    def test_batch_losing_the_insert_race_is_folded_again(self):
+        category = ProductCategory.objects.create(name='Candles')
+        vanilla = Product.objects.create(name='Vanilla', price=10, stock=100, category=category)
+        cedar = Product.objects.create(name='Cedar', price=12, stock=100, category=category)
+        cart = Cart.objects.create()
+        folds = []
+
+        def fold_after_a_concurrent_add(*args):
+            if not folds:
+                # Another request creates the line after the batch locked the existing ones
+                add_to_cart(cart.pk, vanilla, 1)
+            folds.append(args)
+            return fold_cart_operations(*args)
+
+        with mock.patch('custom_ecommerce.cart.fold_cart_operations', side_effect=fold_after_a_concurrent_add):
+            apply_cart_operations(cart.pk, [
+                {'op': 'add', 'product_id': vanilla.pk, 'quantity': 2},
+                {'op': 'add', 'product_id': cedar.pk, 'quantity': 1},
+            ])
+
+        self.assertEqual(len(folds), 2)
+        self.assertEqual(
+            dict(CartItem.objects.filter(cart=cart).values_list('product_id', 'quantity')),
+            {vanilla.pk: 3, cedar.pk: 1}
+        )
+
+
+class AddToCartConcurrencyTests(TransactionTestCase):
+    """Taps on "add to cart" arriving together must all count, on a single line"""
+
+    workers = 10
+
+    def test_concurrent_adds_make_one_line(self):
+        category = ProductCategory.objects.create(name='Candles')
+        product = Product.objects.create(name='Vanilla', price=10, stock=100, category=category)
+        cart = Cart.objects.create()
+
+        errors = run_concurrently(add_to_cart, [(cart.pk, product, 1)] * self.workers)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(list(CartItem.objects.filter(cart=cart).values_list('quantity', flat=True)), [self.workers])
+
+    def test_batches_racing_single_adds(self):
+        category = ProductCategory.objects.create(name='Candles')
+        vanilla = Product.objects.create(name='Vanilla', price=10, stock=100, category=category)
+        cedar = Product.objects.create(name='Cedar', price=12, stock=100, category=category)
+        cart = Cart.objects.create()
+        batch = partial(apply_cart_operations, cart.pk, [
+            {'op': 'add', 'product_id': vanilla.pk, 'quantity': 2},
+            {'op': 'add', 'product_id': cedar.pk, 'quantity': 1},
+        ])
+        single = partial(add_to_cart, cart.pk, vanilla, 1)
+
+        errors = run_concurrently(lambda action: action(), [(batch,), (single,)] * (self.workers // 2))
+
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            dict(CartItem.objects.filter(cart=cart).values_list('product_id', 'quantity')),
+            {vanilla.pk: 3 * self.workers // 2, cedar.pk: self.workers // 2}
+        )
+
+
+@override_settings(PAYMENT_GATEWAY='fake', BACKGROUND_JOBS_MODE='eager')
+class CheckoutReservationTests(TransactionTestCase):
+    """Checkouts racing for the last unit: one gets the hold, the others a clean 400"""
+
+    workers = 2
+
+    def test_concurrent_checkouts_for_the_last_unit(self):
+        category = ProductCategory.objects.create(name='Candles')
+        product = Product.objects.create(name='Vanilla', price=10, stock=1, category=category)
+        responses = []
+
+        def checkout():
+            responses.append(APIClient().post('/api/commerce/orders/', {
+                **ORDER_DETAILS, 'cart_items': [{'product_id': product.pk, 'quantity': 1}],
+            }, format='json'))
+
+        errors = run_concurrently(checkout, [()] * self.workers)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(response.status_code for response in responses), [201, 400])
+        rejected = next(response for response in responses if response.status_code == 400)
+        self.assertIn('cart_items', rejected.json())
+        self.assertEqual(StockHold.objects.filter(product=product, status=StockHold.STATUS_ACTIVE).count(), 1)
+        self.assertEqual(Order.objects.count(), 1)
+
+
+class StockHoldExpiryTests(TestCase):
+
+    def test_expired_holds_are_released(self):
+        category = ProductCategory.objects.create(name='Candles')
+        product = Product.objects.create(name='Vanilla', price=10, stock=3, category=category)
+        order = create_paid_order(product, 2, is_paid=False)
+        expired = StockHold.objects.create(
+            product=product, quantity=2, order=order, expires_at=timezone.now() - timedelta(seconds=1)
+        )
+        live = StockHold.objects.create(
+            product=product, quantity=1, order=order, expires_at=timezone.now() + timedelta(minutes=15)
+        )
+
+        # Expired holds stop counting right away, the sweep only marks them
+        self.assertEqual(Product.objects.with_available().get(pk=product.pk).available, 2)
+        self.assertEqual(expire_stale_holds(batch_size=1), 1)
+
+        expired.refresh_from_db()
+        live.refresh_from_db()
+        self.assertEqual((expired.status, live.status), (StockHold.STATUS_EXPIRED, StockHold.STATUS_ACTIVE))
+        self.assertEqual(expire_stale_holds(), 0)
+
+
+@override_settings(GUEST_CART_STORE='custom_ecommerce.cartstore.LocMemCartStore', GUEST_CART_WRITE_BEHIND_SECONDS=0)
+class GuestCartStoreConcurrencyTests(TransactionTestCase):
+
+    workers = 10
+
+    def test_concurrent_updates_are_not_lost(self):
+        category = ProductCategory.objects.create(name='Candles')
+        product = Product.objects.create(name='Vanilla', price=10, stock=100, category=category)
+        store = get_cart_store()
+        operations = [{'op': 'add', 'product_id': product.pk, 'quantity': 1}]
+
+        # Without write-behind the store only reads the database, so the updates really overlap on SQLite too
+        errors = run_concurrently(store.apply, [('guest', operations)] * self.workers, db_writes=False)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(store.load('guest').quantities, {product.pk: self.workers})
+
+
+@override_settings(PAYMENT_GATEWAY='fake', BACKGROUND_JOBS_MODE='eager')
+class FakeGatewayPaymentTests(TestCase):
+
+    def setUp(self):
+        category = ProductCategory.objects.create(name='Candles')
+        self.product = Product.objects.create(name='Vanilla', price=10, stock=5, category=category)
+        self.gateway = get_payment_gateway()
+
+    def start_payment(self, quantity=1):
+        order = create_paid_order(self.product, quantity, is_paid=False)
+        initiate_order_payment(order.pk)
+        order.refresh_from_db()
+        return order, order.transaction
+
+    def test_initiation_records_gateway_reference(self):
+        order, transaction = self.start_payment()
+
+        self.assertEqual(order.payment_link_status, Order.PAYMENT_LINK_READY)
+        self.assertEqual(transaction.gateway, 'fake')
+        self.assertEqual(transaction.merchant_reference, order.order_number)
+        self.assertEqual(order.payment_url, transaction.redirect_url)
+
+    def test_notification_applies_settled_payment(self):
+        order, transaction = self.start_payment(quantity=2)
+        self.gateway.settle(transaction.gateway_reference, COMPLETED)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/commerce/payment-callback/', {
+                'OrderTrackingId': transaction.gateway_reference,
+                'OrderMerchantReference': order.order_number,
+                'OrderNotificationType': 'IPNCHANGE',
+            }, content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        order.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertTrue(order.is_paid)
+        self.assertEqual(order.transaction.status, COMPLETED)
+        self.assertEqual(self.product.stock, 3)
+        self.assertEqual(DailySales.objects.get().orders, 1)
+
+    def test_pending_notification_keeps_transaction_and_holds(self):
+        order, transaction = self.start_payment()
+        hold = StockHold.objects.create(
+            product=self.product, quantity=1, order=order, expires_at=timezone.now() + timedelta(minutes=15)
+        )
+        notification = {
+            'OrderTrackingId': transaction.gateway_reference,
+            'OrderMerchantReference': order.order_number,
+            'OrderNotificationType': 'IPNCHANGE',
+        }
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/commerce/payment-callback/', notification, content_type='application/json')
+
+        transaction.refresh_from_db()
+        hold.refresh_from_db()
+        self.assertEqual(transaction.status, 'PENDING')
+        self.assertEqual(hold.status, StockHold.STATUS_ACTIVE)
+        self.assertFalse(Order.objects.get(pk=order.pk).is_paid)
+
+        # The payment succeeding later still counts
+        self.gateway.settle(transaction.gateway_reference, COMPLETED)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/commerce/payment-callback/', notification, content_type='application/json')
+        transaction.refresh_from_db()
+        self.assertEqual(transaction.status, COMPLETED)
+        self.assertTrue(Order.objects.get(pk=order.pk).is_paid)
+
+    def test_redelivered_notification_changes_nothing(self):
+        order, transaction = self.start_payment(quantity=2)
+        discount = Discount.objects.create(
+            code='SAVE', value=10, start_date=timezone.now() - timedelta(days=1),
+            end_date=timezone.now() + timedelta(days=1)
+        )
+        Order.objects.filter(pk=order.pk).update(discount_code=discount)
+        self.gateway.settle(transaction.gateway_reference, COMPLETED)
+        notification = {
+            'OrderTrackingId': transaction.gateway_reference,
+            'OrderMerchantReference': order.order_number,
+            'OrderNotificationType': 'IPNCHANGE',
+        }
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/commerce/payment-callback/', notification, content_type='application/json')
+        # The gateway sends the IPN again, later reporting the payment as failed
+        for status in (COMPLETED, FAILED):
+            self.gateway.settle(transaction.gateway_reference, status)
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(
+                    '/api/commerce/payment-callback/', notification, content_type='application/json'
+                )
+            self.assertEqual(response.status_code, 200)
+
+        discount.refresh_from_db()
+        order.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual(discount.times_used, 1)
+        self.assertEqual((order.status, order.is_paid), ('paid', True))
+        self.assertEqual(order.transaction.status, COMPLETED)
+        self.assertEqual(self.product.stock, 3)
+        self.assertEqual(DailySales.objects.get().orders, 1)
+
+    def test_reconcile_uses_batched_statuses(self):
+        paid, paid_tx = self.start_payment()
+        failed, failed_tx = self.start_payment()
+        waiting, waiting_tx = self.start_payment()
+        self.gateway.settle(paid_tx.gateway_reference, COMPLETED)
+        self.gateway.settle(failed_tx.gateway_reference, FAILED)
+
+        summary = reconcile_pending_transactions(self.gateway, stale_after=timedelta(0), rate=0)
+
+        self.assertEqual((summary['checked'], summary[COMPLETED], summary[FAILED]), (3, 1, 1))
+        statuses = dict(Transaction.objects.values_list('pk', 'status'))
+        self.assertEqual(
+            [statuses[paid_tx.pk], statuses[failed_tx.pk], statuses[waiting_tx.pk]], [COMPLETED, FAILED, 'PENDING']
+        )
+
+    def test_reconcile_settles_stale_pending_payments(self):
+        paid, paid_tx = self.start_payment(quantity=2)
+        failed, failed_tx = self.start_payment()
+        lost, lost_tx = self.start_payment()
+        fresh, fresh_tx = self.start_payment()
+        discount = Discount.objects.create(
+            code='SAVE', value=10, start_date=timezone.now() - timedelta(days=1),
+            end_date=timezone.now() + timedelta(days=1)
+        )
+        Order.objects.filter(pk=paid.pk).update(discount_code=discount)
+        hold = StockHold.objects.create(
+            product=self.product, quantity=1, order=failed, expires_at=timezone.now() + timedelta(minutes=15)
+        )
+        self.gateway.settle(paid_tx.gateway_reference, COMPLETED)
+        self.gateway.settle(failed_tx.gateway_reference, FAILED)
+        self.gateway.settle(fresh_tx.gateway_reference, COMPLETED)
+        # The gateway does not know this one, it stays PENDING and counts as an error
+        Transaction.objects.filter(pk=lost_tx.pk).update(gateway_reference='unknown')
+        Transaction.objects.exclude(pk=fresh_tx.pk).update(created_on=timezone.now() - timedelta(hours=1))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            summary = reconcile_pending_transactions(
+                self.gateway, stale_after=timedelta(minutes=30), batch_size=1, rate=0
+            )
+
+        self.assertEqual(
+            (summary['checked'], summary['errors'], summary[COMPLETED], summary[FAILED]), (3, 1, 1, 1)
+        )
+        statuses = dict(Transaction.objects.values_list('pk', 'status'))
+        self.assertEqual(
+            [statuses[paid_tx.pk], statuses[failed_tx.pk], statuses[lost_tx.pk], statuses[fresh_tx.pk]],
+            [COMPLETED, FAILED, 'PENDING', 'PENDING']
+        )
+        paid.refresh_from_db()
+        discount.refresh_from_db()
+        hold.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual((paid.status, paid.is_paid), ('paid', True))
+        self.assertEqual(discount.times_used, 1)
+        self.assertEqual(self.product.stock, 3)
+        self.assertEqual(hold.status, StockHold.STATUS_RELEASED)
+        self.assertFalse(Order.objects.get(pk=failed.pk).is_paid)
+
+        # A second run only looks at what is still pending
+        summary = reconcile_pending_transactions(self.gateway, stale_after=timedelta(minutes=30), rate=0)
+        self.assertEqual((summary['checked'], summary['errors']), (1, 1))
+        discount.refresh_from_db()
+        self.assertEqual(discount.times_used, 1)
+
+    def test_reconcile_stops_while_the_gateway_is_unavailable(self):
+        for _ in range(3):
+            self.start_payment()
+        unavailable = CircuitOpenError('fake circuit is open', retry_after=30)
+
+        with mock.patch.object(self.gateway, 'get_statuses', side_effect=unavailable) as get_statuses:
+            summary = reconcile_pending_transactions(self.gateway, stale_after=timedelta(0), batch_size=1, rate=0)
+
+        self.assertEqual(get_statuses.call_count, 1)
+        self.assertEqual(summary['stopped'], 'fake circuit is open')
+        self.assertEqual(summary.get('checked', 0), 0)
+        self.assertEqual(Transaction.objects.filter(status='PENDING').count(), 3)
+
+    def test_reconcile_leaves_payments_settled_by_ipn(self):
+        order, transaction = self.start_payment()
+        self.gateway.settle(transaction.gateway_reference, COMPLETED)
+        statuses = {transaction.pk: self.gateway.get_status(transaction.gateway_reference)}
+
+        # The IPN lands between the status lookup and the write
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/commerce/payment-callback/', {
+                'OrderTrackingId': transaction.gateway_reference,
+                'OrderMerchantReference': order.order_number,
+                'OrderNotificationType': 'IPNCHANGE',
+            }, content_type='application/json')
+        payloads = TransactionPayload.objects.count()
+
+        self.assertEqual(apply_statuses(statuses), {})
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 4)
+        self.assertEqual(TransactionPayload.objects.count(), payloads)
+        self.assertEqual(DailySales.objects.get().orders, 1)
+
+
+@override_settings(
+    GUEST_CART_STORE='custom_ecommerce.cartstore.LocMemCartStore', PAYMENT_GATEWAY='fake',
+    BACKGROUND_JOBS_MODE='eager', BACKGROUND_JOBS_MAX_ATTEMPTS=2
+)
+class PaymentInitiationTests(TestCase):
+
+    def setUp(self):
+        category = ProductCategory.objects.create(name='Candles')
+        self.product = Product.objects.create(name='Vanilla', price=10, stock=5, category=category)
+        self.client = APIClient()
+
+    def place_order(self, client=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = (client or self.client).post('/api/commerce/orders/', {
+                **ORDER_DETAILS, 'cart_items': [{'product_id': self.product.pk, 'quantity': 1}],
+            }, format='json')
+        self.assertEqual(response.status_code, 201)
+        return Order.objects.get(order_number=response.json()['order_number'])
+
+    def payment_status(self, client, order):
+        return client.get('/api/commerce/orders/payment-status/', {'order_number': order.order_number})
+
+    def run_jobs_now(self):
+        Job.objects.update(run_at=timezone.now())
+        with self.captureOnCommitCallbacks(execute=True):
+            run_due_jobs()
+
+    def test_payment_link_is_ready_after_the_job(self):
+        order = self.place_order()
+
+        self.assertEqual(order.payment_link_status, Order.PAYMENT_LINK_READY)
+        self.assertEqual(order.payment_url, order.transaction.redirect_url)
+        self.assertEqual(order.transaction.status, 'PENDING')
+        self.assertEqual(self.payment_status(self.client, order).json()['payment_url'], order.payment_url)
+
+    def test_rejected_initiation_is_retried_then_failed(self):
+        with mock.patch('utils.gateways.FakeGateway.initiate_payment', side_effect=PaymentGatewayError('rejected')):
+            order = self.place_order()
+            job = Job.objects.get()
+            self.assertEqual((job.status, job.attempts), (Job.STATUS_QUEUED, 1))
+            self.assertGreater(job.run_at, timezone.now())
+            self.assertEqual(self.payment_status(self.client, order).json()['payment_link_status'], 'queued')
+
+            self.run_jobs_now()
+
+        job.refresh_from_db()
+        order.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.STATUS_FAILED, 2))
+        self.assertEqual(order.payment_link_status, Order.PAYMENT_LINK_FAILED)
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_unavailable_gateway_keeps_the_order_queued(self):
+        unavailable = GatewayUnavailable('circuit open', retry_after=10)
+        with mock.patch('utils.gateways.FakeGateway.initiate_payment', side_effect=unavailable):
+            order = self.place_order()
+        job = Job.objects.get()
+        # Waiting for the gateway does not use up an attempt
+        self.assertEqual((job.status, job.attempts), (Job.STATUS_QUEUED, 0))
+        self.assertEqual(Order.objects.get(pk=order.pk).payment_link_status, Order.PAYMENT_LINK_QUEUED)
+
+        self.run_jobs_now()
+        order.refresh_from_db()
+        self.assertEqual(order.payment_link_status, Order.PAYMENT_LINK_READY)
+        self.assertEqual(Job.objects.get().status, Job.STATUS_DONE)
+
+    def test_payment_status_is_for_the_owner_only(self):
+        guest_order = self.place_order()
+        user = User.objects.create_user('buyer', email='buyer@example.com')
+        user_client = APIClient()
+        user_client.force_authenticate(user)
+        user_order = self.place_order(user_client)
+        staff_client = APIClient()
+        staff_client.force_authenticate(User.objects.create_user('admin', is_staff=True))
+
+        self.assertEqual(self.payment_status(self.client, guest_order).status_code, 200)
+        self.assertEqual(self.payment_status(user_client, user_order).status_code, 200)
+        self.assertEqual(self.payment_status(staff_client, guest_order).status_code, 200)
+        # Knowing the order number is not enough
+        self.assertEqual(self.payment_status(APIClient(), guest_order).status_code, 404)
+        self.assertEqual(self.payment_status(user_client, guest_order).status_code, 404)
+        self.assertEqual(self.payment_status(self.client, user_order).status_code, 404)
+
+
+class TransactionPayloadTests(TestCase):
+
+    def setUp(self):
+        category = ProductCategory.objects.create(name='Candles')
+        product = Product.objects.create(name='Vanilla', price=10, stock=5, category=category)
+        order = create_paid_order(product, 1)
+        self.transaction = Transaction.objects.create(order=order, transaction_id='tx-1', status=COMPLETED)
+        self.transaction.add_payload(TransactionPayload.EVENT_INIT, {'redirect_url': 'https://pay.invalid/1'})
+        self.transaction.add_payload(TransactionPayload.EVENT_STATUS, {'payment_status_description': 'Failed'})
+        self.transaction.add_payload(TransactionPayload.EVENT_STATUS, {'payment_status_description': 'Completed'})
+
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('admin', is_staff=True))
+
+    def test_payloads_are_compressed_and_append_only(self):
+        payload = TransactionPayload.objects.first()
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT data FROM {TransactionPayload._meta.db_table} WHERE id = %s", [payload.pk])
+            stored = bytes(cursor.fetchone()[0])
+
+        self.assertNotIn(b'redirect_url', stored)
+        self.assertEqual(payload.data, {'redirect_url': 'https://pay.invalid/1'})
+        with self.assertRaises(ValueError):
+            payload.save()
+
+    def test_list_rows_are_slim(self):
+        response = self.client.get('/api/commerce/transactions/')
+
+        row = response.json()['results'][0]
+        self.assertNotIn('transaction_init_info', row)
+        self.assertNotIn('all_transaction_info_after_callback', row)
+
+    def test_payloads_on_request(self):
+        listed = self.client.get('/api/commerce/transactions/?include=payloads').json()['results'][0]
+        detail = self.client.get(f'/api/commerce/transactions/{self.transaction.pk}/').json()
+
+        for row in (listed, detail):
+            self.assertEqual(row['all_transaction_info_after_callback'], {'payment_status_description': 'Completed'})
+            self.assertEqual(row['transaction_init_info'], {'redirect_url': 'https://pay.invalid/1'})
+            self.assertIsNone(row['ipn_data'])
+
+
+@override_settings(ORDER_NUMBER_BLOCK_SIZE=100)
+class CreateOrderQueryCountTests(TestCase):
+    """Placing an order costs the same number of queries whatever its number of lines"""
+
+    def setUp(self):
+        category = ProductCategory.objects.create(name='Candles')
+        self.products = [
+            Product.objects.create(name=f'Candle {i}', price=10, stock=50, category=category) for i in range(30)
+        ]
+        # Reserve the order number block up front so neither order pays for it
+        next_order_number()
+
+    def place_order(self, products):
+        lines = [{'product_id': product.pk, 'quantity': 2} for product in products]
+        serializer = OrderSerializer(data={**ORDER_DETAILS, 'cart_items': lines})
+        serializer.is_valid(raise_exception=True)
+        return create_order(serializer, serializer.validated_data.pop('cart_items'))
+
+    def test_constant_queries(self):
+        with self.assertNumQueries(9):
+            single = self.place_order(self.products[:1])
+        with self.assertNumQueries(9):
+            large = self.place_order(self.products)
+
+        self.assertEqual((single.items.count(), large.items.count()), (1, 30))
+        self.assertEqual(StockHold.objects.filter(order=large).count(), 30)
+
+
+class ListQueryCountTests(TestCase):
+    """Order and transaction pages must cost the same number of queries whatever their size"""
+
+    def setUp(self):
+        category = ProductCategory.objects.create(name='Candles')
+        products = [Product.objects.create(name=f'Candle {i}', price=10, stock=500, category=category) for i in range(3)]
+        discount = Discount.objects.create(
+            code='SAVE10', discount_type='percentage', value=10,
+            start_date=timezone.now() - timedelta(days=1), end_date=timezone.now() + timedelta(days=1)
+        )
+        for i in range(100):
+            order = create_paid_order(products[0], 1)
+            if i % 2:
+                order.discount_code = discount
+                order.save()
+            for product in products[1:]:
+                OrderItem.objects.create(order=order, product=product, quantity=2, price=10, product_name=product.name)
+            Transaction.objects.create(order=order, transaction_id=f'tx-{i}', status=COMPLETED)
+
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('admin', is_staff=True, is_superuser=True))
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.json()['results']
+
+    def assert_constant(self, url, params=''):
+        small, rows = self.count_queries(f'{url}?limit=10{params}')
+        self.assertEqual(len(rows), 10)
+        large, rows = self.count_queries(f'{url}?limit=100{params}')
+        self.assertEqual(len(rows), 100)
+        self.assertEqual(small, large)
+        return rows
+
+    def test_order_page(self):
+        rows = self.assert_constant('/api/commerce/orders/')
+
+        self.assertEqual(len(rows[0]['items']), 3)
+        self.assertEqual(rows[0]['transaction']['status'], COMPLETED)
+        self.assertEqual(
+            {row['discount_code']['code'] for row in rows if row['discount_code']}, {'SAVE10'}
+        )
+
+    def test_transaction_page(self):
+        rows = self.assert_constant('/api/commerce/transactions/')
+
+        self.assertEqual(len(rows[0]['order_items']), 3)
+
+    def test_transaction_page_with_payloads(self):
+        rows = self.assert_constant('/api/commerce/transactions/', '&include=payloads')
+
+        self.assertIn('ipn_data', rows[0])
+
+
+class CartQueryCountTests(TestCase):
+    """A cart renders in the same number of queries whatever its number of items"""
+
+    def setUp(self):
+        category = ProductCategory.objects.create(name='Candles')
+        self.products = [
+            Product.objects.create(name=f'Candle {i}', price=10, stock=50, category=category) for i in range(20)
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('admin', is_staff=True))
+
+    def make_cart(self, products):
+        cart = Cart.objects.create()
+        CartItem.objects.bulk_create([
+            CartItem(cart=cart, product=product, quantity=2, price=product.price) for product in products
+        ])
+        return cart
+
+    def test_cart_with_20_items(self):
+        small = self.make_cart(self.products[:1])
+        large = self.make_cart(self.products)
+
+        # The cart with its totals, its items with their products, their primary images, and the request savepoint
+        with self.assertNumQueries(5):
+            response = self.client.get(f'/api/commerce/carts/{small.pk}/')
+        self.assertEqual(response.json()['total_items'], 2)
+        with self.assertNumQueries(5):
+            response = self.client.get(f'/api/commerce/carts/{large.pk}/')
+        self.assertEqual(response.json()['total_items'], 40)
+        self.assertEqual(len(response.json()['items']), 20)
+
+
+@override_settings(PAYMENT_GATEWAY='fake')
+class StatsCounterTests(TestCase):
+
+    def setUp(self):
+        category = ProductCategory.objects.create(name='Candles')
+        self.product = Product.objects.create(name='Vanilla', price=10, stock=50, category=category)
+        rebuild_counters()
+
+    def test_counters_follow_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            orders = [create_paid_order(self.product, quantity, is_paid=False) for quantity in (1, 2, 3)]
+            for order in orders:
+                initiate_order_payment(order.pk)
+            orders[0].total = 25
+            orders[0].save()
+            transaction = Transaction.objects.get(order=orders[1])
+            transaction.status = FAILED
+            transaction.save()
+            orders[2].delete()
+            Product.objects.create(name='Cedar', price=12, stock=1, category=self.product.category)
+
+        self.assertEqual(read_counters(), compute_stats())
+        self.assertEqual(read_counters()['transactions.PENDING'], 1)
+
+    def test_reconciled_transactions_are_counted(self):
+        gateway = get_payment_gateway()
+        with self.captureOnCommitCallbacks(execute=True):
+            order = create_paid_order(self.product, 1, is_paid=False)
+            initiate_order_payment(order.pk)
+        gateway.settle(Transaction.objects.get(order=order).gateway_reference, COMPLETED)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            reconcile_pending_transactions(gateway, stale_after=timedelta(0), rate=0)
+
+        self.assertEqual(read_counters()['transactions.COMPLETED'], 1)
+        self.assertEqual(read_counters(), compute_stats())
+
+    def test_endpoint_is_staff_only_and_cached(self):
+        client = APIClient()
+        self.assertIn(client.get('/api/commerce/stats/').status_code, (401, 403))
+
+        client.force_authenticate(User.objects.create_user('admin', is_staff=True))
+        with CaptureQueriesContext(connection) as first_queries:
+            first = client.get('/api/commerce/stats/').json()
+        with CaptureQueriesContext(connection) as second_queries:
+            second = client.get('/api/commerce/stats/').json()
+
+        def selects(queries):
+            return [query['sql'] for query in queries if query['sql'].startswith('SELECT')]
+
+        self.assertEqual(len(selects(first_queries)), 1)
+        self.assertEqual(selects(second_queries), [])
+        self.assertEqual(first, second)
+        self.assertEqual(first['total_products'], 1)
+
+
+class SalesRollupTests(TestCase):
+
+    def setUp(self):
+        self.candles = ProductCategory.objects.create(name='Candles')
+        self.oils = ProductCategory.objects.create(name='Oils')
+        self.vanilla = Product.objects.create(name='Vanilla', price=10, stock=100, category=self.candles)
+        self.cedar = Product.objects.create(name='Cedar', price=15, stock=100, category=self.candles)
+        self.lavender = Product.objects.create(name='Lavender', price=20, stock=100, category=self.oils)
+
+        self.days = [timezone.now() - timedelta(days=offset) for offset in (9, 8, 1)]
+        self.orders = []
+        for created_on, lines in zip(self.days, [
+            [(self.vanilla, 2), (self.cedar, 1), (self.lavender, 1)],
+            [(self.vanilla, 1)],
+            [(self.lavender, 3)],
+        ]):
+            order = create_paid_order(lines[0][0], lines[0][1])
+            for product, quantity in lines[1:]:
+                OrderItem.objects.create(
+                    order=order, product=product, quantity=quantity, price=product.price, product_name=product.name
+                )
+            order.total = sum(product.price * quantity for product, quantity in lines)
+            order.save()
+            Order.objects.filter(pk=order.pk).update(created_on=created_on)
+            self.orders.append(order)
+
+    def snapshot(self):
+        return [
+            list(model.objects.values_list(*fields, 'orders', 'units', 'revenue').order_by(*fields))
+            for model, fields in [
+                (DailySales, ['day']), (DailyProductSales, ['day', 'product']), (DailyCategorySales, ['day', 'category'])
+            ]
+        ]
+
+    def test_orders_are_rolled_up_once(self):
+        self.assertEqual(rollup_orders([order.pk for order in self.orders]), 3)
+        self.assertEqual(rollup_orders([self.orders[0].pk]), 0)
+
+        first_day = DailySales.objects.get(day=self.days[0].date())
+        self.assertEqual((first_day.orders, first_day.units, first_day.revenue), (1, 4, 55))
+        candles = DailyCategorySales.objects.get(day=self.days[0].date(), category=self.candles)
+        self.assertEqual((candles.orders, candles.units, candles.revenue), (1, 3, 35))
+
+    def test_backfill_matches_incremental_rollups(self):
+        for order in self.orders:
+            rollup_orders([order.pk])
+        incremental = self.snapshot()
+
+        self.assertEqual(backfill_rollups(chunk_size=2, rebuild=True), 3)
+        self.assertEqual(self.snapshot(), incremental)
+
+    def test_analytics_endpoint(self):
+        backfill_rollups()
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('admin', is_staff=True))
+        start = self.days[0].date().isoformat()
+
+        daily = client.get(f'/api/commerce/analytics/sales/?start={start}').json()['results']
+        by_category = client.get(
+            f'/api/commerce/analytics/sales/?start={start}&interval=month&group=category'
+        ).json()['results']
+
+        self.assertEqual([row['orders'] for row in daily], [1, 1, 1])
+        self.assertEqual(sum(float(row['revenue']) for row in daily), 125)
+        oils = [row for row in by_category if row['category__name'] == 'Oils']
+        self.assertEqual(sum(row['units'] for row in oils), 4)
+        self.assertEqual(
+            client.get('/api/commerce/analytics/sales/?interval=year').status_code, 400
+        )
+
+
+@override_settings(TRENDING_HALF_LIFE_DAYS=7, LEADERBOARD_SIZE=2)
+class LeaderboardTests(TestCase):
+
+    def setUp(self):
+        category = ProductCategory.objects.create(name='Candles')
+        self.vanilla = Product.objects.create(name='Vanilla', price=10, stock=100, category=category)
+        self.cedar = Product.objects.create(name='Cedar', price=15, stock=100, category=category)
+        self.lavender = Product.objects.create(name='Lavender', price=20, stock=100, category=category)
+
+        # Vanilla sold most overall but two weeks ago, cedar sold less but today
+        old = create_paid_order(self.vanilla, 8)
+        Order.objects.filter(pk=old.pk).update(created_on=timezone.now() - timedelta(days=14))
+        create_paid_order(self.cedar, 3)
+        create_paid_order(self.lavender, 1)
+        create_paid_order(self.lavender, 50, is_paid=False)
+
+    def test_paid_orders_are_counted_once(self):
+        self.assertEqual(update_leaderboards(batch_size=2), 3)
+        self.assertEqual(update_leaderboards(), 0)
+
+        self.vanilla.refresh_from_db()
+        self.lavender.refresh_from_db()
+        self.assertEqual((self.vanilla.units_sold, self.lavender.units_sold), (8, 1))
+        # Two half lives old
+        self.assertAlmostEqual(current_trending_score(self.vanilla), 2, places=2)
+
+        self.assertEqual(update_leaderboards(rebuild=True), 3)
+        self.vanilla.refresh_from_db()
+        self.assertEqual(self.vanilla.units_sold, 8)
+
+    def test_rankings(self):
+        update_leaderboards()
+        best = Leaderboard.objects.get(name='best_sellers').product_ids
+        trending = Leaderboard.objects.get(name='trending').product_ids
+        self.assertEqual(best, [self.vanilla.pk, self.cedar.pk])
+        self.assertEqual(trending, [self.cedar.pk, self.vanilla.pk])
+
+        client = APIClient()
+        names = lambda url: [product['name'] for product in client.get(url).json()['results']]
+        self.assertEqual(names('/api/commerce/products/?ordering=popularity'), ['Vanilla', 'Cedar', 'Lavender'])
+        self.assertEqual(names('/api/commerce/products/?ordering=-popularity'), ['Lavender', 'Cedar', 'Vanilla'])
+        self.assertEqual(names('/api/commerce/products/?ordering=trending')[0], 'Cedar')
+
+        response = client.get('/api/commerce/products/best_sellers/?limit=1')
+        self.assertEqual([product['name'] for product in response.json()], ['Vanilla'])
+
+    def test_rebase_keeps_scores(self):
+        update_leaderboards()
+        before = [current_trending_score(product) for product in Product.objects.order_by('pk')]
+        rebase_trending(timezone.now() + timedelta(days=30))
+        after = [current_trending_score(product) for product in Product.objects.order_by('pk')]
+        for old, new in zip(before, after):
+            self.assertAlmostEqual(old, new, places=6)
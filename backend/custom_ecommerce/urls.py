@@ -15,6 +15,7 @@ router.register(r'product-images', views.ProductImagesViewSet)
 urlpatterns = [
     path('', include(router.urls)),
     path('stats/', views.EcommerceStatsView.as_view(), name='ecommerce-stats'),
+    path('analytics/sales/', views.SalesAnalyticsView.as_view(), name='sales-analytics'),
     path('register-callback-url/', views.RegisterCallbackURLs.as_view(), name='register-callback-url'),
     path('payment-callback/', views.payment_callback, name="payment-callback")
 ] 
\ No newline at end of file
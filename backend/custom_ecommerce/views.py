@@ -1,7 +1,7 @@
 from decimal import Decimal
 
-from django.db.models import F, Sum
-from django.shortcuts import get_object_or_404
+from django.db import transaction
+from django.db.models import F, Q
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import viewsets, status, filters
 from rest_framework.decorators import action, api_view
@@ -14,18 +14,33 @@ from customauth.permissions import HasCustomAPIKey
 from customauth.authentication import APIKeyAuthentication
 from main.authentication import AUTH_CLASS
 from main.utils import StandardResultsSetPagination
-from utils.checkout import Pesapal
-from .filters import ProductFilter
+from utils.gateways import PaymentGatewayError, get_payment_gateway
+from utils.idempotency import idempotent
+from .cart import (
+    InsufficientStock, CartOperationError, add_to_cart, set_cart_quantity, remove_from_cart, get_cart_line,
+    get_cart_totals, apply_cart_operations, get_open_user_cart
+)
+from .cartstore import CartBusyError, get_cart_store, get_guest_cart_key, remember_guest_cart_key
+from .filters import ProductFilter, ProductOrderingFilter
+from .leaderboards import BEST_SELLERS, TRENDING, leaderboard_products
 from .models import (
-    ProductCategory, Product, Cart, CartItem, Order, OrderItem, Discount, Transaction, CallBackUrls, ProductImage
+    ProductCategory, Product, Cart, CartItem, Order, Discount, Transaction, CallBackUrls, ProductImage,
+    primary_images_prefetch
 )
+from .notifications import record_notification
+from .orders import create_order
+from .payments import queue_payment_initiation
 from .permissions import IsAdminOrReadOnly, IsOwnerOrAdmin
+from .reservations import release_order_holds
+from .rollups import sales_series
 from .serializers import (
     ProductCategorySerializer, ProductSerializer,
-    CartSerializer, CartItemSerializer, OrderSerializer,
-    DiscountSerializer, CallBackUrlsSerializer, TransactionSerializerBasic, ProductImageSerializer
+    CartSerializer, CartItemSerializer, CartLineChangeSerializer, CartBatchSerializer, StoredCartSerializer,
+    OrderSerializer,
+    DiscountSerializer, CallBackUrlsSerializer, TransactionSerializerBasic, ProductImageSerializer,
+    SalesAnalyticsQuerySerializer
 )
-from .utils import is_not_non_or_zero
+from .stats import get_ecommerce_stats
 
 
 class ProductCategoryViewSet(BulkModelViewSet):
@@ -67,10 +82,11 @@ class ProductViewSet(BulkModelViewSet):
 
     pagination_class = StandardResultsSetPagination
 
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
+    filter_backends = [DjangoFilterBackend, filters.SearchFilter, ProductOrderingFilter]
     filterset_class = ProductFilter
     search_fields = ['name', 'description', 'fragrance_notes', 'materials']
-    ordering_fields = ['price', 'created_on', 'name']
+    # ?ordering=popularity and ?ordering=trending are aliases of the leaderboard columns
+    ordering_fields = ['price', 'created_on', 'name', 'units_sold', 'trending_score']
     ordering = ['-created_on']
 
     def get_queryset(self):
@@ -95,6 +111,24 @@ class ProductViewSet(BulkModelViewSet):
         serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
 
+    def get_leaderboard_response(self, name):
+        try:
+            limit = int(self.request.query_params.get('limit', 0)) or None
+        except ValueError:
+            return Response({'detail': 'limit must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+        products = leaderboard_products(name, self.get_queryset(), limit=limit)
+        serializer = self.get_serializer(products, many=True)
+        return Response(serializer.data)
+
+    @action(detail=False, methods=['get'])
+    def best_sellers(self, request):
+        # Precomputed by `manage.py update_leaderboards`, ?limit=10 for the first ten
+        return self.get_leaderboard_response(BEST_SELLERS)
+
+    @action(detail=False, methods=['get'])
+    def trending(self, request):
+        return self.get_leaderboard_response(TRENDING)
+
 
 class CartViewSet(viewsets.ModelViewSet):
     serializer_class = CartSerializer
@@ -106,14 +140,38 @@ class CartViewSet(viewsets.ModelViewSet):
     pagination_class = StandardResultsSetPagination
 
     def get_queryset(self):
-        if self.request.user.is_staff:
-            return Cart.objects.all()
-        return Cart.objects.filter(session_id=self.request.session.session_key)
+        queryset = Cart.objects.all()
+        if self.action in ('list', 'retrieve'):
+            queryset = queryset.with_totals().with_items()
+        user = self.request.user
+        if user.is_staff:
+            return queryset
+        if user.is_authenticated:
+            return queryset.filter(user=user)
+        # Guests own the carts stored under their guest cart key, see cartstore.get_guest_cart_key
+        key = get_guest_cart_key(self.request, create=False)
+        if key is None:
+            return queryset.none()
+        return queryset.filter(session_id=key, user__isnull=True)
 
     def perform_create(self, serializer):
-        if not self.request.session.session_key:
-            self.request.session.create()
-        serializer.save(session_id=self.request.session.session_key)
+        user = self.request.user
+        if user.is_authenticated:
+            serializer.save(user=user, is_guest=False, session_id=None)
+        else:
+            serializer.save(session_id=get_guest_cart_key(self.request), is_guest=True)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        return remember_guest_cart_key(request, response)
+
+    def get_line_response(self, cart, product_id):
+        data = {
+            'cart': cart.pk,
+            'item': get_cart_line(cart.pk, product_id),
+            **get_cart_totals(cart.pk)
+        }
+        return Response(CartLineChangeSerializer(data).data)
 
     @action(detail=True, methods=['post'])
     def add_item(self, request, pk=None):
@@ -123,19 +181,13 @@ class CartViewSet(viewsets.ModelViewSet):
         if serializer.is_valid():
             product = serializer.validated_data['product']
             quantity = serializer.validated_data.get('quantity', 1)
-            
-            # Check if item already exists in cart
-            cart_item, created = CartItem.objects.get_or_create(
-                cart=cart,
-                product=product,
-                defaults={'quantity': quantity, 'price': product.sale_price or product.price}
-            )
-            
-            if not created:
-                cart_item.quantity += quantity
-                cart_item.save()
-            
-            return Response(CartSerializer(cart).data)
+
+            try:
+                add_to_cart(cart.pk, product, quantity)
+            except InsufficientStock as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+            return self.get_line_response(cart, product.pk)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     @action(detail=True, methods=['post'])
@@ -143,35 +195,121 @@ class CartViewSet(viewsets.ModelViewSet):
         cart = self.get_object()
         product_id = request.data.get('product_id')
         
-        try:
-            cart_item = CartItem.objects.get(cart=cart, product_id=product_id)
-            cart_item.delete()
-            return Response(CartSerializer(cart).data)
-        except CartItem.DoesNotExist:
+        if not remove_from_cart(cart.pk, product_id):
             return Response(
                 {'error': 'Item not found in cart'},
                 status=status.HTTP_404_NOT_FOUND
             )
+        return self.get_line_response(cart, product_id)
 
     @action(detail=True, methods=['post'])
     def update_quantity(self, request, pk=None):
         cart = self.get_object()
         product_id = request.data.get('product_id')
-        quantity = request.data.get('quantity')
+
+        try:
+            quantity = int(request.data.get('quantity'))
+        except (TypeError, ValueError):
+            return Response(
+                {'error': 'A whole number quantity is required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         
         try:
-            cart_item = CartItem.objects.get(cart=cart, product_id=product_id)
-            if quantity <= 0:
-                cart_item.delete()
-            else:
-                cart_item.quantity = quantity
-                cart_item.save()
-            return Response(CartSerializer(cart).data)
+            set_cart_quantity(cart.pk, product_id, quantity)
         except CartItem.DoesNotExist:
             return Response(
                 {'error': 'Item not found in cart'},
                 status=status.HTTP_404_NOT_FOUND
             )
+        except InsufficientStock as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return self.get_line_response(cart, product_id)
+
+    @action(detail=True, methods=['post'])
+    def batch(self, request, pk=None):
+        """
+        Apply several add/set/remove operations in one transaction and return the cart once, e.g.
+        {"operations": [{"op": "add", "product_id": 1, "quantity": 2}, {"op": "remove", "product_id": 3}]}
+        """
+        cart = self.get_object()
+        serializer = CartBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        try:
+            apply_cart_operations(cart.pk, serializer.validated_data['operations'])
+        except CartOperationError as e:
+            return Response({'errors': e.errors}, status=status.HTTP_400_BAD_REQUEST)
+
+        cart = Cart.objects.with_totals().with_items().get(pk=cart.pk)
+        return Response(CartSerializer(cart).data)
+
+    def get_stored_cart_data(self, stored_cart):
+        products = Product.objects.prefetch_related(primary_images_prefetch()).in_bulk(stored_cart.items.keys())
+        prices = stored_cart.prices
+        items = [
+            CartItem(product=products[product_id], quantity=quantity, price=prices[product_id])
+            for product_id, quantity in stored_cart.quantities.items()
+            if product_id in products
+        ]
+        return StoredCartSerializer({
+            'id': stored_cart.cart_id,
+            'is_guest': True,
+            'items': items,
+            'total_items': sum(item.quantity for item in items),
+            'subtotal': sum((item.total_price for item in items), Decimal('0.00')),
+        }).data
+
+    @action(detail=False, methods=['get', 'post'])
+    def mine(self, request):
+        """
+        The caller's own cart. Guest carts live in the guest cart store and only reach the database at
+        checkout or on the write-behind interval, signed in users work on their open Cart row.
+        POST applies {"operations": [...]} like the batch action.
+        """
+        if request.method == 'POST':
+            serializer = CartBatchSerializer(data=request.data)
+            serializer.is_valid(raise_exception=True)
+            operations = serializer.validated_data['operations']
+
+        try:
+            if request.user.is_authenticated:
+                cart = get_open_user_cart(request.user)
+                if request.method == 'POST':
+                    apply_cart_operations(cart.pk, operations)
+                cart = Cart.objects.with_totals().with_items().get(pk=cart.pk)
+                return Response(CartSerializer(cart).data)
+
+            store = get_cart_store()
+            key = get_guest_cart_key(request)
+            if request.method == 'POST':
+                stored_cart = store.apply(key, operations)
+            else:
+                stored_cart = store.load(key)
+        except CartBusyError as e:
+            return Response({'errors': e.errors}, status=status.HTTP_409_CONFLICT)
+        except CartOperationError as e:
+            return Response({'errors': e.errors}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(self.get_stored_cart_data(stored_cart))
+
+    @action(detail=False, methods=['post'], url_path='mine/checkout')
+    def checkout(self, request):
+        """Write the caller's guest cart to Cart/CartItem and return it with its database id"""
+        if request.user.is_authenticated:
+            cart = get_open_user_cart(request.user)
+        else:
+            store = get_cart_store()
+            key = get_guest_cart_key(request)
+            try:
+                with store.lock(key):
+                    stored_cart = store.load(key)
+                    if not stored_cart.items:
+                        return Response({'error': 'Cart is empty'}, status=status.HTTP_400_BAD_REQUEST)
+                    cart = store.persist(stored_cart)
+            except CartBusyError as e:
+                return Response({'errors': e.errors}, status=status.HTTP_409_CONFLICT)
+        cart = Cart.objects.with_totals().with_items().get(pk=cart.pk)
+        return Response(CartSerializer(cart).data)
 
 
 class DiscountViewSet(viewsets.ModelViewSet):
@@ -226,6 +364,14 @@ class DiscountViewSet(viewsets.ModelViewSet):
             }, status=status.HTTP_404_NOT_FOUND)
 
 
+def payloads_requested(view):
+    """Raw gateway payloads are only serialized on detail requests and with ?include=payloads"""
+    if view.request is None:
+        return False
+    include = [name.strip() for name in view.request.query_params.get('include', '').split(',')]
+    return view.action == 'retrieve' or 'payloads' in include
+
+
 class OrderViewSet(viewsets.ModelViewSet):
     serializer_class = OrderSerializer
     authentication_classes = [AUTH_CLASS, APIKeyAuthentication]
@@ -240,145 +386,75 @@ class OrderViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         if self.request.user.is_staff:
-            return Order.objects.all()
+            # Everything OrderSerializer renders, in three queries whatever the page size
+            queryset = Order.objects.select_related('discount_code', 'transaction').prefetch_related('items')
+            if payloads_requested(self):
+                queryset = queryset.prefetch_related('transaction__payloads')
+            return queryset
         # return Order.objects.filter(email=self.request.user.email)
         return Order.objects.none()
 
-    def perform_create(self, serializer):
-        items_data = serializer.validated_data.pop("cart_items")
-
-        # Create empty cart first
-        cart_instance = Cart.objects.create()
-
-        subtotal = Decimal("0.00")
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['include_payloads'] = payloads_requested(self)
+        return context
 
-        for item in items_data:
-            product_id = item.get("product_id")
-            quantity = item.get("quantity")
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        return remember_guest_cart_key(request, response)
 
-            product = get_object_or_404(Product, id=product_id)
-            price = product.sale_price if is_not_non_or_zero(product.sale_price) else product.price
-            line_total = price * quantity
-            subtotal += line_total
+    @idempotent('orders.create')
+    def create(self, request, *args, **kwargs):
+        return super().create(request, *args, **kwargs)
 
-            CartItem.objects.create(
-                cart=cart_instance,
-                product=product,
-                quantity=quantity,
-                price=price
-            )
-
-        shipping_cost = Decimal("0.00") # Decimal(self.request.data.get("shipping_cost", "0.00"))
-        tax = Decimal("0.00") # Decimal(self.request.data.get("tax", "0.00"))
-        discount = Decimal("0.00")
-
-        discount_code = self.request.data.get("discount_code")
-        discount_amount = Decimal("0.00")
-        discount_obj = None
-        
-        discount_message = ""
-        if discount_code:
-            discount_obj = Discount.objects.filter(code=discount_code).first()
-            
-            if discount_obj:
-                # Check if the discount code is valid
-                is_valid, message = discount_obj.is_valid(
-                    user=self.request.user if self.request.user.is_authenticated else None,
-                    cart_total=subtotal
-                )
-                
-                if is_valid:
-                    # Calculate the discount amount
-                    discount_amount = discount_obj.calculate_discount(subtotal)
-                    
-                    if discount_amount > Decimal("0.00"):
-                        # Update usage statistics, we will update the discount usage in the IPN
-                        # discount_obj.times_used += 1
-                        # if self.request.user.is_authenticated:
-                        #     discount_obj.used_by.add(self.request.user)
-                        # discount_obj.save()
-                        
-                        # Store the discount code in the serializer data
-                        serializer.validated_data["discount_code"] = discount_obj
-                        discount_message = f"Discount code '{discount_code}' applied successfully. You saved {discount_amount}."
-                    else:
-                        # Discount code is valid but no discount was applied (e.g., minimum purchase not met)
-                        if discount_obj.min_purchase and subtotal < discount_obj.min_purchase:
-                            discount_message = f"Minimum purchase of {discount_obj.min_purchase} required for discount code '{discount_code}'."
-                        else:
-                            discount_message = f"Discount code '{discount_code}' could not be applied."
-                else:
-                    # Discount code is not valid, use the message from is_valid method
-                    discount_message = f"Discount code '{discount_code}' is not valid: {message}"
-            else:
-                discount_message = f"Discount code '{discount_code}' not found."
+    def perform_create(self, serializer):
+        items_data = serializer.validated_data.pop("cart_items")
+        user = self.request.user if self.request.user.is_authenticated else None
+
+        # The caller's open cart is closed by the order, guests get a key to look their order up with
+        key = None if user else get_guest_cart_key(self.request)
+        if user is not None:
+            source_cart = Cart.objects.filter(user=user, is_ordered=False).order_by('-id').first()
+        elif key:
+            source_cart = Cart.objects.filter(session_id=key, user__isnull=True, is_ordered=False).order_by('-id').first()
         else:
-            discount_message = "No discount code provided."
-            
-        # Store the discount message in the serializer data
-        serializer.validated_data["discount_message"] = discount_message
-        
-        discount = discount_amount
-
-        total = subtotal + shipping_cost + tax - discount
- 
-        cart_instance.total = total
-        cart_instance.is_ordered = True
-        cart_instance.save()
-
-        # Set computed fields before saving
-        serializer.validated_data["subtotal"] = subtotal
-        serializer.validated_data["shipping_cost"] = shipping_cost
-        serializer.validated_data["tax"] = tax
-        serializer.validated_data["discount"] = discount
-        serializer.validated_data["total"] = total
-        serializer.validated_data["cart"] = cart_instance
-        # Make sure discount_message is saved (already set earlier)
-
-        order = serializer.save()
-
-        for cart_item in cart_instance.items.all():
-            OrderItem.objects.create(
-                order=order,
-                product=cart_item.product,
-                quantity=cart_item.quantity,
-                price=cart_item.price,
-                product_name=cart_item.product.name
-            )
-            
-        # Initiate payment transaction with Pesapal
-        try:
-            pesapal = Pesapal()
-            response = pesapal.submit_order_request(
-                order.order_number,
-                order.total,
-                order.email,
-                order.phone_number,
-                f"Order #{order.order_number}",
-                True
-            )
-
-            if response.get("status") == "200":
-                # Create transaction record
-                Transaction.objects.create(
-                    order=order,
-                    transaction_id=response.get("order_tracking_id"),
-                    amount=order.total,
-                    currency="KES",  # Adjust as needed
-                    status="PENDING",
-                    pesapal_order_tracking_id=response.get("order_tracking_id"),
-                    pesapal_redirect_url=response.get("redirect_url"),
-                    pesapal_merchant_reference=response.get("merchant_reference"),
-                    transaction_init_info=response
-                )
-                
-                # Add redirect URL to order response
-                order.payment_url = response.get("redirect_url")
-                order.save(update_fields=["payment_url"])
-        except Exception as e:
-            # Log the error but don't fail the order creation
-            print(f"Payment initiation error: {str(e)}")
-            # You might want to add proper logging here
+            source_cart = None
+
+        order = create_order(
+            serializer,
+            items_data,
+            discount_code=self.request.data.get("discount_code"),
+            user=user,
+            source_cart=source_cart,
+            guest_key=key,
+        )
+        if key:
+            # The guest cart is done with, drop it from the guest cart store too
+            transaction.on_commit(lambda: get_cart_store().delete(key))
+
+        # The payment link is fetched by a background job, clients poll payment_status for it
+        queue_payment_initiation(order)
+
+    @action(detail=False, methods=['get'], url_path='payment-status', permission_classes=[])
+    def payment_status(self, request):
+        """
+        Poll for the payment redirect URL of a new order, ?order_number=...
+        Order numbers are sequential, so only staff and the order's owner find it: the user whose cart it
+        was placed from, or the guest holding the guest cart cookie it was placed with.
+        ``payment_link_status`` is queued until the gateway answered, then ready (or failed).
+        """
+        orders = Order.objects.filter(order_number=request.query_params.get('order_number'))
+        if not request.user.is_staff:
+            key = get_guest_cart_key(request, create=False)
+            owner = Q(cart__session_id=key, cart__user__isnull=True) if key else Q(pk__in=[])
+            if request.user.is_authenticated:
+                owner |= Q(cart__user=request.user)
+            orders = orders.filter(owner)
+        order = orders.values('order_number', 'payment_url', 'payment_link_status', 'is_paid').first()
+
+        if order is None:
+            return Response({'error': 'Order not found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(order)
 
     @action(detail=True, methods=['post'])
     def update_status(self, request, pk=None):
@@ -399,56 +475,78 @@ class OrderViewSet(viewsets.ModelViewSet):
         
         order.status = new_status
         order.save()
+
+        if new_status == 'cancelled':
+            release_order_holds(order)
         
         return Response(OrderSerializer(order).data)
 
     @action(detail=True, methods=['post'])
+    @idempotent('orders.initiate_payment')
     def initiate_payment(self, request, pk=None):
-        pesapal = Pesapal()
-
-        response = pesapal.submit_order_request(5, 1, "dante@gmail.com", "+254706522473", "Order on Fragrance", True)
+        """Queue the order's payment again, e.g. after it failed, poll payment-status for the URL"""
+        order = self.get_object()
+        if order.payment_link_status != Order.PAYMENT_LINK_READY:
+            order.payment_link_status = Order.PAYMENT_LINK_QUEUED
+            order.save(update_fields=['payment_link_status', 'updated_on'])
+            queue_payment_initiation(order)
 
-        error = response.get("error", None)
-        if error and error.get("code", None) == "missing_unique_id":
-            response = pesapal.submit_order_request(6, 1, "dante@gmail.com", "+254706522473", "Order on Fragrance", True)
         return Response({
-            "data": response
-        })
+            "order_number": order.order_number,
+            "payment_url": order.payment_url,
+            "payment_link_status": order.payment_link_status,
+        }, status=status.HTTP_202_ACCEPTED)
 
     @action(detail=True, methods=['post'])
     def check_payment_status(self, request, pk=None):
-        pesapal = Pesapal()
+        order = self.get_object()
+        transaction = Transaction.objects.filter(order=order).first()
+        if transaction is None:
+            return Response({'error': 'The order has no payment yet'}, status=status.HTTP_404_NOT_FOUND)
 
-        response = pesapal.check_payment_status("ee164173-2e0d-468f-a4e2-e05f575c6af6")
+        try:
+            payment = get_payment_gateway().get_status(transaction.gateway_reference or transaction.transaction_id)
+        except PaymentGatewayError as e:
+            return Response({'error': str(e)}, status=status.HTTP_502_BAD_GATEWAY)
 
         return Response({
-            "data": response
+            "status": payment.status,
+            "data": payment.raw
         })
 
 
 class EcommerceStatsView(APIView):
+    """
+    Dashboard numbers, read from the StatsCounter rows that signals keep up to date. ?live=true computes
+    them from the tables instead (one aggregate query per table). Both are cached for
+    ECOMMERCE_STATS_CACHE_SECONDS.
+    """
+    authentication_classes = [AUTH_CLASS]
+    permission_classes = [IsAdminUser]
+
     def get(self, request):
-        # Get total sales
-        total_sales = Order.objects.aggregate(total_sales=Sum('total'))['total_sales'] or 0
-        total_orders = Order.objects.count()
-        total_products = Product.objects.count()
-        total_categories = ProductCategory.objects.count()
-        total_discounts = Discount.objects.count()
-        pending_transactions = Transaction.objects.filter(status="PENDING").count()
-        completed_transactions = Transaction.objects.filter(status="COMPLETED").count()
-        failed_transactions = Transaction.objects.filter(status="FAILED").count()
+        live = request.query_params.get('live', '').lower() in ('1', 'true', 'yes')
+        return Response(get_ecommerce_stats(live=live))
+
 
+class SalesAnalyticsView(APIView):
+    """
+    Revenue, orders, units and average order value per day, week or month, overall or per category or
+    product: ?start=2025-01-01&end=2025-03-31&interval=week&group=category. Served from the daily rollups.
+    """
+    authentication_classes = [AUTH_CLASS]
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        query = SalesAnalyticsQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        params = query.validated_data
         return Response({
-            'total_sales': total_sales,
-            'total_orders': total_orders,
-            'total_products': total_products,
-            'total_categories': total_categories,
-            'total_discounts': total_discounts,
-            'transactions': {
-                'pending_transactions': pending_transactions,
-                'completed_transactions': completed_transactions,
-                'failed_transactions': failed_transactions
-            }
+            'start': params['start'],
+            'end': params['end'],
+            'interval': params['interval'],
+            'group': params.get('group'),
+            'results': sales_series(params['start'], params['end'], params['interval'], params.get('group')),
         })
 
 
@@ -491,13 +589,12 @@ class RegisterCallbackURLs(APIView):
                     status=status.HTTP_400_BAD_REQUEST
                 )
             
-            # Initialize Pesapal and register the IPN URL
-            pesapal = Pesapal()
-            ipn_id = pesapal.register_ipn_url(url)
+            # Register the IPN URL with the payment gateway
+            ipn_id = get_payment_gateway().register_notification_url(url)
             
             if not ipn_id:
                 return Response(
-                    {'error': 'Failed to register callback URL with Pesapal'}, 
+                    {'error': 'Failed to register callback URL with the payment gateway'}, 
                     status=status.HTTP_500_INTERNAL_SERVER_ERROR
                 )
             
@@ -523,38 +620,53 @@ class RegisterCallbackURLs(APIView):
 
 
 def initiate_checkout(request, order_id):
-    pesapal = Pesapal()
     order = Order.objects.get(id=order_id)
-    redirect_url = pesapal.submit_order_request(
-        order_id=order.id,
-        amount=order.total_amount,
-        email=order.customer_email,
-        phone=order.customer_phone,
-        description=f"Payment for Order #{order.id}"
-    )
+    payment = get_payment_gateway().initiate_payment(order)
     return Response({
-        "payment_url": redirect_url
-    })  # Redirects to Pesapal payment page
+        "payment_url": payment.redirect_url
+    })  # Redirects to the gateway's payment page
 
 
 @api_view(['POST'])
 def payment_callback(request):
-    pesapal = Pesapal()
-    if pesapal.handle_pesapal_callback(request.data):
-        return Response({"message": "Payment processed successfully!"}, status=status.HTTP_200_OK)
-    else:
-        return Response({"message": "Payment failed or already processed."}, status=status.HTTP_400_BAD_REQUEST)
+    """
+    Payment gateway IPN endpoint. The notification is stored and acknowledged right away,
+    a background job looks the payment up and updates the order (see custom_ecommerce/notifications.py).
+    """
+    if not request.data.get("OrderTrackingId"):
+        return Response({"message": "OrderTrackingId is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+    record_notification(request.data)
+    return Response({
+        "orderNotificationType": request.data.get("OrderNotificationType"),
+        "orderTrackingId": request.data.get("OrderTrackingId"),
+        "orderMerchantReference": request.data.get("OrderMerchantReference"),
+        "status": 200,
+        "message": "Notification received."
+    }, status=status.HTTP_200_OK)
 
 
 class TransactionViewSet(viewsets.ModelViewSet):
     serializer_class = TransactionSerializerBasic
     permission_classes = [IsAdminUser]
     pagination_class = StandardResultsSetPagination
-    queryset = Transaction.objects.all()
+    # The order and its items are rendered with every transaction
+    queryset = Transaction.objects.select_related('order').prefetch_related('order__items')
     filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
     filterset_fields = ['order_id']
     ordering_fields = ['created_on']
     ordering = ['id']
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if payloads_requested(self):
+            queryset = queryset.prefetch_related('payloads')
+        return queryset
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['include_payloads'] = payloads_requested(self)
+        return context
     
     def update(self, request, *args, **kwargs):
         """Disable update operations on transactions"""
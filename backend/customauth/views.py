@@ -1,4 +1,5 @@
 from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_in
 from django.utils.http import urlsafe_base64_decode
 from rest_framework import generics, status, viewsets, permissions
 from rest_framework.authentication import TokenAuthentication
@@ -28,6 +29,9 @@ class CustomLogin(ObtainAuthToken):
         serializer.is_valid(raise_exception=True)
         user = serializer.validated_data['user']
         token, created = Token.objects.get_or_create(user=user)
+        # Token logins bypass django.contrib.auth.login, send the signal so receivers such as the
+        # guest cart merge still run
+        user_logged_in.send(sender=user.__class__, request=request, user=user)
         return Response({
             'token': token.key,
             'user': AccountSerializer(user).data
@@ -8,7 +8,8 @@ class MediaSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Media
-        fields = ['id', 'file', 'title', 'type', 'media_url']
+        fields = ['id', 'file', 'title', 'type', 'media_url', 'size', 'width', 'height']
+        read_only_fields = ['size', 'width', 'height']
 
         extra_kwargs = {
             'image_url': {
@@ -17,7 +18,12 @@ class MediaSerializer(serializers.ModelSerializer):
         }
 
     def get_media_url(self, obj):
-        return f""
+        if obj.url:
+            return obj.url
+        if obj.public_id:
+            from utils.storage import get_media_storage
+            return get_media_storage().url(obj.public_id)
+        return ""
 
 
 class CountrySerializer(BaseSerializer, serializers.ModelSerializer):
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.1 on 2026-10-19 13:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0002_review_user_name_alter_review_user'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='media',
+            name='public_id',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='media',
+            name='url',
+            field=models.URLField(blank=True, max_length=500, null=True),
+        ),
+    ]
@@ -101,9 +101,47 @@ class Media(TimeStampedModel):
     file = models.FileField(blank=False, null=True)
     type = models.CharField(max_length=20, blank=False, null=True)
 
+    # Media storage provider fields
+    url = models.URLField(max_length=500, blank=True, null=True)
+    public_id = models.CharField(max_length=255, blank=True, null=True)
+
+    # Metadata captured at upload time
+    size = models.PositiveBigIntegerField(blank=True, null=True)
+    width = models.PositiveIntegerField(blank=True, null=True)
+    height = models.PositiveIntegerField(blank=True, null=True)
+
     def __str__(self):
         return f'media_{self.id}'
 
+    def upload_to_storage(self):
+        """
+        Send the attached file to the media storage provider and point the file field at the stored object.
+        """
+        from utils.storage import get_media_storage, resource_type_for_media
+        result = get_media_storage().upload(
+            file=self.file,
+            folder='media',
+            resource_type=resource_type_for_media(self.type)
+        )
+        self.url = result.get('url')
+        self.public_id = result.get('public_id')
+        self.file = self.public_id
+
+    def save(self, *args, **kwargs):
+        if self.file and not self.public_id and not self.url:
+            self.upload_to_storage()
+        return super(Media, self).save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        if self.public_id:
+            from utils.storage import get_media_storage, resource_type_for_media
+            try:
+                get_media_storage().delete(self.public_id, resource_type=resource_type_for_media(self.type))
+            except Exception as e:
+                # Log the error but continue with deletion
+                print(f"Error deleting stored media: {e}")
+        return super(Media, self).delete(*args, **kwargs)
+
 
 class Country(TimeStampedModel):
     name = models.CharField(max_length=30, blank=False, null=True)
@@ -0,0 +1,42 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_init, post_save
+
+from account.models import Profile
+from .models import Contact
+from .stats import TOTALS, invalidate_app_stats
+
+# AppStatsView's cached payload (main/stats.py) is dropped when a counted row is created or deleted, or when a
+# row moves to another breakdown. Other saves, e.g. last_login updates, keep it. The breakdown value a row was
+# loaded with is remembered in post_init, read from __dict__ so deferred fields are not fetched.
+
+BREAKDOWNS = {
+    Profile: 'gender',
+    Contact: 'read',
+}
+
+
+def remember_breakdown(sender, instance, **kwargs):
+    instance._app_stats_value = instance.__dict__.get(BREAKDOWNS[sender]) if instance.pk else None
+
+
+def invalidate_on_change(sender, instance, created, **kwargs):
+    field = BREAKDOWNS.get(sender)
+    if field is None:
+        changed = False
+    else:
+        changed = instance._app_stats_value != instance.__dict__.get(field, instance._app_stats_value)
+        instance._app_stats_value = instance.__dict__.get(field)
+    if created or changed:
+        invalidate_app_stats()
+
+
+def invalidate_on_delete(sender, instance, **kwargs):
+    invalidate_app_stats()
+
+
+for model in (User, *BREAKDOWNS, *TOTALS.values()):
+    post_save.connect(invalidate_on_change, sender=model, dispatch_uid=f'app_stats_save_{model._meta.label}')
+    post_delete.connect(invalidate_on_delete, sender=model, dispatch_uid=f'app_stats_delete_{model._meta.label}')
+
+for model in BREAKDOWNS:
+    post_init.connect(remember_breakdown, sender=model, dispatch_uid=f'app_stats_init_{model._meta.label}')
@@ -0,0 +1,85 @@
+"""
+Numbers for AppStatsView.
+
+Every table is read with at most one query, the breakdowns (users by gender, contact entries by read flag)
+are conditional aggregates. The payload is cached for APP_STATS_CACHE_SECONDS and dropped when a counted
+row is added, removed or changes its breakdown (main/signals.py).
+
+The approximate variant reads table totals from the database statistics instead of counting tables with
+more than APPROXIMATE_COUNT_THRESHOLD estimated rows. Breakdowns are always exact.
+"""
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Q
+
+from account.models import Profile
+from utils.db import estimated_row_count
+from .models import Blog, Category, Contact, Country, Review, Subscriber
+
+CACHE_KEY = 'main:app_stats:{source}'
+
+# Profile gender stored for each key of the response
+GENDERS = {
+    'male': 'male',
+    'female': 'female',
+    'prefer_not_say': 'prefer_not_to_say',
+}
+
+# Tables whose only number is their row count, by response key
+TOTALS = {
+    'countries': Country,
+    'subscribers': Subscriber,
+    'categories': Category,
+    'blogs': Blog,
+    'reviews': Review,
+}
+
+
+def count_rows(model, approximate=False):
+    """``model``'s row count, estimated from table statistics for big tables when ``approximate``"""
+    if approximate:
+        estimate = estimated_row_count(model)
+        if estimate is not None and estimate > settings.APPROXIMATE_COUNT_THRESHOLD:
+            return estimate
+    return model.objects.count()
+
+
+def compute_app_stats(approximate=False):
+    # Every profile belongs to a user, so the breakdown is read from the profile table alone, no join
+    genders = Profile.objects.aggregate(**{
+        key: Count('id', filter=Q(gender=gender)) for key, gender in GENDERS.items()
+    })
+    contacts = Contact.objects.aggregate(
+        read=Count('id', filter=Q(read=True)),
+        unread=Count('id', filter=Q(read=False)),
+    )
+    return {
+        'users': {
+            'total': count_rows(User, approximate),
+            **genders,
+        },
+        **{key: count_rows(model, approximate) for key, model in TOTALS.items()},
+        'contact_form_entries': {
+            'total': contacts['read'] + contacts['unread'],
+            **contacts,
+        },
+    }
+
+
+def get_app_stats(approximate=False):
+    source = 'approximate' if approximate else 'exact'
+    key = CACHE_KEY.format(source=source)
+    stats = cache.get(key)
+    if stats is None:
+        stats = compute_app_stats(approximate)
+        cache.set(key, stats, settings.APP_STATS_CACHE_SECONDS)
+    return stats
+
+
+def invalidate_app_stats():
+    """Drop the cached payloads once the current transaction commits, so they are never rebuilt from stale rows"""
+    transaction.on_commit(
+        lambda: cache.delete_many([CACHE_KEY.format(source=source) for source in ('exact', 'approximate')])
+    )
@@ -1,3 +1,207 @@
-from django.test import TestCase
+import io
+import os
+import shutil
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.core.files.uploadhandler import StopUpload
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+from rest_framework.test import APIClient
+
+from .models import Contact, Country, Media
+from .uploadhandlers import MediaUploadHandler
+from .utils import classify_file_by_signature, create_files
+
+
+@override_settings(APP_STATS_CACHE_SECONDS=300, APPROXIMATE_COUNT_THRESHOLD=1000)
+class AppStatsTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_user('admin', is_staff=True)
+        for username, gender in [('ann', 'female'), ('bob', 'male'), ('cy', 'prefer_not_to_say')]:
+            user = User.objects.create_user(username)
+            user.profile.gender = gender
+            user.profile.save()
+        Contact.objects.create(name='A', email='a@example.com', message='Hi', read=True)
+        Contact.objects.create(name='B', email='b@example.com', message='Hi')
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def get_stats(self, query=''):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.get(f'/api/app-stats/{query}')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_breakdowns(self):
+        with CaptureQueriesContext(connection) as queries:
+            stats = self.get_stats()
+        selects = [query for query in queries.captured_queries if query['sql'].startswith('SELECT')]
+        # Profile and contact breakdowns, plus one count per totalled table
+        self.assertEqual(len(selects), 8)
+
+        self.assertEqual(stats['users'], {'total': 4, 'male': 1, 'female': 1, 'prefer_not_say': 1})
+        self.assertEqual(stats['contact_form_entries'], {'total': 2, 'read': 1, 'unread': 1})
+
+    def test_cached_until_counted_rows_change(self):
+        self.get_stats()
+        with CaptureQueriesContext(connection) as queries:
+            self.get_stats()
+        self.assertFalse([query for query in queries.captured_queries if query['sql'].startswith('SELECT')])
+
+        # A login only touches last_login, the payload is kept
+        with self.captureOnCommitCallbacks(execute=True):
+            self.admin.save(update_fields=['last_login'])
+            contact = Contact.objects.get(read=False)
+        self.assertEqual(self.get_stats()['contact_form_entries']['read'], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            contact.read = True
+            contact.save()
+            Country.objects.create(name='Kenya')
+        stats = self.get_stats()
+        self.assertEqual(stats['contact_form_entries']['read'], 2)
+        self.assertEqual(stats['countries'], 1)
+
+    def test_approximate_totals_for_large_tables(self):
+        with mock.patch('main.stats.estimated_row_count', return_value=250000):
+            stats = self.get_stats('?approximate=true')
+        self.assertEqual(stats['users']['total'], 250000)
+        self.assertEqual(stats['users']['male'], 1)
+
+        with mock.patch('main.stats.estimated_row_count', return_value=None):
+            cache.clear()
+            self.assertEqual(self.get_stats('?approximate=true')['users']['total'], 4)
+
+
+def png_bytes(width=3, height=2):
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class FileSignatureTests(TestCase):
+
+    def test_classified_by_content(self):
+        self.assertEqual(classify_file_by_signature(png_bytes(), 'photo.exe'), 'image')
+        self.assertEqual(classify_file_by_signature(b'%PDF-1.7\n', 'report.jpg'), 'document')
+        self.assertEqual(classify_file_by_signature(b'ID3\x04\x00', 'song.pdf'), 'audio')
+
+    def test_ftyp_brand(self):
+        self.assertEqual(classify_file_by_signature(b'\x00\x00\x00\x18ftypisom\x00\x00\x02\x00'), 'video')
+        self.assertEqual(classify_file_by_signature(b'\x00\x00\x00\x14ftypqt  \x00\x00\x00\x00'), 'video')
+        self.assertEqual(classify_file_by_signature(b'\x00\x00\x00\x20ftypM4A \x00\x00\x00\x00'), 'audio')
+        self.assertEqual(classify_file_by_signature(b'\x00\x00\x00\x18ftypheic\x00\x00\x00\x00'), 'image')
+        self.assertEqual(classify_file_by_signature(b'\x00\x00\x00\x1cftypavif\x00\x00\x00\x00'), 'image')
+        self.assertEqual(classify_file_by_signature(b'\x00\x00\x00\x18ftypmif1\x00\x00\x00\x00'), 'image')
+
+    def test_riff_form(self):
+        self.assertEqual(classify_file_by_signature(b'RIFF\x24\x00\x00\x00WEBPVP8 '), 'image')
+        self.assertEqual(classify_file_by_signature(b'RIFF\x24\x00\x00\x00AVI LIST'), 'video')
+        self.assertEqual(classify_file_by_signature(b'RIFF\x24\x00\x00\x00WAVEfmt '), 'audio')
+        self.assertEqual(classify_file_by_signature(b'RIFF\x24\x00\x00\x00ACONanih'), 'unknown')
+        # The form type alone is not enough
+        self.assertEqual(classify_file_by_signature(b'#!/bin/sWEBPVP8 ', 'photo.webp'), 'unknown')
+
+    def test_unknown_content(self):
+        # The name alone is not trusted
+        self.assertEqual(classify_file_by_signature(b'MZ\x90\x00\x03', 'photo.png'), 'unknown')
+        self.assertEqual(classify_file_by_signature(b'#!/bin/sh\nrm -rf /', 'clip.mp4'), 'unknown')
+        # Text has no signature, it needs the txt name and no binary bytes
+        self.assertEqual(classify_file_by_signature(b'Plain notes\n', 'notes.txt'), 'document')
+        self.assertEqual(classify_file_by_signature(b'Plain\x00notes', 'notes.txt'), 'unknown')
+        self.assertEqual(classify_file_by_signature(b'Plain notes\n', 'notes.md'), 'unknown')
+
+
+class MediaUploadHandlerTests(TestCase):
+
+    def start_file(self, handler, file_name='photo.png'):
+        handler.handle_raw_input(None, {}, 0, b'boundary')
+        handler.new_file('files[]', file_name, 'application/octet-stream', None)
+
+    def test_streams_to_temporary_file(self):
+        handler = MediaUploadHandler(max_bytes=10 * 2 ** 20)
+        self.start_file(handler)
+        content = png_bytes(400, 300)
+        for start in range(0, len(content), 16):
+            handler.receive_data_chunk(content[start:start + 16], start)
+        file = handler.file_complete(len(content))
+
+        self.assertIsInstance(file, TemporaryUploadedFile)
+        self.assertTrue(os.path.exists(file.temporary_file_path()))
+        self.assertEqual(file.size, len(content))
+        self.assertEqual(file.media_type, 'image')
+        file.seek(0)
+        self.assertEqual(file.read(), content)
+        file.close()
+
+    def test_classifies_from_first_bytes_only(self):
+        handler = MediaUploadHandler(max_bytes=0)
+        self.start_file(handler, 'photo.txt')
+        handler.receive_data_chunk(b'MZ' + b'\x00' * 100, 0)
+        handler.receive_data_chunk(png_bytes(), 102)
+        file = handler.file_complete(102)
+        self.assertEqual(file.media_type, 'unknown')
+        file.close()
+
+    def test_refuses_oversized_body_before_reading(self):
+        handler = MediaUploadHandler(max_bytes=1024)
+        self.assertIsNotNone(handler.handle_raw_input(None, {}, 4096, b'boundary'))
+        self.assertTrue(handler.budget_exceeded)
+
+    def test_stops_once_budget_is_spent(self):
+        # The declared length can be wrong or missing, the streamed bytes are counted as well
+        handler = MediaUploadHandler(max_bytes=100)
+        self.start_file(handler)
+        handler.receive_data_chunk(b'\x00' * 60, 0)
+        with self.assertRaises(StopUpload):
+            handler.receive_data_chunk(b'\x00' * 60, 60)
+        self.assertTrue(handler.budget_exceeded)
+        handler.file.close()
+
+
+class MediaUploadTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(
+            MEDIA_ROOT=self.media_root, MEDIA_URL='/media/',
+            MEDIA_STORAGE_BACKEND='utils.storage.LocalMediaStorage', MEDIA_UPLOAD_MAX_BYTES=64 * 2 ** 10
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def upload(self, *files):
+        return self.client.post('/api/media/', {'files[]': list(files)})
+
+    def test_upload_is_sniffed_and_stored(self):
+        response = self.upload(
+            SimpleUploadedFile('photo.txt', png_bytes()),
+            SimpleUploadedFile('clip.mp4', b'#!/bin/sh\necho hi\n'),
+        )
+        self.assertEqual(response.status_code, 201)
+        photo, script = Media.objects.order_by('pk')
+        self.assertEqual((photo.type, photo.width, photo.height), ('image', 3, 2))
+        self.assertEqual(script.type, 'unknown')
+        self.assertTrue(os.path.isfile(os.path.join(self.media_root, photo.public_id)))
+
+    def test_files_not_streamed_are_sniffed_too(self):
+        media = create_files([
+            SimpleUploadedFile('photo.png', b'#!/bin/sh\necho hi\n'),
+            SimpleUploadedFile('photo.bin', png_bytes()),
+        ])
+        self.assertEqual([item.type for item in media], ['unknown', 'image'])
+
+    def test_oversized_upload_is_refused(self):
+        response = self.upload(SimpleUploadedFile('big.png', png_bytes() + b'\x00' * 65 * 2 ** 10))
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(Media.objects.exists())
+        self.assertEqual(os.listdir(self.media_root), [])
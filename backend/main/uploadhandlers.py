@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.core.files.uploadhandler import StopUpload, TemporaryFileUploadHandler
+from django.http import QueryDict
+from django.utils.datastructures import MultiValueDict
+
+from .utils import FILE_SIGNATURE_SIZE, classify_file_by_signature
+
+
+class MediaUploadHandler(TemporaryFileUploadHandler):
+    """
+    Streams every uploaded file to a temporary file in fixed size chunks so memory use does not grow with
+    the upload, classifies it from the magic bytes of its first block and enforces a per request byte budget.
+    """
+
+    chunk_size = 64 * 2 ** 10
+
+    def __init__(self, request=None, max_bytes=None):
+        super().__init__(request)
+        self.max_bytes = max_bytes if max_bytes is not None else settings.MEDIA_UPLOAD_MAX_BYTES
+        self.total_bytes = 0
+        self.budget_exceeded = False
+        self.head = b''
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        # Refuse oversized bodies up front, before a single byte hits the disk
+        if self.max_bytes and content_length > self.max_bytes:
+            self.budget_exceeded = True
+            return QueryDict(encoding=encoding), MultiValueDict()
+        return None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.head = b''
+
+    def receive_data_chunk(self, raw_data, start):
+        self.total_bytes += len(raw_data)
+        if self.max_bytes and self.total_bytes > self.max_bytes:
+            self.budget_exceeded = True
+            raise StopUpload(connection_reset=False)
+
+        if len(self.head) < FILE_SIGNATURE_SIZE:
+            self.head += raw_data[:FILE_SIGNATURE_SIZE - len(self.head)]
+        self.file.write(raw_data)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        file.media_type = classify_file_by_signature(self.head, self.file_name or '')
+        return file
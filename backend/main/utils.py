@@ -55,6 +55,97 @@ def classify_file_by_extension(file_name):
         return 'unknown'
 
 
+# Leading bytes of the formats we accept, checked in order
+FILE_SIGNATURES = [
+    (0, b'\x89PNG\r\n\x1a\n', 'image'),
+    (0, b'\xff\xd8\xff', 'image'),
+    (0, b'GIF87a', 'image'),
+    (0, b'GIF89a', 'image'),
+    (0, b'\x1a\x45\xdf\xa3', 'video'),
+    (0, b'ID3', 'audio'),
+    (0, b'\xff\xfb', 'audio'),
+    (0, b'\xff\xf3', 'audio'),
+    (0, b'\xff\xf2', 'audio'),
+    (0, b'OggS', 'audio'),
+    (0, b'fLaC', 'audio'),
+    (0, b'%PDF', 'document'),
+    (0, b'PK\x03\x04', 'document'),
+    (0, b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'document'),
+]
+
+# RIFF containers start with b'RIFF', a length and the form type that tells what they hold
+RIFF_FORMS = {
+    b'WEBP': 'image',
+    b'AVI ': 'video',
+    b'WAVE': 'audio',
+}
+
+# ISO base media files (mp4, mov, m4a, heic, avif, ...) start with an ftyp box, the major brand after it
+# tells what the file holds. Brands not listed here are video.
+FTYP_BRANDS = {
+    b'M4A ': 'audio',
+    b'M4B ': 'audio',
+    b'heic': 'image',
+    b'heix': 'image',
+    b'heim': 'image',
+    b'heis': 'image',
+    b'hevc': 'image',
+    b'hevx': 'image',
+    b'mif1': 'image',
+    b'msf1': 'image',
+    b'avif': 'image',
+    b'avis': 'image',
+}
+
+# Number of leading bytes needed to match FILE_SIGNATURES, the RIFF form and the ftyp brand
+FILE_SIGNATURE_SIZE = 16
+
+
+def classify_file_by_signature(head, file_name=''):
+    """
+    Classify a file from its first bytes instead of trusting the uploaded file name.
+    Plain text has no signature, so it is only accepted when the name says txt and the bytes look like text.
+    """
+    if head[:4] == b'RIFF':
+        return RIFF_FORMS.get(head[8:12], 'unknown')
+    if head[4:8] == b'ftyp':
+        return FTYP_BRANDS.get(head[8:12], 'video')
+    for offset, signature, file_type in FILE_SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            return file_type
+
+    if file_name.split('.')[-1].lower() == 'txt' and b'\x00' not in head:
+        return 'document'
+    return 'unknown'
+
+
+def sniff_file(file):
+    """classify_file_by_signature for a file that did not go through MediaUploadHandler"""
+    file.seek(0)
+    head = file.read(FILE_SIGNATURE_SIZE)
+    file.seek(0)
+    return classify_file_by_signature(head, file.name)
+
+
+def get_media_metadata(file, file_type):
+    """
+    Size and, for images, pixel dimensions of an uploaded file.
+    Pillow only parses the image header here so the pixels are never decoded into memory.
+    """
+    metadata = {'size': file.size, 'width': None, 'height': None}
+    if file_type == 'image':
+        from PIL import Image, UnidentifiedImageError
+        try:
+            file.seek(0)
+            with Image.open(file) as image:
+                metadata['width'], metadata['height'] = image.size
+        except (UnidentifiedImageError, OSError):
+            pass
+        finally:
+            file.seek(0)
+    return metadata
+
+
 def create_file(file):
     if file is not None and hasattr(file, 'name'):
         title = f'{file.name}'
@@ -70,8 +161,18 @@ def create_file(file):
 
 
 def create_files(files):
-    media_list = [Media(file=file, title=f'{file.name}'[0:60], type=classify_file_by_extension(file.name))
-                  for file in files]
+    media_list = []
+    for file in files:
+        # Content the signatures do not recognise is stored as unknown whatever the file name says. Files
+        # received through MediaUploadHandler were already sniffed while streaming to disk.
+        file_type = getattr(file, 'media_type', None) or sniff_file(file)
+        media = Media(file=file, title=f'{file.name}'[0:60], type=file_type,
+                      **get_media_metadata(file, file_type))
+        media_list.append(media)
+
+    # bulk_create skips Media.save, so push each file to the storage provider first
+    for media in media_list:
+        media.upload_to_storage()
     media_created = Media.objects.bulk_create(media_list)
     return media_created
 
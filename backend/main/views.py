@@ -1,5 +1,6 @@
 import random
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.db.models import Q
 from django.shortcuts import render, get_list_or_404
@@ -17,8 +18,11 @@ from .models import Contact, Category, BlogTag, Blog, BlogReply, Review, Media,
 from .serializers import ContactSerializer, CategorySerializer, BlogTagSerializer, BlogSerializer, \
     BlogReplySerializer, ReviewSerializer, SubscriberSerializer, FAQSerializer
 from .extraserializers import MediaSerializer, CountrySerializer
+from .uploadhandlers import MediaUploadHandler
+from .stats import get_app_stats
 from .utils import create_files, StandardResultsSetPagination
 from main.permissions import IsAuthenticatedOrPostOnly
+from utils.storage import delete_stored_files, resource_type_for_media
 
 
 def home(request):
@@ -55,15 +59,29 @@ class MediaViewSet(BulkModelViewSet):
     filterset_fields = ['type']
     search_fields = ['title']
 
+    def initialize_request(self, request, *args, **kwargs):
+        # Upload handlers can only be swapped before the body is parsed
+        if request.method == 'POST':
+            request.upload_handlers = [MediaUploadHandler(request)]
+        return super().initialize_request(request, *args, **kwargs)
+
     def create(self, request, *args, **kwargs):
-        # files = []
         files = request.data.getlist('files[]')
-        # for key, file in request.data.items():
-        #     files.append(file)
+        if any(getattr(handler, 'budget_exceeded', False) for handler in request.upload_handlers):
+            return Response(
+                {'detail': f'Upload exceeds the limit of {settings.MEDIA_UPLOAD_MAX_BYTES} bytes per request.'},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
         saved_files = create_files(files)
         data = self.serializer_class(saved_files, many=True).data
         return Response(data=data, status=201)
 
+    def perform_bulk_destroy(self, objects):
+        # Remove the stored files in batches instead of one provider call per row
+        references = [(media.public_id, resource_type_for_media(media.type)) for media in objects]
+        delete_stored_files(references)
+        objects.delete()
+
 
 class CategoryViewSet(BulkModelViewSet):
 
@@ -197,36 +215,17 @@ class FAQViewSet(BulkModelViewSet):
 
 
 class AppStatsView(APIView):
+    """
+    Site wide numbers, one query per table, cached for APP_STATS_CACHE_SECONDS and refreshed when they
+    change. ?approximate=true takes the totals of large tables from the database's table statistics.
+    """
 
     authentication_classes = [AUTH_CLASS]
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request, *args, **kwargs):
-        users = User.objects
-        contact_form_entries = Contact.objects
-        # agents = Agent.objects
-        # # You can add more statistics here
-        #
-        app_stats = {
-            'users': {
-                'total': users.count(),
-                'male': users.filter(profile__gender='male').count(),
-                'female': users.filter(profile__gender='female').count(),
-                'prefer_not_say': users.filter(profile__gender='prefer_not_say').count(),
-            },
-            'countries': Country.objects.count(),
-            'subscribers': Subscriber.objects.count(),
-            'categories': Category.objects.count(),
-            'blogs': Blog.objects.count(),
-            'reviews': Review.objects.count(),
-            'contact_form_entries': {
-                'total': contact_form_entries.count(),
-                'read': contact_form_entries.filter(read=True).count(),
-                'unread': contact_form_entries.filter(read=False).count()
-            },
-        }
-
-        return Response(app_stats, status=status.HTTP_200_OK)
+        approximate = request.query_params.get('approximate', '').lower() in ('1', 'true', 'yes')
+        return Response(get_app_stats(approximate=approximate), status=status.HTTP_200_OK)
 
 
 class UserStatsView(APIView):
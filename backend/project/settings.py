@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 import os
 from pathlib import Path
 
+from corsheaders.defaults import default_headers
 from dotenv import load_dotenv
 
 
@@ -157,6 +158,62 @@ else:
         }
     }
 
+# Cache
+# Use a shared backend (e.g. django.core.cache.backends.redis.RedisCache) in production so that every
+# worker sees the same guest carts and cached values
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
+    }
+}
+
+# Guest carts are kept in the cache (see custom_ecommerce/cartstore.py) and written to Cart/CartItem at
+# checkout or at most once per GUEST_CART_WRITE_BEHIND_SECONDS while they are being changed
+GUEST_CART_STORE = os.getenv('GUEST_CART_STORE', 'custom_ecommerce.cartstore.CacheCartStore')
+GUEST_CART_CACHE_ALIAS = 'default'
+GUEST_CART_TTL = int(os.getenv('GUEST_CART_TTL', 60 * 60 * 24 * 7))
+GUEST_CART_WRITE_BEHIND_SECONDS = int(os.getenv('GUEST_CART_WRITE_BEHIND_SECONDS', 15 * 60))
+# Signed cookie carrying the guest cart key, guest carts do not use the database-backed session
+GUEST_CART_COOKIE = os.getenv('GUEST_CART_COOKIE', 'guest_cart')
+
+# Stock reserved for an order at checkout is held this long while the customer pays,
+# run `manage.py expire_stock_holds` periodically to sweep expired holds
+STOCK_HOLD_TTL_SECONDS = int(os.getenv('STOCK_HOLD_TTL_SECONDS', 15 * 60))
+
+# Background jobs (utils/jobs.py) are stored in the database and run by `manage.py run_jobs`.
+# "thread" also starts each job in a daemon thread when it is queued, "eager" runs it inline (tests)
+BACKGROUND_JOBS_MODE = os.getenv('BACKGROUND_JOBS_MODE', 'thread' if DEBUG else 'worker')
+BACKGROUND_JOBS_MAX_ATTEMPTS = int(os.getenv('BACKGROUND_JOBS_MAX_ATTEMPTS', 5))
+BACKGROUND_JOBS_BASE_BACKOFF = float(os.getenv('BACKGROUND_JOBS_BASE_BACKOFF', 2))
+BACKGROUND_JOBS_MAX_BACKOFF = float(os.getenv('BACKGROUND_JOBS_MAX_BACKOFF', 300))
+BACKGROUND_JOBS_LOCK_SECONDS = int(os.getenv('BACKGROUND_JOBS_LOCK_SECONDS', 120))
+
+# Responses to requests sent with an Idempotency-Key header are replayed for this long,
+# `manage.py clear_idempotency_keys` removes the expired ones
+IDEMPOTENCY_KEY_TTL = int(os.getenv('IDEMPOTENCY_KEY_TTL', 60 * 60))
+CORS_ALLOW_HEADERS = (*default_headers, 'idempotency-key')
+
+# Ecommerce dashboard numbers are cached this long (custom_ecommerce/stats.py),
+# `manage.py rebuild_stats_counters` recomputes the signal-maintained counters if they ever drift
+ECOMMERCE_STATS_CACHE_SECONDS = int(os.getenv('ECOMMERCE_STATS_CACHE_SECONDS', 30))
+
+# AppStatsView's payload is cached this long (main/stats.py) and dropped when the counted rows change.
+# ?approximate=true reads the total of tables over APPROXIMATE_COUNT_THRESHOLD rows from table statistics
+APP_STATS_CACHE_SECONDS = int(os.getenv('APP_STATS_CACHE_SECONDS', 300))
+APPROXIMATE_COUNT_THRESHOLD = int(os.getenv('APPROXIMATE_COUNT_THRESHOLD', 100000))
+
+# Product leaderboards (custom_ecommerce/leaderboards.py), updated in batches by `manage.py update_leaderboards`.
+# Sales count half as much towards the trending score every TRENDING_HALF_LIFE_DAYS days
+LEADERBOARD_SIZE = int(os.getenv('LEADERBOARD_SIZE', 50))
+TRENDING_HALF_LIFE_DAYS = float(os.getenv('TRENDING_HALF_LIFE_DAYS', 7))
+
+# Order numbers are allocated from blocks reserved per process (custom_ecommerce/numbering.py),
+# e.g. ORD-00001234. Larger blocks mean fewer database round trips but bigger gaps after restarts
+ORDER_NUMBER_PREFIX = os.getenv('ORDER_NUMBER_PREFIX', 'ORD-')
+ORDER_NUMBER_WIDTH = int(os.getenv('ORDER_NUMBER_WIDTH', 8))
+ORDER_NUMBER_BLOCK_SIZE = int(os.getenv('ORDER_NUMBER_BLOCK_SIZE', 20))
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -239,6 +296,21 @@ else:
     SESSION_COOKIE_SECURE = True
     CSRF_COOKIE_SECURE = True
 
+# Media storage provider used by the models that store uploads (see utils/storage.py).
+# utils.storage.LocalMediaStorage keeps files under MEDIA_ROOT and serves them from MEDIA_URL
+if DEBUG and not os.getenv('CLOUDINARY_URL'):
+    MEDIA_STORAGE_BACKEND = os.getenv('MEDIA_STORAGE_BACKEND', 'utils.storage.LocalMediaStorage')
+else:
+    MEDIA_STORAGE_BACKEND = os.getenv('MEDIA_STORAGE_BACKEND', 'utils.storage.CloudinaryMediaStorage')
+
+# Let the web server send local media: 'X-Accel-Redirect' (nginx) or 'X-Sendfile' (Apache)
+MEDIA_SENDFILE_HEADER = os.getenv('MEDIA_SENDFILE_HEADER')
+MEDIA_SENDFILE_PREFIX = os.getenv('MEDIA_SENDFILE_PREFIX', '/protected-media/')
+MEDIA_CACHE_MAX_AGE = int(os.getenv('MEDIA_CACHE_MAX_AGE', 86400))
+
+# Byte budget for a single MediaViewSet upload request (all files together)
+MEDIA_UPLOAD_MAX_BYTES = int(os.getenv('MEDIA_UPLOAD_MAX_BYTES', 200 * 1024 * 1024))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -251,6 +323,33 @@ PESAPAL_BASE_URL = os.getenv('PESAPAL_BASE_URL') # Sandbox or Live URL
 PESAPAL_CALLBACK_URL = os.getenv('PESAPAL_CALLBACK_URL') # Django endpoint for IPN
 PESAPAL_IPN_ID = os.getenv('PESAPAL_IPN_ID')
 
+# Payment gateway used for orders (utils/gateways.py): 'pesapal', 'fake' (in-process, for tests and local
+# development) or a dotted path to a PaymentGateway subclass, PAYMENT_GATEWAY_OPTIONS go to its constructor
+PAYMENT_GATEWAY = os.getenv('PAYMENT_GATEWAY', 'pesapal')
+PAYMENT_GATEWAY_OPTIONS = {}
+
+# Shared HTTP client for payment gateways (utils/httpclient.py), timeouts are (connect, read) seconds per endpoint
+PAYMENT_HTTP_TIMEOUTS = {
+    'default': (3.05, 10),
+    'pesapal.token': (3.05, 10),
+    'pesapal.register_ipn': (3.05, 15),
+    'pesapal.submit_order': (3.05, 20),
+    'pesapal.transaction_status': (3.05, 10),
+}
+PAYMENT_HTTP_POOL_SIZE = int(os.getenv('PAYMENT_HTTP_POOL_SIZE', 10))
+PAYMENT_HTTP_MAX_RETRIES = int(os.getenv('PAYMENT_HTTP_MAX_RETRIES', 2))
+PAYMENT_HTTP_BACKOFF = float(os.getenv('PAYMENT_HTTP_BACKOFF', 0.3))
+
+# Circuit breaker and bulkhead around gateway calls (utils/resilience.py), shared by all workers through the cache.
+# The breaker opens after FAILURE_THRESHOLD failures within WINDOW seconds and probes again after RESET_TIMEOUT,
+# at most BULKHEAD_SIZE calls are in flight at once
+PAYMENT_BREAKER_FAILURE_THRESHOLD = int(os.getenv('PAYMENT_BREAKER_FAILURE_THRESHOLD', 5))
+PAYMENT_BREAKER_WINDOW = int(os.getenv('PAYMENT_BREAKER_WINDOW', 60))
+PAYMENT_BREAKER_RESET_TIMEOUT = int(os.getenv('PAYMENT_BREAKER_RESET_TIMEOUT', 30))
+PAYMENT_BULKHEAD_SIZE = int(os.getenv('PAYMENT_BULKHEAD_SIZE', 10))
+PAYMENT_BULKHEAD_WAIT = float(os.getenv('PAYMENT_BULKHEAD_WAIT', 0.5))
+PAYMENT_BULKHEAD_SLOT_TTL = int(os.getenv('PAYMENT_BULKHEAD_SLOT_TTL', 60))
+
 # Main Email settings
 EMAIL_BACKEND = os.getenv('EMAIL_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
 EMAIL_HOST_PORT = os.getenv('EMAIL_HOST_PORT', 465)
@@ -1,15 +1,44 @@
-import requests
+import hashlib
+import threading
+import time
+
 from django.conf import settings
-from django.urls import reverse
-from custom_ecommerce.models import Order, Transaction, CallBackUrls  # Assuming you have Order and Transaction models
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from custom_ecommerce.models import CallBackUrls
+from .httpclient import get_payment_http_client
+from .resilience import get_gateway_guard
+
+# Serializes token refreshes within a process, the cache lock below does the same across processes
+_token_refresh_lock = threading.Lock()
+
 
 class Pesapal:
+    """
+    Pesapal API 3.0 client. Order code goes through utils.gateways.PesapalGateway, which keeps one instance.
+    """
+
+    # Tokens are refreshed this many seconds before Pesapal's expiryDate
+    token_refresh_margin = 60
+    # How long a worker waits for another worker's token refresh before fetching a token itself
+    token_refresh_wait = 5
 
     def __init__(self):
         self.consumer_key = settings.PESAPAL_CONSUMER_KEY
         self.consumer_secret = settings.PESAPAL_CONSUMER_SECRET
         self.base_url = settings.PESAPAL_BASE_URL  # Sandbox or Live URL
         self.callback_url = settings.PESAPAL_CALLBACK_URL  # Django endpoint for IPN
+        # Shared pooled client, keeps connections to Pesapal alive between calls
+        self.http = get_payment_http_client()
+        # Circuit breaker and bulkhead shared by every worker, see utils/resilience.py
+        self.guard = get_gateway_guard("pesapal")
+
+    @property
+    def _token_cache_key(self):
+        # Scoped to the account and environment so sandbox and live tokens never mix
+        account = hashlib.sha256(f"{self.base_url}:{self.consumer_key}".encode()).hexdigest()[:16]
+        return f"pesapal:token:{account}"
 
     def _generate_auth_token(self):
         """
@@ -21,9 +50,92 @@ class Pesapal:
             "consumer_key": self.consumer_key,
             "consumer_secret": self.consumer_secret
         }
-        response = requests.post(auth_url, json=payload, headers=headers)
+        # Requesting a token has no side effects, so it may be retried
+        response = self._send("pesapal.token", "POST", auth_url, json=payload, headers=headers, idempotent=True)
+
+        return response.json()
+
+    def _get_auth_token(self, rejected=None):
+        """
+        Return a cached access token, requesting a new one when it is missing, about to expire or
+        the ``rejected`` token that the API just answered with a 401.
+
+        The token lives in the Django cache so every worker shares it. Refreshes are single flight: one
+        worker takes the cache lock and requests the token while the others wait for it to appear.
+        """
+        key = self._token_cache_key
+        token = cache.get(key)
+        if token and token != rejected:
+            return token
+
+        with _token_refresh_lock:
+            # Another thread may have refreshed the token while this one waited for the lock
+            token = cache.get(key)
+            if token and token != rejected:
+                return token
+
+            lock_key = f"{key}:lock"
+            if cache.add(lock_key, True, self.token_refresh_wait * 2):
+                try:
+                    return self._refresh_auth_token()
+                finally:
+                    cache.delete(lock_key)
+
+            # Another worker is refreshing, wait for its token and fall back to our own request
+            deadline = time.monotonic() + self.token_refresh_wait
+            while time.monotonic() < deadline:
+                time.sleep(0.1)
+                token = cache.get(key)
+                if token and token != rejected:
+                    return token
+            return self._refresh_auth_token()
+
+    def _refresh_auth_token(self):
+        data = self._generate_auth_token()
+        token = data.get("token")
+        if not token:
+            return None
+
+        expires_at = parse_datetime(data.get("expiryDate") or "")
+        # Pesapal tokens last 5 minutes, assume that when the expiry date is missing
+        ttl = (expires_at - timezone.now()).total_seconds() if expires_at else 300
+        ttl -= self.token_refresh_margin
+        if ttl > 0:
+            cache.set(self._token_cache_key, token, ttl)
+        return token
 
-        return response.json().get("token")
+    def _send(self, endpoint, method, url, **kwargs):
+        """
+        Send a request through the circuit breaker and bulkhead. Raises GatewayUnavailable without
+        contacting Pesapal while it is failing or already has as many calls in flight as allowed.
+        """
+        return self.guard.call(
+            self.http.request, endpoint, method, url,
+            is_failure=lambda response: response.status_code >= 500,
+            **kwargs
+        )
+
+    def _authorized_request(self, endpoint, method, url, **kwargs):
+        """
+        Send a request with the cached bearer token. A 401 means the token was revoked or expired early,
+        the token is then refreshed and the request retried once.
+        """
+        token = self._get_auth_token()
+        if not token:
+            raise Exception("Failed to authenticate with Pesapal")
+
+        for attempt in range(2):
+            headers = {
+                "Authorization": f"Bearer {token}",
+                "Content-Type": "application/json"
+            }
+            response = self._send(endpoint, method, url, headers=headers, **kwargs)
+            if response.status_code != 401 or attempt:
+                return response
+
+            token = self._get_auth_token(rejected=token)
+            if not token:
+                raise Exception("Failed to authenticate with Pesapal")
 
     def register_ipn_url(self, ipn_url=None):
         """
@@ -33,15 +145,7 @@ class Pesapal:
         Args:
             ipn_url (str): The URL to be registered for IPN. If None, uses the callback_url.
         """
-        token = self._generate_auth_token()
-        if not token:
-            raise Exception("Failed to authenticate with Pesapal")
-
         register_url = f"{self.base_url}/api/URLSetup/RegisterIPN"
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
 
         # Use provided IPN URL or fall back to callback_url
         url_to_register = ipn_url or self.callback_url
@@ -50,7 +154,7 @@ class Pesapal:
             "ipn_notification_type": "POST"  # Pesapal will POST payment updates to this URL
         }
 
-        response = requests.post(register_url, json=payload, headers=headers)
+        response = self._authorized_request("pesapal.register_ipn", "POST", register_url, json=payload)
         response_data = response.json()
 
         if response.status_code == 200 and response_data.get("url") == url_to_register:
@@ -64,17 +168,11 @@ class Pesapal:
         Returns a redirect URL or triggers STK push (if M-Pesa is forced).
         """
         # ipn_reigistration = self.register_ipn_url("https://webhook.site/ee457311-e4d0-4e70-a35c-0e9d4ec534bb")
-        token = self._generate_auth_token()
-        if not token:
-            raise Exception("Failed to authenticate with Pesapal")
-
         submit_url = f"{self.base_url}/api/Transactions/SubmitOrderRequest"
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
 
-        pesapal_ipn_id = CallBackUrls.objects.filter(identifier="active").first()
+        # The IPN registered through the admin, PESAPAL_IPN_ID when none was
+        active_ipn = CallBackUrls.objects.filter(identifier="active").first()
+        notification_id = active_ipn.callback_url_id if active_ipn else settings.PESAPAL_IPN_ID
 
         payload = {
             "id": str(order_id),
@@ -82,8 +180,7 @@ class Pesapal:
             "amount": float(amount),
             "description": description,
             "callback_url": self.callback_url,
-            # "notification_id": settings.PESAPAL_IPN_ID,
-            "notification_id": pesapal_ipn_id.callback_url_id,
+            "notification_id": notification_id,
             "billing_address": {
                 "email_address": email,
                 "phone_number": phone,  # Must be an M-Pesa-registered number
@@ -94,7 +191,7 @@ class Pesapal:
         if force_mpesa:
             payload["payment_method"] = "mpesa"  # Check Pesapal's API docs for exact key
 
-        response = requests.post(submit_url, json=payload, headers=headers)
+        response = self._authorized_request("pesapal.submit_order", "POST", submit_url, json=payload)
         response_data = response.json()
 
         # Pesapal may return an M-Pesa STK push trigger or redirect URL
@@ -104,79 +201,11 @@ class Pesapal:
         """
         Check the status of a transaction using the order_tracking_id.
         """
-        token = self._generate_auth_token()
-        if not token:
-            raise Exception("Failed to authenticate with Pesapal")
-
         status_url = f"{self.base_url}/api/Transactions/GetTransactionStatus"
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
         params = {"orderTrackingId": order_tracking_id}
-        response = requests.get(status_url, headers=headers, params=params)
+        response = self._authorized_request("pesapal.transaction_status", "GET", status_url, params=params)
         return response.json()  # Returns status (PENDING, COMPLETED, FAILED)
 
-    def handle_pesapal_callback(self, request_data):
-        """
-        Handle Pesapal IPN (Instant Payment Notification) callback.
-        Updates the order status in the database.
-        """
-        transaction_tracking_id = request_data.get("OrderTrackingId") # Transaction id
-        merchant_reference = request_data.get("OrderMerchantReference") # Order Number
-        order_notification_type = request_data.get("OrderNotificationType")
-
-        # Update the order and transaction in the database
-        try:
-            order = Order.objects.get(order_number=merchant_reference)
-            transaction, created = Transaction.objects.get_or_create(
-                order=order,
-                transaction_id=transaction_tracking_id
-            )
-            # We query pesapal with the tx_id to get all the information
-            response = self.check_payment_status(transaction_tracking_id)
-
-            transaction.ipn_data = request_data
-            payment_status = response.get("payment_status_description")
-
-            tx_status = "PENDING"
-            if str.lower(payment_status) == "completed":
-                tx_status = "COMPLETED"
-                order.is_paid = True
-                order.status = "paid"
-                """
-                    Send email/SMS confirmation here
-                """
-                # self._send_payment_confirmation(order)
-            else:
-                tx_status = "FAILED"
-
-            transaction.status = tx_status
-            transaction.amount = response.get("amount")
-            transaction.payment_method = response.get("payment_method")
-            transaction.confirmation_code = response.get("confirmation_code")
-            transaction.all_transaction_info_after_callback = response
-
-            # Update discount
-            if order.discount_code:
-                order.discount_code.times_used += 1
-                order.discount_code.save()
-        
-            # Update the db by saving the order and transaction
-            transaction.save()
-            order.save()
-
-            # if not created:
-            #     transaction.status = status
-            #     transaction.save()
-            #
-            # # Additional logic (e.g., send email on success)
-            # if status == "COMPLETED":
-            #     self._send_payment_confirmation(order)
-            return True
-        except Exception as e:
-            return False
-
     def _send_payment_confirmation(self, order):
         """
         (Private) Send a payment confirmation email to the customer.
@@ -3,14 +3,14 @@ from rest_framework.decorators import api_view, parser_classes
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.response import Response
 
-from .cloudinary_utils import upload_file_to_cloudinary
+from .storage import get_media_storage
 
 
 @api_view(['POST'])
 @parser_classes([MultiPartParser, FormParser])
 def upload_image(request):
     """
-    Example view for uploading an image to Cloudinary
+    Example view for uploading an image through the configured media storage provider
     
     Request should include a file with the key 'image'
     Optional parameters:
@@ -30,8 +30,8 @@ def upload_image(request):
     public_id = request.data.get('public_id', None)
     
     try:
-        # Upload the file to Cloudinary
-        result = upload_file_to_cloudinary(
+        # Upload the file to the media storage provider
+        result = get_media_storage().upload(
             file=image_file,
             folder=folder,
             public_id=public_id,
@@ -40,13 +40,13 @@ def upload_image(request):
             # transformation={"width": 500, "height": 500, "crop": "limit"}
         )
         
-        # Return the Cloudinary response with URLs
+        # Return the provider response with URLs
         return Response({
             'success': True,
             'message': 'File uploaded successfully',
             'data': {
                 'public_id': result.get('public_id'),
-                'url': result.get('secure_url'),
+                'url': result.get('url'),
                 'resource_type': result.get('resource_type'),
                 'format': result.get('format'),
                 'width': result.get('width'),
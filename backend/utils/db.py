@@ -0,0 +1,35 @@
+from django.db import DatabaseError, connections, transaction
+
+
+def estimated_row_count(model, using='default'):
+    """
+    The row count of ``model``'s table according to the database's table statistics, without scanning it.
+    The estimate is only as fresh as the last ANALYZE (PostgreSQL, SQLite) or InnoDB's sampled statistics
+    (MySQL). Returns None when the database has no statistics for the table.
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+    queries = {
+        'postgresql': ("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)", [table]),
+        'mysql': (
+            "SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+            [table]
+        ),
+        # sqlite_stat1 only exists once ANALYZE ran, its stat column starts with the table's row count
+        'sqlite': ("SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1", [table]),
+    }
+    if connection.vendor not in queries:
+        return None
+    sql, params = queries[connection.vendor]
+    try:
+        # A savepoint, so a missing statistics table does not break the surrounding transaction
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+    except DatabaseError:
+        return None
+    if row is None or row[0] is None:
+        return None
+    estimate = int(str(row[0]).split()[0])
+    # PostgreSQL reports -1 for tables that were never analyzed
+    return estimate if estimate >= 0 else None
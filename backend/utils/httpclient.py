@@ -0,0 +1,133 @@
+import random
+import threading
+import time
+from functools import lru_cache
+
+import requests
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from requests.adapters import HTTPAdapter
+
+# Methods that can be sent again without side effects
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+RETRY_STATUSES = frozenset([502, 503, 504])
+
+
+class EndpointMetrics:
+    """Running latency and error counts of one endpoint"""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'retries': self.retries,
+            'avg_ms': round(self.total_seconds / self.calls * 1000, 2) if self.calls else 0,
+            'max_ms': round(self.max_seconds * 1000, 2),
+        }
+
+
+class HttpClient:
+    """
+    A ``requests.Session`` shared by the payment integrations.
+
+    Connections are kept alive in a pool, every call names an endpoint that picks its (connect, read)
+    timeout from ``timeouts`` and records its latency and errors under that name. Idempotent calls are
+    retried on connection errors, timeouts and 502/503/504 responses with jittered exponential backoff.
+    """
+
+    def __init__(self, timeouts=None, pool_size=10, max_retries=2, backoff=0.3):
+        self.timeouts = {'default': (3.05, 10), **(timeouts or {})}
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._metrics = {}
+        self._metrics_lock = threading.Lock()
+
+    def timeout_for(self, endpoint):
+        return tuple(self.timeouts.get(endpoint, self.timeouts['default']))
+
+    def _record(self, endpoint, seconds, error=False, retry=False):
+        with self._metrics_lock:
+            metrics = self._metrics.setdefault(endpoint, EndpointMetrics())
+            if retry:
+                metrics.retries += 1
+                return
+            metrics.calls += 1
+            metrics.total_seconds += seconds
+            metrics.max_seconds = max(metrics.max_seconds, seconds)
+            if error:
+                metrics.errors += 1
+
+    def metrics(self):
+        """Snapshot of the per endpoint metrics, e.g. {'pesapal.status': {'calls': 3, 'avg_ms': 120.5, ...}}"""
+        with self._metrics_lock:
+            return {endpoint: metrics.as_dict() for endpoint, metrics in self._metrics.items()}
+
+    def _sleep_before_retry(self, attempt):
+        ceiling = self.backoff * 2 ** attempt
+        time.sleep(random.uniform(0, ceiling))
+
+    def request(self, endpoint, method, url, idempotent=None, **kwargs):
+        """
+        Send a request for ``endpoint``. ``idempotent`` defaults to whether the method is, pass True for
+        POSTs that are safe to repeat. Raises requests.RequestException once the retries are used up.
+        """
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        attempts = self.max_retries + 1 if idempotent else 1
+        kwargs.setdefault('timeout', self.timeout_for(endpoint))
+
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._record(endpoint, time.monotonic() - started, error=True)
+                if last_attempt:
+                    raise
+            else:
+                failed = response.status_code >= 500
+                self._record(endpoint, time.monotonic() - started, error=failed)
+                if response.status_code not in RETRY_STATUSES or last_attempt:
+                    return response
+            self._record(endpoint, 0, retry=True)
+            self._sleep_before_retry(attempt)
+
+    def get(self, endpoint, url, **kwargs):
+        return self.request(endpoint, 'GET', url, **kwargs)
+
+    def post(self, endpoint, url, **kwargs):
+        return self.request(endpoint, 'POST', url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+@lru_cache(maxsize=None)
+def get_payment_http_client() -> HttpClient:
+    """The process wide client for payment gateways, configured by the PAYMENT_HTTP_* settings"""
+    return HttpClient(
+        timeouts=getattr(settings, 'PAYMENT_HTTP_TIMEOUTS', None),
+        pool_size=getattr(settings, 'PAYMENT_HTTP_POOL_SIZE', 10),
+        max_retries=getattr(settings, 'PAYMENT_HTTP_MAX_RETRIES', 2),
+        backoff=getattr(settings, 'PAYMENT_HTTP_BACKOFF', 0.3),
+    )
+
+
+@receiver(setting_changed)
+def reset_payment_http_client(sender, setting, **kwargs):
+    if setting.startswith('PAYMENT_HTTP_'):
+        get_payment_http_client.cache_clear()
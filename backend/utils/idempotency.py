@@ -0,0 +1,112 @@
+import hashlib
+import json
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+
+def hash_request(request):
+    """Fingerprint of what the client asked for, a key reused for a different request is rejected"""
+    digest = hashlib.sha256()
+    digest.update(request.method.encode())
+    digest.update(request.path.encode())
+    digest.update(json.dumps(request.data, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def _claim(scope, key, request_hash):
+    """
+    Insert the key row, or return the existing unexpired one. The insert runs in the request's transaction,
+    so a concurrent duplicate blocks on the unique (scope, key) index until the first request commits
+    (then it sees the stored response) or rolls back (then its own insert goes through).
+    Returns (record, created).
+
+    The lookup after a conflict is a locking read: under MySQL's REPEATABLE READ a plain SELECT would read
+    the transaction's snapshot, taken before the winner committed, and not find the row.
+    """
+    expires_at = timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+    for _ in range(2):
+        try:
+            with transaction.atomic():
+                return IdempotencyKey.objects.create(
+                    scope=scope, key=key, request_hash=request_hash, expires_at=expires_at
+                ), True
+        except IntegrityError:
+            record = IdempotencyKey.objects.select_for_update().filter(scope=scope, key=key).first()
+            if record is None:
+                continue
+            if record.expires_at > timezone.now():
+                return record, False
+            # An expired key is free to be used again
+            IdempotencyKey.objects.filter(pk=record.pk).delete()
+    raise IntegrityError(f"Could not claim idempotency key {key}")
+
+
+def idempotent(scope):
+    """
+    Make a DRF view method replay its first response for requests carrying the same ``Idempotency-Key``
+    header, e.g. ``@idempotent('orders.create')``. Requests without the header run as usual.
+
+    The view runs in one transaction with the key. Only successful (2xx) responses are stored, when the view
+    raises or answers with an error the key is released so the client can retry. Responses are kept for
+    IDEMPOTENCY_KEY_TTL seconds, keys are scoped to the user.
+    """
+    def decorator(view_method):
+        @wraps(view_method)
+        def wrapper(self, request, *args, **kwargs):
+            key = request.headers.get(IDEMPOTENCY_HEADER)
+            if not key:
+                return view_method(self, request, *args, **kwargs)
+            if len(key) > 255:
+                return Response(
+                    {'error': f'{IDEMPOTENCY_HEADER} must be at most 255 characters'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            user_scope = f"{scope}:{request.user.pk if request.user.is_authenticated else 'anonymous'}"
+            request_hash = hash_request(request)
+
+            with transaction.atomic():
+                record, created = _claim(user_scope, key, request_hash)
+                if not created:
+                    if record.request_hash != request_hash:
+                        return Response(
+                            {'error': f'{IDEMPOTENCY_HEADER} was already used for a different request'},
+                            status=status.HTTP_422_UNPROCESSABLE_ENTITY
+                        )
+                    response = Response(record.response_body, status=record.response_status)
+                    response['Idempotent-Replayed'] = 'true'
+                    return response
+
+                response = view_method(self, request, *args, **kwargs)
+                if not status.is_success(response.status_code):
+                    record.delete()
+                    return response
+                record.response_status = response.status_code
+                record.response_body = response.data
+                record.save(update_fields=['response_status', 'response_body', 'updated_on'])
+                return response
+
+        return wrapper
+    return decorator
+
+
+def clear_expired_keys(batch_size=1000):
+    """Delete expired idempotency keys in batches, returns how many were removed"""
+    total = 0
+    while True:
+        ids = list(
+            IdempotencyKey.objects.filter(expires_at__lte=timezone.now()).values_list('pk', flat=True)[:batch_size]
+        )
+        if not ids:
+            return total
+        total += IdempotencyKey.objects.filter(pk__in=ids).delete()[0]
@@ -0,0 +1,147 @@
+import random
+import threading
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import Job
+
+
+class RetryLater(Exception):
+    """
+    Raised by a job that could not run for a reason outside its control (e.g. the gateway circuit is open),
+    it is run again after ``delay`` seconds without using up an attempt.
+    """
+
+    def __init__(self, delay, message=''):
+        self.delay = delay
+        super().__init__(message or f"Retry in {delay} seconds")
+
+
+def job_name(func):
+    return f"{func.__module__}.{func.__qualname__}"
+
+
+def enqueue(func, delay=0, max_attempts=None, on_failure=None, **payload):
+    """
+    Queue ``func(**payload)`` to run in the background, ``payload`` must be JSON serializable.
+    ``on_failure(**payload)`` is called once the job has used up its attempts.
+
+    The job row is written in the caller's transaction, so it only becomes visible to workers once that
+    commits. With BACKGROUND_JOBS_MODE set to "thread" the job is also started in a daemon thread on commit
+    (handy without a worker process), "eager" runs it inline on commit (tests).
+    """
+    job = Job.objects.create(
+        name=job_name(func),
+        on_failure=job_name(on_failure) if on_failure else '',
+        payload=payload,
+        max_attempts=max_attempts or settings.BACKGROUND_JOBS_MAX_ATTEMPTS,
+        run_at=timezone.now() + timedelta(seconds=delay),
+    )
+
+    mode = settings.BACKGROUND_JOBS_MODE
+    if mode == 'eager':
+        transaction.on_commit(lambda: run_job(job.pk))
+    elif mode == 'thread':
+        transaction.on_commit(lambda: threading.Thread(target=_run_job_in_thread, args=(job.pk,), daemon=True).start())
+    return job
+
+
+def _run_job_in_thread(job_id):
+    try:
+        run_job(job_id)
+    finally:
+        close_old_connections()
+
+
+def backoff_delay(attempts):
+    """Exponential backoff with full jitter, capped at BACKGROUND_JOBS_MAX_BACKOFF seconds"""
+    ceiling = min(settings.BACKGROUND_JOBS_MAX_BACKOFF, settings.BACKGROUND_JOBS_BASE_BACKOFF * 2 ** attempts)
+    return random.uniform(ceiling / 2, ceiling)
+
+
+def claim_job(job_id):
+    """
+    Mark a due job running with a single conditional UPDATE so only one worker gets it.
+    Returns the claimed job or None if another worker got there first or it is not due.
+    """
+    now = timezone.now()
+    claimed = Job.objects.filter(
+        Q(status=Job.STATUS_QUEUED) | Q(status=Job.STATUS_RUNNING, locked_until__lt=now),
+        pk=job_id,
+        run_at__lte=now,
+    ).update(
+        status=Job.STATUS_RUNNING,
+        locked_until=now + timedelta(seconds=settings.BACKGROUND_JOBS_LOCK_SECONDS),
+        updated_on=now,
+    )
+    return Job.objects.filter(pk=job_id).first() if claimed else None
+
+
+def run_job(job_id):
+    """Claim and run one job, rescheduling it with backoff when it raises. Returns True if it ran successfully"""
+    job = claim_job(job_id)
+    if job is None:
+        return False
+
+    try:
+        import_string(job.name)(**job.payload)
+    except RetryLater as e:
+        Job.objects.filter(pk=job.pk).update(
+            status=Job.STATUS_QUEUED,
+            run_at=timezone.now() + timedelta(seconds=e.delay),
+            locked_until=None,
+            last_error=str(e),
+            updated_on=timezone.now(),
+        )
+        return False
+    except Exception as e:
+        attempts = job.attempts + 1
+        failed = attempts >= job.max_attempts
+        Job.objects.filter(pk=job.pk).update(
+            status=Job.STATUS_FAILED if failed else Job.STATUS_QUEUED,
+            attempts=attempts,
+            run_at=timezone.now() + timedelta(seconds=0 if failed else backoff_delay(attempts)),
+            locked_until=None,
+            last_error=f"{e}\n{traceback.format_exc()}",
+            updated_on=timezone.now(),
+        )
+        print(f"Error running job {job.name} ({job.pk}), attempt {attempts}: {e}")
+        if failed and job.on_failure:
+            try:
+                import_string(job.on_failure)(**job.payload)
+            except Exception as e:
+                print(f"Error running failure handler of job {job.name} ({job.pk}): {e}")
+        return False
+
+    Job.objects.filter(pk=job.pk).update(
+        status=Job.STATUS_DONE, attempts=job.attempts + 1, locked_until=None, updated_on=timezone.now()
+    )
+    return True
+
+
+def due_job_ids(limit=100, names=None):
+    now = timezone.now()
+    queryset = Job.objects.filter(
+        Q(status=Job.STATUS_QUEUED) | Q(status=Job.STATUS_RUNNING, locked_until__lt=now),
+        run_at__lte=now,
+    )
+    if names:
+        queryset = queryset.filter(name__in=names)
+    return list(queryset.order_by('run_at').values_list('pk', flat=True)[:limit])
+
+
+def run_due_jobs(limit=100, names=None):
+    """Run up to ``limit`` due jobs one after the other, returns (succeeded, failed)"""
+    succeeded = failed = 0
+    for job_id in due_job_ids(limit=limit, names=names):
+        if run_job(job_id):
+            succeeded += 1
+        else:
+            failed += 1
+    return succeeded, failed
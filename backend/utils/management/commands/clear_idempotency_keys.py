@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from utils.idempotency import clear_expired_keys
+
+
+class Command(BaseCommand):
+    help = "Delete expired idempotency keys, in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        deleted = clear_expired_keys(batch_size=options['batch_size'])
+        self.stdout.write(f"Deleted {deleted} expired idempotency keys")
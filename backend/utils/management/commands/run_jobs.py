@@ -0,0 +1,45 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+
+from utils.jobs import run_due_jobs
+
+
+class Command(BaseCommand):
+    help = "Run queued background jobs, keeps polling for new ones unless --once is given"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Run the jobs that are due and exit")
+        parser.add_argument('--workers', type=int, default=1, help="Number of worker threads")
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--poll-interval', type=float, default=1.0)
+        parser.add_argument('--name', action='append', dest='names', help="Only run jobs with this dotted name")
+
+    def work(self, options):
+        try:
+            while True:
+                close_old_connections()
+                succeeded, failed = run_due_jobs(limit=options['batch_size'], names=options['names'])
+                if succeeded or failed:
+                    self.stdout.write(f"Ran {succeeded + failed} jobs, {failed} failed")
+                if options['once']:
+                    return
+                if not (succeeded or failed):
+                    time.sleep(options['poll_interval'])
+        finally:
+            connections.close_all()
+
+    def handle(self, *args, **options):
+        if options['workers'] <= 1:
+            return self.work(options)
+
+        # Jobs are claimed with a conditional UPDATE, so the threads can share the queue safely
+        threads = [
+            threading.Thread(target=self.work, args=(options,), daemon=True) for _ in range(options['workers'])
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+
+from utils.pesapal_simulator import PesapalSimulator, make_simulator_server
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve a local Pesapal stand-in for offline load and integration tests. "
+        "Set PESAPAL_BASE_URL to http://HOST:PORT for the app under test."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--latency', type=float, nargs=2, default=[0.05, 0.2], metavar=('MIN', 'MAX'),
+                            help="Seconds added to every request")
+        parser.add_argument('--error-rate', type=float, default=0.0, help="Share of requests answered with a 500")
+        parser.add_argument('--complete-rate', type=float, default=1.0, help="Share of payments that complete")
+        parser.add_argument('--ipn-delay', type=float, default=2.0, help="Seconds until a payment settles")
+        parser.add_argument('--ipn-url', default='http://127.0.0.1:8000/api/commerce/payment-callback/',
+                            help="IPN endpoint used when an order's notification_id is unknown")
+        parser.add_argument('--token-ttl', type=int, default=300)
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--verbose-requests', action='store_true', help="Log every request")
+
+    def handle(self, *args, **options):
+        simulator = PesapalSimulator(
+            latency=tuple(options['latency']),
+            error_rate=options['error_rate'],
+            complete_rate=options['complete_rate'],
+            ipn_delay=options['ipn_delay'],
+            ipn_url=options['ipn_url'],
+            token_ttl=options['token_ttl'],
+            seed=options['seed'],
+        )
+        server = make_simulator_server(
+            simulator, options['host'], options['port'], quiet=not options['verbose_requests']
+        )
+        self.stdout.write(f"Pesapal simulator listening on http://{options['host']}:{options['port']}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(f"Stopped, {simulator.stats}")
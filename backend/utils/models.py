@@ -1,3 +1,4 @@
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 
 # Create your models here.
@@ -13,38 +14,97 @@ class TimeStampedModel(models.Model):
 
 
 class Image(TimeStampedModel):
-    """Model for storing images with Cloudinary integration"""
+    """Model for storing images through the configured media storage provider"""
     file = models.ImageField(upload_to='images')
     cloudinary_url = models.URLField(blank=True, null=True)
     public_id = models.CharField(max_length=255, blank=True, null=True)
     
     def save(self, *args, **kwargs):
-        # If this is a new image being saved and we're using Cloudinary
-        from django.conf import settings
-        if hasattr(settings, 'DEFAULT_FILE_STORAGE') and 'cloudinary' in settings.DEFAULT_FILE_STORAGE:
-            # Only upload to Cloudinary if we have a file and no public_id yet
-            if self.file and not self.public_id and not self.cloudinary_url:
-                from .cloudinary_utils import upload_file_to_cloudinary
-                # Upload the file to Cloudinary
-                result = upload_file_to_cloudinary(
-                    file=self.file,
-                    folder='images',
-                    resource_type='image'
-                )
-                # Store the Cloudinary URL and public_id
-                self.cloudinary_url = result.get('secure_url')
-                self.public_id = result.get('public_id')
+        # Only upload if we have a new file and no public_id yet
+        if self.file and not self.public_id and not self.cloudinary_url:
+            from .storage import get_media_storage
+            # Upload the file through the configured media storage provider
+            result = get_media_storage().upload(
+                file=self.file,
+                folder='images',
+                resource_type='image'
+            )
+            # Store the provider URL and public_id
+            self.cloudinary_url = result.get('url')
+            self.public_id = result.get('public_id')
+            # Point the file field at the stored object so it is not written a second time
+            self.file = self.public_id
         
         super().save(*args, **kwargs)
     
     def delete(self, *args, **kwargs):
-        # Delete from Cloudinary if we have a public_id
+        # Delete from the media storage provider if we have a public_id
         if self.public_id:
-            from .cloudinary_utils import delete_file_from_cloudinary
+            from .storage import get_media_storage
             try:
-                delete_file_from_cloudinary(self.public_id)
+                get_media_storage().delete(self.public_id)
             except Exception as e:
                 # Log the error but continue with deletion
-                print(f"Error deleting from Cloudinary: {e}")
+                print(f"Error deleting stored media: {e}")
         
         super().delete(*args, **kwargs)
+
+
+class Job(TimeStampedModel):
+    """
+    A unit of background work run by ``manage.py run_jobs``, see utils/jobs.py.
+    ``name`` is the dotted path of the function called with ``payload`` as keyword arguments.
+    """
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    name = models.CharField(max_length=200)
+    # Dotted path of a function called with ``payload`` once every attempt has failed
+    on_failure = models.CharField(max_length=200, blank=True)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField()
+    # A running job whose worker died is picked up again once this has passed
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['-id']
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='job_status_run_at_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.status})"
+
+
+class IdempotencyKey(TimeStampedModel):
+    """
+    The stored outcome of a request sent with an ``Idempotency-Key`` header, see utils/idempotency.py.
+    Retries with the same key get ``response_body`` back instead of running the view again.
+    """
+    scope = models.CharField(max_length=150)
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        ordering = ['-id']
+        constraints = [
+            models.UniqueConstraint(fields=['scope', 'key'], name='idempotencykey_scope_key_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.scope}:{self.key}"
@@ -0,0 +1,227 @@
+"""
+A local stand-in for the Pesapal API 3.0 endpoints used by utils.checkout.Pesapal, for offline load and
+integration tests. Run it with ``manage.py run_pesapal_simulator`` and point PESAPAL_BASE_URL at it.
+
+Only the standard library is used so the simulator can also run next to a load generator without Django.
+"""
+import json
+import random
+import socketserver
+import threading
+import time
+import urllib.request
+import uuid
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _iso(moment):
+    return moment.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class PesapalSimulator:
+    """
+    WSGI app implementing RequestToken, RegisterIPN, SubmitOrderRequest and GetTransactionStatus.
+
+    Args:
+        latency: (min, max) seconds added to every request
+        error_rate: Share of requests answered with a 500
+        complete_rate: Share of submitted orders that end up Completed, the rest Failed
+        ipn_delay: Seconds between an order being submitted and its payment settling
+        ipn_url: Where settled payments are notified when the order's notification_id is unknown
+        token_ttl: Lifetime of issued tokens in seconds
+    """
+
+    def __init__(self, latency=(0, 0), error_rate=0.0, complete_rate=1.0, ipn_delay=2.0, ipn_url=None,
+                 token_ttl=300, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.complete_rate = complete_rate
+        self.ipn_delay = ipn_delay
+        self.ipn_url = ipn_url
+        self.token_ttl = token_ttl
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.ipns = {}
+        self.orders = {}
+        self.references = set()
+        self.stats = {'requests': 0, 'errors': 0, 'ipn_sent': 0, 'ipn_failed': 0}
+
+    def __call__(self, environ, start_response):
+        with self.lock:
+            self.stats['requests'] += 1
+            fail = self.random.random() < self.error_rate
+            delay = self.random.uniform(*self.latency)
+        if delay:
+            time.sleep(delay)
+
+        routes = {
+            ('POST', '/api/Auth/RequestToken'): self.request_token,
+            ('POST', '/api/URLSetup/RegisterIPN'): self.register_ipn,
+            ('POST', '/api/Transactions/SubmitOrderRequest'): self.submit_order_request,
+            ('GET', '/api/Transactions/GetTransactionStatus'): self.get_transaction_status,
+        }
+        path = environ.get('PATH_INFO', '')
+        handler = routes.get((environ['REQUEST_METHOD'], path))
+        if handler is None:
+            return self.respond(start_response, 404, {'error': {'code': 'not_found'}, 'status': '404'})
+        if fail:
+            with self.lock:
+                self.stats['errors'] += 1
+            return self.respond(start_response, 500, {'error': {'code': 'simulated_failure'}, 'status': '500'})
+        if path != '/api/Auth/RequestToken' and not self.authorized(environ):
+            return self.respond(start_response, 401, {'error': {'code': 'invalid_token'}, 'status': '401'})
+
+        status, data = handler(environ, self.read_json(environ))
+        return self.respond(start_response, status, data)
+
+    @staticmethod
+    def read_json(environ):
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if not length:
+            return {}
+        try:
+            return json.loads(environ['wsgi.input'].read(length))
+        except ValueError:
+            return {}
+
+    @staticmethod
+    def respond(start_response, status, data):
+        body = json.dumps(data).encode()
+        reasons = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found', 500: 'Internal Server Error'}
+        start_response(f"{status} {reasons.get(status, '')}", [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body))),
+        ])
+        return [body]
+
+    def authorized(self, environ):
+        token = environ.get('HTTP_AUTHORIZATION', '').replace('Bearer ', '', 1)
+        with self.lock:
+            expires_at = self.tokens.get(token)
+        return expires_at is not None and expires_at > _now()
+
+    def request_token(self, environ, data):
+        if not data.get('consumer_key') or not data.get('consumer_secret'):
+            return 200, {'token': None, 'error': {'code': 'invalid_consumer_key_or_secret_provided'}, 'status': '500'}
+        token = uuid.uuid4().hex
+        expires_at = _now() + timedelta(seconds=self.token_ttl)
+        with self.lock:
+            self.tokens[token] = expires_at
+        return 200, {'token': token, 'expiryDate': _iso(expires_at), 'error': None, 'status': '200',
+                     'message': 'Request processed successfully'}
+
+    def register_ipn(self, environ, data):
+        ipn_id = str(uuid.uuid4())
+        with self.lock:
+            self.ipns[ipn_id] = data.get('url')
+        return 200, {'url': data.get('url'), 'created_date': _iso(_now()), 'ipn_id': ipn_id,
+                     'ipn_notification_type_description': data.get('ipn_notification_type', 'POST'),
+                     'ipn_status': 1, 'ipn_status_description': 'Active', 'error': None, 'status': '200'}
+
+    def submit_order_request(self, environ, data):
+        merchant_reference = str(data.get('id') or '')
+        if not merchant_reference:
+            return 200, {'error': {'code': 'missing_unique_id'}, 'status': '500'}
+
+        tracking_id = str(uuid.uuid4())
+        with self.lock:
+            if merchant_reference in self.references:
+                return 200, {'error': {'code': 'duplicate_merchant_reference'}, 'status': '500'}
+            self.references.add(merchant_reference)
+            completed = self.random.random() < self.complete_rate
+            self.orders[tracking_id] = {
+                'merchant_reference': merchant_reference,
+                'amount': data.get('amount'),
+                'currency': data.get('currency', 'KES'),
+                'created_date': _iso(_now()),
+                'settles_at': time.monotonic() + self.ipn_delay,
+                'outcome': 'Completed' if completed else 'Failed',
+                'ipn_url': self.ipns.get(data.get('notification_id')) or self.ipn_url,
+            }
+
+        timer = threading.Timer(self.ipn_delay, self.send_ipn, args=(tracking_id,))
+        timer.daemon = True
+        timer.start()
+
+        host = environ.get('HTTP_HOST', 'localhost')
+        return 200, {'order_tracking_id': tracking_id, 'merchant_reference': merchant_reference,
+                     'redirect_url': f"http://{host}/pay/{tracking_id}", 'error': None, 'status': '200'}
+
+    def payment_status(self, tracking_id):
+        with self.lock:
+            order = self.orders.get(tracking_id)
+        if order is None:
+            return None
+        settled = time.monotonic() >= order['settles_at']
+        description = order['outcome'] if settled else 'INVALID'
+        return {
+            'payment_method': 'MpesaKE' if settled else '',
+            'amount': order['amount'],
+            'created_date': order['created_date'],
+            'confirmation_code': uuid.uuid4().hex[:10].upper() if description == 'Completed' else '',
+            'payment_status_description': description,
+            'description': '',
+            'message': 'Request processed successfully',
+            'payment_account': '',
+            'call_back_url': '',
+            'status_code': {'INVALID': 0, 'Completed': 1, 'Failed': 2}[description],
+            'merchant_reference': order['merchant_reference'],
+            'currency': order['currency'],
+            'error': {'error_type': None, 'code': None, 'message': None},
+            'status': '200',
+        }
+
+    def get_transaction_status(self, environ, data):
+        tracking_id = parse_qs(environ.get('QUERY_STRING', '')).get('orderTrackingId', [''])[0]
+        status = self.payment_status(tracking_id)
+        if status is None:
+            return 200, {'error': {'code': 'order_not_found'}, 'status': '500'}
+        return 200, status
+
+    def send_ipn(self, tracking_id):
+        with self.lock:
+            order = self.orders.get(tracking_id)
+        if not order or not order['ipn_url']:
+            return
+        body = json.dumps({
+            'OrderTrackingId': tracking_id,
+            'OrderMerchantReference': order['merchant_reference'],
+            'OrderNotificationType': 'IPNCHANGE',
+        }).encode()
+        request = urllib.request.Request(
+            order['ipn_url'], data=body, headers={'Content-Type': 'application/json'}, method='POST'
+        )
+        try:
+            urllib.request.urlopen(request, timeout=10).close()
+            key = 'ipn_sent'
+        except Exception as e:
+            print(f"Error sending simulated IPN for {tracking_id}: {e}")
+            key = 'ipn_failed'
+        with self.lock:
+            self.stats[key] += 1
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+def make_simulator_server(simulator, host='127.0.0.1', port=8765, quiet=True):
+    """A threaded WSGI server for ``simulator``, call ``serve_forever()`` on it"""
+    return make_server(host, port, simulator, server_class=ThreadingWSGIServer,
+                       handler_class=QuietHandler if quiet else WSGIRequestHandler)
@@ -0,0 +1,205 @@
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+
+class GatewayUnavailable(APIException):
+    """
+    Raised instead of calling a gateway that is failing or saturated, ``retry_after`` is in seconds.
+    Views that let it through answer 503 right away.
+    """
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_code = 'gateway_unavailable'
+
+    def __init__(self, message, retry_after=None):
+        self.retry_after = retry_after
+        super().__init__(detail=message)
+
+
+class CircuitOpenError(GatewayUnavailable):
+    pass
+
+
+class BulkheadFullError(GatewayUnavailable):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker whose state lives in the Django cache so every worker shares it.
+
+    Closed: calls go through and failures are counted in a ``window`` second bucket. Reaching
+    ``failure_threshold`` opens the breaker for ``reset_timeout`` seconds, calls then fail fast with
+    CircuitOpenError. Half open: once the timeout passed a single probe call is let through, its success
+    closes the breaker and its failure opens it again.
+    """
+
+    def __init__(self, name, failure_threshold=5, window=60, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.failures_key = f"breaker:{name}:failures"
+        self.opened_key = f"breaker:{name}:opened_until"
+        self.probe_key = f"breaker:{name}:probe"
+
+    @property
+    def state(self):
+        opened_until = cache.get(self.opened_key)
+        if opened_until is None:
+            return 'closed'
+        return 'open' if time.time() < opened_until else 'half_open'
+
+    def before_call(self):
+        """Raise CircuitOpenError unless the call may go ahead, returns True for a half open probe"""
+        opened_until = cache.get(self.opened_key)
+        if opened_until is None:
+            return False
+        remaining = opened_until - time.time()
+        if remaining > 0:
+            raise CircuitOpenError(f"{self.name} circuit is open", retry_after=remaining)
+        if not cache.add(self.probe_key, True, self.reset_timeout):
+            raise CircuitOpenError(f"{self.name} circuit is half open", retry_after=self.reset_timeout)
+        return True
+
+    def release_probe(self):
+        """Give the half open probe back when it never reached the gateway, the next call probes instead"""
+        cache.delete(self.probe_key)
+
+    def record_success(self, probe=False):
+        if probe:
+            cache.delete_many([self.opened_key, self.failures_key, self.probe_key])
+
+    def record_failure(self, probe=False):
+        if probe:
+            self.open()
+            return
+        cache.add(self.failures_key, 0, self.window)
+        try:
+            failures = cache.incr(self.failures_key)
+        except ValueError:
+            # The bucket expired between add and incr
+            cache.set(self.failures_key, 1, self.window)
+            failures = 1
+        if failures >= self.failure_threshold:
+            self.open()
+
+    def open(self):
+        # Kept until well after the timeout so half open is still detected, closing deletes it
+        cache.set(self.opened_key, time.time() + self.reset_timeout, self.reset_timeout * 10)
+        cache.delete_many([self.failures_key, self.probe_key])
+
+    def reset(self):
+        cache.delete_many([self.opened_key, self.failures_key, self.probe_key])
+
+
+class Bulkhead:
+    """
+    Caps how many calls, across all workers, are inside a gateway at once.
+
+    Each call takes one of ``size`` slot keys in the cache with ``cache.add``. Slots expire after
+    ``slot_ttl`` seconds so a worker that died mid call cannot leak one. When every slot is taken for
+    ``wait`` seconds the call fails with BulkheadFullError instead of queueing up.
+    """
+
+    def __init__(self, name, size=10, wait=0.5, slot_ttl=60):
+        self.name = name
+        self.size = size
+        self.wait = wait
+        self.slot_ttl = slot_ttl
+
+    def _slot_key(self, slot):
+        return f"bulkhead:{self.name}:{slot}"
+
+    def acquire(self):
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.wait
+        while True:
+            slots = list(range(self.size))
+            random.shuffle(slots)
+            for slot in slots:
+                if cache.add(self._slot_key(slot), token, self.slot_ttl):
+                    return slot, token
+            if time.monotonic() >= deadline:
+                raise BulkheadFullError(f"{self.name} has {self.size} calls in flight", retry_after=self.wait)
+            time.sleep(0.05)
+
+    def release(self, slot, token):
+        key = self._slot_key(slot)
+        if cache.get(key) == token:
+            cache.delete(key)
+
+    @contextmanager
+    def __call__(self):
+        slot, token = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(slot, token)
+
+
+class GatewayGuard:
+    """Runs gateway calls inside a bulkhead and a circuit breaker"""
+
+    def __init__(self, breaker, bulkhead):
+        self.breaker = breaker
+        self.bulkhead = bulkhead
+
+    def call(self, func, *args, is_failure=None, **kwargs):
+        """
+        Call ``func``, counting exceptions and results for which ``is_failure(result)`` is true as failures.
+        Raises GatewayUnavailable without calling it when the breaker is open or the bulkhead is full.
+        """
+        probe = self.breaker.before_call()
+        try:
+            slot, token = self.bulkhead.acquire()
+        except BulkheadFullError:
+            if probe:
+                self.breaker.release_probe()
+            raise
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.breaker.record_failure(probe)
+            raise
+        finally:
+            self.bulkhead.release(slot, token)
+        if is_failure and is_failure(result):
+            self.breaker.record_failure(probe)
+        else:
+            self.breaker.record_success(probe)
+        return result
+
+
+@lru_cache(maxsize=None)
+def get_gateway_guard(name) -> GatewayGuard:
+    """The guard for the gateway ``name``, configured by the PAYMENT_BREAKER_* and PAYMENT_BULKHEAD_* settings"""
+    return GatewayGuard(
+        CircuitBreaker(
+            name,
+            failure_threshold=getattr(settings, 'PAYMENT_BREAKER_FAILURE_THRESHOLD', 5),
+            window=getattr(settings, 'PAYMENT_BREAKER_WINDOW', 60),
+            reset_timeout=getattr(settings, 'PAYMENT_BREAKER_RESET_TIMEOUT', 30),
+        ),
+        Bulkhead(
+            name,
+            size=getattr(settings, 'PAYMENT_BULKHEAD_SIZE', 10),
+            wait=getattr(settings, 'PAYMENT_BULKHEAD_WAIT', 0.5),
+            slot_ttl=getattr(settings, 'PAYMENT_BULKHEAD_SLOT_TTL', 60),
+        ),
+    )
+
+
+@receiver(setting_changed)
+def reset_gateway_guards(sender, setting, **kwargs):
+    if setting.startswith(('PAYMENT_BREAKER_', 'PAYMENT_BULKHEAD_')):
+        get_gateway_guard.cache_clear()
@@ -0,0 +1,220 @@
+import mimetypes
+import os
+import uuid
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Union
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import InMemoryUploadedFile, TemporaryUploadedFile
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+
+def build_public_id(file_name: str) -> str:
+    """
+    Build a URL-friendly, collision resistant identifier from a file name
+
+    Args:
+        file_name: The original name of the uploaded file
+
+    Returns:
+        str: The sanitized base name suffixed with a short random hex string
+    """
+    filename = os.path.splitext(os.path.basename(file_name))[0]
+    safe_filename = "".join([c if c.isalnum() else "_" for c in filename])
+    return f"{safe_filename}_{uuid.uuid4().hex[:8]}"
+
+
+def resource_type_for_media(media_type: Optional[str]) -> str:
+    """
+    Map a ``main.Media.type`` classification to a storage resource type
+
+    Args:
+        media_type: One of image, video, audio, document or unknown
+
+    Returns:
+        str: The resource type understood by the storage backends (image, video, raw)
+    """
+    if media_type == 'image':
+        return 'image'
+    if media_type in ('video', 'audio'):
+        # Cloudinary stores audio under the video resource type
+        return 'video'
+    return 'raw'
+
+
+class BaseMediaStorage:
+    """
+    Interface every media storage provider implements.
+
+    ``upload`` returns a dict with at least ``public_id`` and ``url`` so that the
+    models can persist the reference without knowing which provider stored it.
+    """
+
+    def upload(
+        self,
+        file: Union[InMemoryUploadedFile, TemporaryUploadedFile],
+        folder: str = "uploads",
+        resource_type: str = "auto",
+        public_id: Optional[str] = None,
+        **options
+    ) -> Dict:
+        raise NotImplementedError
+
+    def delete(self, public_id: str, resource_type: str = "image") -> Dict:
+        raise NotImplementedError
+
+    def delete_many(self, public_ids: Iterable[str], resource_type: str = "image") -> Dict:
+        """
+        Delete several stored files. Providers with a batch API should override this.
+        """
+        deleted = {}
+        for public_id in public_ids:
+            deleted[public_id] = self.delete(public_id, resource_type=resource_type)
+        return {"deleted": deleted}
+
+    def url(self, public_id: str, **options) -> str:
+        raise NotImplementedError
+
+
+class CloudinaryMediaStorage(BaseMediaStorage):
+    """Stores media on Cloudinary through ``utils.cloudinary_utils``"""
+
+    # Cloudinary's Admin API accepts at most 100 public ids per delete_resources call
+    delete_batch_size = 100
+
+    # Files above this size are sent with the chunked upload API straight from their temporary file
+    large_upload_threshold = 20 * 1024 * 1024
+
+    def upload(self, file, folder="uploads", resource_type="auto", public_id=None, **options):
+        from .cloudinary_utils import upload_file_to_cloudinary
+
+        if hasattr(file, 'temporary_file_path') and (file.size or 0) > self.large_upload_threshold:
+            import cloudinary.uploader
+
+            result = cloudinary.uploader.upload_large(
+                file.temporary_file_path(),
+                folder=folder,
+                public_id=public_id or build_public_id(file.name),
+                resource_type=resource_type,
+                overwrite=True,
+                chunk_size=self.large_upload_threshold,
+                **options
+            )
+            result = dict(result)
+            result["url"] = result.get("secure_url") or result.get("url")
+            return result
+
+        result = upload_file_to_cloudinary(
+            file=file,
+            folder=folder,
+            resource_type=resource_type,
+            public_id=public_id,
+            **options
+        )
+        result = dict(result)
+        result["url"] = result.get("secure_url") or result.get("url")
+        return result
+
+    def delete(self, public_id, resource_type="image"):
+        from .cloudinary_utils import delete_file_from_cloudinary
+
+        return delete_file_from_cloudinary(public_id, resource_type=resource_type)
+
+    def delete_many(self, public_ids, resource_type="image"):
+        import cloudinary.api
+
+        public_ids = [public_id for public_id in public_ids if public_id]
+        deleted = {}
+        for start in range(0, len(public_ids), self.delete_batch_size):
+            batch = public_ids[start:start + self.delete_batch_size]
+            result = cloudinary.api.delete_resources(batch, resource_type=resource_type)
+            deleted.update(result.get("deleted", {}))
+        return {"deleted": deleted}
+
+    def url(self, public_id, **options):
+        from .cloudinary_utils import get_cloudinary_url
+
+        return get_cloudinary_url(public_id, secure=True, **options)
+
+
+class LocalMediaStorage(BaseMediaStorage):
+    """
+    Stores media on the local filesystem under ``MEDIA_ROOT``.
+
+    The public id is the path relative to ``MEDIA_ROOT`` which lets the file
+    fields of the models point at the stored file directly.
+    """
+
+    def __init__(self, location: Optional[str] = None, base_url: Optional[str] = None):
+        self.location = location or getattr(settings, 'MEDIA_ROOT', None) or 'data/media/'
+        base_url = base_url or getattr(settings, 'MEDIA_URL', None) or '/media/'
+        if not base_url.startswith(('/', 'http://', 'https://')):
+            base_url = f"/{base_url}"
+        if not base_url.endswith('/'):
+            base_url = f"{base_url}/"
+        self.base_url = base_url
+        self.storage = FileSystemStorage(location=self.location, base_url=self.base_url)
+
+    def upload(self, file, folder="uploads", resource_type="auto", public_id=None, **options):
+        extension = os.path.splitext(file.name)[1].lower()
+        public_id = public_id or build_public_id(file.name)
+        name = self.storage.save(f"{folder}/{public_id}{extension}", file)
+
+        return {
+            "public_id": name,
+            "url": self.url(name),
+            "resource_type": resource_type,
+            "format": extension.lstrip('.'),
+            "bytes": self.storage.size(name),
+            "content_type": mimetypes.guess_type(name)[0],
+        }
+
+    def delete(self, public_id, resource_type="image"):
+        if not self.storage.exists(public_id):
+            return {"result": "not found"}
+        self.storage.delete(public_id)
+        return {"result": "ok"}
+
+    def url(self, public_id, **options):
+        return self.storage.url(public_id)
+
+    def path(self, public_id: str) -> str:
+        """Absolute filesystem path of a stored file, raises SuspiciousFileOperation outside MEDIA_ROOT"""
+        return self.storage.path(public_id)
+
+
+@lru_cache(maxsize=None)
+def get_media_storage() -> BaseMediaStorage:
+    """
+    Return the media storage provider configured by ``MEDIA_STORAGE_BACKEND``
+    """
+    backend = getattr(settings, 'MEDIA_STORAGE_BACKEND', 'utils.storage.CloudinaryMediaStorage')
+    return import_string(backend)()
+
+
+@receiver(setting_changed)
+def reset_media_storage(sender, setting, **kwargs):
+    if setting in ('MEDIA_STORAGE_BACKEND', 'MEDIA_ROOT', 'MEDIA_URL'):
+        get_media_storage.cache_clear()
+
+
+def delete_stored_files(references: List[tuple]) -> None:
+    """
+    Batch delete ``(public_id, resource_type)`` pairs from the configured provider
+
+    Failures are logged rather than raised so that database deletes can still go ahead.
+    """
+    by_type = {}
+    for public_id, resource_type in references:
+        if public_id:
+            by_type.setdefault(resource_type, []).append(public_id)
+
+    storage = get_media_storage()
+    for resource_type, public_ids in by_type.items():
+        try:
+            storage.delete_many(public_ids, resource_type=resource_type)
+        except Exception as e:
+            print(f"Error deleting stored media: {e}")
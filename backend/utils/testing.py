@@ -0,0 +1,34 @@
+import threading
+from contextlib import nullcontext
+
+from django.db import connection, connections
+
+
+def run_concurrently(target, args_list, db_writes=True):
+    """
+    Call ``target(*args)`` for every ``args`` in ``args_list``, each in a thread of its own and all released at
+    the same moment. Returns the exceptions raised by the calls.
+
+    SQLite raises "database table is locked" instead of waiting for a concurrent writer, so calls that write
+    (``db_writes``) take turns there. Backends with row locks (MySQL, PostgreSQL) run them truly concurrently.
+    """
+    barrier = threading.Barrier(len(args_list))
+    turn = threading.Lock() if db_writes and connection.vendor == 'sqlite' else nullcontext()
+    errors = []
+
+    def run(args):
+        try:
+            barrier.wait()
+            with turn:
+                target(*args)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=run, args=(args,)) for args in args_list]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
@@ -1,3 +1,501 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import requests
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils.http import http_date
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory
+from rest_framework.views import APIView
+
+from .checkout import Pesapal
+from .gateways import COMPLETED, FAILED, PENDING, PaymentGatewayError, PesapalGateway
+from .httpclient import HttpClient
+from .idempotency import idempotent
+from .models import IdempotencyKey
+from .pesapal_simulator import PesapalSimulator, make_simulator_server
+from .resilience import Bulkhead, BulkheadFullError, CircuitBreaker, CircuitOpenError, GatewayGuard
+from .storage import get_media_storage
+from .testing import run_concurrently
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers according to the path: /ok, /slow, /flaky (503 until the third call) and /fail (always 503)"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.hits[self.path] = self.server.hits.get(self.path, 0) + 1
+        self.server.client_ports.add(self.client_address[1])
+
+        if self.path == '/slow':
+            time.sleep(0.5)
+        if self.path == '/fail' or (self.path == '/flaky' and self.server.hits[self.path] < 3):
+            return self.reply(503, {'error': 'unavailable'})
+        return self.reply(200, {'path': self.path})
+
+    do_POST = do_GET
+
+    def reply(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class HttpClientTests(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        cls.server.daemon_threads = True
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.server.hits = {}
+        self.server.client_ports = set()
+        self.client = HttpClient(timeouts={'slow': (1, 0.1)}, max_retries=2, backoff=0.01)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_reuses_pooled_connection(self):
+        for _ in range(5):
+            self.assertEqual(self.client.get('ok', f"{self.base_url}/ok").status_code, 200)
+
+        self.assertEqual(len(self.server.client_ports), 1)
+
+    def test_read_timeout_per_endpoint(self):
+        with self.assertRaises(requests.Timeout):
+            self.client.request('slow', 'GET', f"{self.base_url}/slow", idempotent=False)
+
+        self.assertEqual(self.client.metrics()['slow']['errors'], 1)
+
+    def test_retries_idempotent_calls(self):
+        response = self.client.get('flaky', f"{self.base_url}/flaky")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.server.hits['/flaky'], 3)
+        self.assertEqual(self.client.metrics()['flaky']['retries'], 2)
+
+    def test_does_not_retry_posts(self):
+        response = self.client.post('fail', f"{self.base_url}/fail")
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.server.hits['/fail'], 1)
+
+    def test_retries_are_bounded(self):
+        response = self.client.get('fail', f"{self.base_url}/fail")
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.server.hits['/fail'], 3)
+        metrics = self.client.metrics()['fail']
+        self.assertEqual((metrics['calls'], metrics['errors']), (3, 3))
+
+
+class GatewayGuardTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.now = 1000.0
+        clock = mock.patch('utils.resilience.time.time', side_effect=lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+        self.breaker = CircuitBreaker('test', failure_threshold=3, window=60, reset_timeout=30)
+        self.bulkhead = Bulkhead('test', size=1, wait=0)
+        self.guard = GatewayGuard(self.breaker, self.bulkhead)
+        self.calls = 0
+
+    def gateway(self, status_code=200):
+        self.calls += 1
+        if status_code is None:
+            raise requests.ConnectionError('down')
+        return SimpleNamespace(status_code=status_code)
+
+    def call(self, status_code=200):
+        return self.guard.call(self.gateway, status_code, is_failure=lambda response: response.status_code >= 500)
+
+    def open_breaker(self):
+        for status_code in (503, None, 500):
+            try:
+                self.call(status_code)
+            except requests.ConnectionError:
+                pass
+
+    def test_opens_after_failures_and_fails_fast(self):
+        self.call(503)
+        self.call(200)
+        with self.assertRaises(requests.ConnectionError):
+            self.call(None)
+        self.assertEqual(self.breaker.state, 'closed')
+        self.call(500)
+        self.assertEqual(self.breaker.state, 'open')
+
+        self.now += 10
+        with self.assertRaises(CircuitOpenError) as raised:
+            self.call()
+        self.assertEqual(raised.exception.retry_after, 20)
+        self.assertEqual(self.calls, 4)
+
+    def test_half_open_probe_closes_on_success(self):
+        self.open_breaker()
+        self.now += 31
+        self.assertEqual(self.breaker.state, 'half_open')
+
+        # Only one probe at a time, the others keep failing fast
+        self.breaker.before_call()
+        with self.assertRaises(CircuitOpenError):
+            self.call()
+        self.breaker.release_probe()
+
+        self.call()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.call()
+        self.assertEqual(self.calls, 5)
+
+    def test_half_open_probe_reopens_on_failure(self):
+        self.open_breaker()
+        self.now += 31
+        self.call(503)
+        self.assertEqual(self.breaker.state, 'open')
+        with self.assertRaises(CircuitOpenError):
+            self.call()
+
+        self.now += 31
+        with self.assertRaises(requests.ConnectionError):
+            self.call(None)
+        self.assertEqual(self.breaker.state, 'open')
+
+    def test_probe_is_released_when_the_bulkhead_is_full(self):
+        self.open_breaker()
+        self.now += 31
+        slot, token = self.bulkhead.acquire()
+        with self.assertRaises(BulkheadFullError):
+            self.call()
+        self.assertEqual(self.breaker.state, 'half_open')
+        self.bulkhead.release(slot, token)
+
+        # The next call gets to probe instead of waiting out the probe key
+        self.call()
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_bulkhead_slot_is_released(self):
+        self.call()
+        with self.assertRaises(requests.ConnectionError):
+            self.call(None)
+        self.assertEqual(self.bulkhead.acquire()[0], 0)
+
+
+class CountingView(APIView):
+    """Answers 201 with how often it ran, or the status asked for in the body"""
+    authentication_classes = []
+    permission_classes = []
+    calls = 0
+
+    @idempotent('tests.counting')
+    def post(self, request):
+        CountingView.calls += 1
+        return Response({'calls': CountingView.calls}, status=request.data.get('status', status.HTTP_201_CREATED))
+
+
+class IdempotencyTests(TestCase):
+
+    def setUp(self):
+        CountingView.calls = 0
+        self.factory = APIRequestFactory()
+
+    def post(self, key, data=None):
+        request = self.factory.post('/counting/', data or {}, format='json', HTTP_IDEMPOTENCY_KEY=key)
+        return CountingView.as_view()(request)
+
+    def test_replays_the_first_response(self):
+        first = self.post('key-1')
+        second = self.post('key-1')
+
+        self.assertEqual((first.status_code, second.status_code), (201, 201))
+        self.assertEqual(second.data, {'calls': 1})
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(CountingView.calls, 1)
+        self.assertEqual(self.post('key-2').data, {'calls': 2})
+
+    def test_rejects_key_reused_for_another_request(self):
+        self.post('key-1')
+        self.assertEqual(self.post('key-1', {'other': True}).status_code, 422)
+
+    def test_error_responses_are_not_stored(self):
+        self.assertEqual(self.post('key-1', {'status': 503}).status_code, 503)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+        # The same key can be retried, its first success sticks
+        self.assertEqual(self.post('key-1', {'status': 503}).data, {'calls': 2})
+        self.assertEqual(self.post('key-1', {'status': 200}).data, {'calls': 3})
+        self.assertEqual(self.post('key-1', {'status': 200}).data, {'calls': 3})
+
+    def test_duplicate_finding_a_stored_key_replays_it(self):
+        # What a duplicate sees once the request that inserted the key first has committed
+        self.post('key-1')
+        IdempotencyKey.objects.update(response_body={'calls': 'first'})
+        self.assertEqual(self.post('key-1').data, {'calls': 'first'})
+
+
+class IdempotencyConcurrencyTests(TransactionTestCase):
+
+    workers = 8
+
+    def test_concurrent_duplicates_run_the_view_once(self):
+        CountingView.calls = 0
+        factory = APIRequestFactory()
+        responses = []
+
+        def send():
+            request = factory.post('/counting/', {}, format='json', HTTP_IDEMPOTENCY_KEY='same-key')
+            responses.append(CountingView.as_view()(request))
+
+        errors = run_concurrently(send, [()] * self.workers)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(CountingView.calls, 1)
+        self.assertEqual([response.status_code for response in responses], [201] * self.workers)
+        self.assertEqual({response.data['calls'] for response in responses}, {1})
+
+
+class SimulatorTestCase(TestCase):
+    """Runs a PesapalSimulator per test and points the Pesapal settings at it"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.ipn_server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        cls.ipn_server.daemon_threads = True
+        threading.Thread(target=cls.ipn_server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ipn_server.shutdown()
+        cls.ipn_server.server_close()
+        super().tearDownClass()
+
+    def start_simulator(self, **options):
+        self.ipn_server.hits = {}
+        self.ipn_server.client_ports = set()
+        ipn_url = f"http://127.0.0.1:{self.ipn_server.server_address[1]}/ipn"
+        simulator = PesapalSimulator(ipn_delay=0.2, ipn_url=ipn_url, seed=1, **options)
+        server = make_simulator_server(simulator, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        settings_override = override_settings(
+            PESAPAL_BASE_URL=f"http://127.0.0.1:{server.server_address[1]}",
+            PESAPAL_CONSUMER_KEY='key', PESAPAL_CONSUMER_SECRET='secret', PESAPAL_IPN_ID='ipn',
+            PESAPAL_CALLBACK_URL='http://testserver/callback',
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        cache.clear()
+        return simulator, PesapalGateway(status_concurrency=2)
+
+
+class PesapalSimulatorTests(SimulatorTestCase):
+    """PesapalGateway against the simulator, over real HTTP"""
+
+    def order(self, number):
+        return SimpleNamespace(order_number=number, total=1500, email='buyer@example.com', phone_number='0700000000')
+
+    def wait_for_status(self, gateway, reference):
+        deadline = time.monotonic() + 5
+        while True:
+            payment = gateway.get_status(reference)
+            if payment.settled or time.monotonic() > deadline:
+                return payment
+            time.sleep(0.05)
+
+    def test_payment_round_trip(self):
+        simulator, gateway = self.start_simulator()
+
+        initiation = gateway.initiate_payment(self.order('ORD-1'))
+        self.assertEqual(initiation.merchant_reference, 'ORD-1')
+        self.assertIn(initiation.reference, initiation.redirect_url)
+        self.assertEqual(gateway.get_status(initiation.reference).status, PENDING)
+
+        payment = self.wait_for_status(gateway, initiation.reference)
+        self.assertEqual(payment.status, COMPLETED)
+        self.assertEqual(payment.amount, 1500)
+        self.assertTrue(payment.confirmation_code)
+
+        deadline = time.monotonic() + 5
+        while simulator.stats['ipn_sent'] < 1 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.ipn_server.hits, {'/ipn': 1})
+        # One token served every call
+        self.assertEqual(len(simulator.tokens), 1)
+
+    def test_failed_and_duplicate_payments(self):
+        simulator, gateway = self.start_simulator(complete_rate=0)
+
+        initiation = gateway.initiate_payment(self.order('ORD-2'))
+        self.assertEqual(self.wait_for_status(gateway, initiation.reference).status, FAILED)
+        with self.assertRaises(PaymentGatewayError):
+            gateway.initiate_payment(self.order('ORD-2'))
+        with self.assertRaises(PaymentGatewayError):
+            gateway.get_status('unknown')
+
+    def test_batched_statuses(self):
+        simulator, gateway = self.start_simulator()
+        references = [gateway.initiate_payment(self.order(f"ORD-{number}")).reference for number in range(4)]
+        self.wait_for_status(gateway, references[-1])
+
+        statuses = gateway.get_statuses(references + ['unknown'])
+        self.assertEqual(sorted(statuses), sorted(references))
+        self.assertEqual({payment.status for payment in statuses.values()}, {COMPLETED})
+
+    def test_batched_statuses_stop_while_the_circuit_is_open(self):
+        simulator, gateway = self.start_simulator()
+        references = [gateway.initiate_payment(self.order(f"ORD-{number}")).reference for number in range(4)]
+        requests_sent = simulator.stats['requests']
+        gateway.client.guard.breaker.open()
+        self.addCleanup(gateway.client.guard.breaker.reset)
+
+        with self.assertRaises(CircuitOpenError):
+            gateway.get_statuses(references)
+        self.assertEqual(simulator.stats['requests'], requests_sent)
+
+
+class PesapalTokenTests(SimulatorTestCase):
+
+    def test_token_is_shared(self):
+        simulator, gateway = self.start_simulator()
+        gateway.client.check_payment_status('unknown')
+        gateway.client.check_payment_status('unknown')
+        # Another worker finds the token in the cache
+        Pesapal().register_ipn_url('http://testserver/ipn')
+
+        self.assertEqual(len(simulator.tokens), 1)
+
+    def test_token_is_refreshed_before_it_expires(self):
+        # Tokens closer to their expiry than the refresh margin are not reused
+        simulator, gateway = self.start_simulator(token_ttl=Pesapal.token_refresh_margin - 1)
+        gateway.client.check_payment_status('unknown')
+        gateway.client.check_payment_status('unknown')
+
+        self.assertEqual(len(simulator.tokens), 2)
+
+    def test_rejected_token_is_refreshed_once(self):
+        simulator, gateway = self.start_simulator()
+        gateway.client.check_payment_status('unknown')
+        revoked = cache.get(gateway.client._token_cache_key)
+        simulator.tokens.clear()
+
+        response = gateway.client.check_payment_status('unknown')
+        self.assertEqual(response['error'], {'code': 'order_not_found'})
+        self.assertEqual(len(simulator.tokens), 1)
+        self.assertNotEqual(cache.get(gateway.client._token_cache_key), revoked)
+
+    def test_refresh_is_single_flight(self):
+        simulator, gateway = self.start_simulator(latency=(0.1, 0.1))
+        barrier = threading.Barrier(6)
+        tokens = []
+
+        def fetch():
+            barrier.wait()
+            tokens.append(Pesapal()._get_auth_token())
+
+        threads = [threading.Thread(target=fetch) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(tokens)), 1)
+        self.assertEqual(len(simulator.tokens), 1)
+
+
+class MediaServingTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(
+            MEDIA_ROOT=self.media_root, MEDIA_STORAGE_BACKEND='utils.storage.LocalMediaStorage',
+            MEDIA_SENDFILE_HEADER=None
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.content = bytes(range(256)) * 4
+        self.public_id = get_media_storage().upload(SimpleUploadedFile('clip.mp4', self.content), folder='media')[
+            'public_id'
+        ]
+
+    def get(self, path=None, **headers):
+        return self.client.get(reverse('serve-media', kwargs={'path': path or self.public_id}), **headers)
+
+    def test_serves_whole_file(self):
+        response = self.get()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['Content-Type'], 'video/mp4')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('max-age=', response['Cache-Control'])
+
+        last_modified = os.path.getmtime(os.path.join(self.media_root, self.public_id))
+        self.assertEqual(self.get(HTTP_IF_MODIFIED_SINCE=http_date(last_modified + 1)).status_code, 304)
+
+    def test_serves_byte_ranges(self):
+        for header, first, last in [('bytes=10-19', 10, 19), ('bytes=1000-', 1000, 1023), ('bytes=-4', 1020, 1023),
+                                    ('bytes=1020-5000', 1020, 1023)]:
+            response = self.get(HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 206, header)
+            self.assertEqual(b''.join(response.streaming_content), self.content[first:last + 1], header)
+            self.assertEqual(response['Content-Range'], f'bytes {first}-{last}/1024', header)
+            self.assertEqual(response['Content-Length'], str(last - first + 1), header)
+
+        # Several ranges are answered with the whole file
+        self.assertEqual(self.get(HTTP_RANGE='bytes=0-1,5-6').status_code, 200)
+
+    def test_unsatisfiable_range(self):
+        response = self.get(HTTP_RANGE='bytes=2048-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */1024')
+
+    def test_missing_files_are_not_found(self):
+        self.assertEqual(self.get('media/missing.mp4').status_code, 404)
+        self.assertEqual(self.get('../../etc/passwd').status_code, 404)
+        self.assertEqual(self.get('media').status_code, 404)
+
+        get_media_storage().delete_many([self.public_id])
+        self.assertEqual(self.get().status_code, 404)
+        with override_settings(MEDIA_STORAGE_BACKEND='utils.storage.CloudinaryMediaStorage'):
+            self.assertEqual(self.get().status_code, 404)
+
+    @override_settings(MEDIA_SENDFILE_HEADER='X-Accel-Redirect', MEDIA_SENDFILE_PREFIX='/protected-media/')
+    def test_sendfile_leaves_the_body_to_the_web_server(self):
+        response = self.get(HTTP_RANGE='bytes=10-19')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{self.public_id}')
+        self.assertEqual(response.content, b'')
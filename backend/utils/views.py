@@ -1,7 +1,116 @@
+import mimetypes
+import posixpath
+import re
+from pathlib import Path
+
+from django.conf import settings
 from django.contrib import messages
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+from .storage import LocalMediaStorage, get_media_storage
+
+BYTE_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
 
 def add_form_errors_to_messages(request, error_dict):
     for field, errors in error_dict.items():
         for error in errors:
             error_message = error.get('message', '')
-            messages.error(request, f"{field.capitalize()}: {error_message}", extra_tags='danger')
\ No newline at end of file
+            messages.error(request, f"{field.capitalize()}: {error_message}", extra_tags='danger')
+
+
+def parse_byte_range(header, size):
+    """
+    ``(first, last)`` byte offsets asked for by a single range ``Range`` header, None to send the whole file.
+    Raises ValueError when the range lies outside a file of ``size`` bytes.
+    """
+    match = BYTE_RANGE_RE.match(header or '')
+    if not match or match.groups() == ('', ''):
+        # Missing, malformed or multiple ranges, the whole file is a valid answer to all of them
+        return None
+    first, last = match.groups()
+    if not first:
+        # bytes=-500 is the last 500 bytes
+        first, last = max(size - int(last), 0), size - 1
+    else:
+        first, last = int(first), min(int(last), size - 1) if last else size - 1
+    if first >= size or first > last:
+        raise ValueError(f"Range {header} is outside the {size} bytes of the file")
+    return first, last
+
+
+def read_file_range(file, first, last, chunk_size=64 * 1024):
+    with file:
+        file.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            chunk = file.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def serve_media(request, path):
+    """
+    Serve a file stored by the local media storage provider.
+
+    When ``MEDIA_SENDFILE_HEADER`` is set (``X-Accel-Redirect`` for nginx, ``X-Sendfile`` for
+    Apache/lighttpd) the body and any ``Range`` are left to the web server, otherwise the file is streamed
+    with ``FileResponse`` which uses ``os.sendfile`` under WSGI servers that support it. A single byte range
+    is answered with a 206 so players can seek in audio and video without downloading the whole file.
+    """
+    storage = get_media_storage()
+    if not isinstance(storage, LocalMediaStorage):
+        raise Http404("Media is not served by this application")
+
+    path = posixpath.normpath(path).lstrip("/")
+    try:
+        fullpath = Path(storage.path(path))
+    except SuspiciousFileOperation:
+        raise Http404("Media file not found")
+    if not fullpath.is_file():
+        raise Http404("Media file not found")
+
+    statobj = fullpath.stat()
+    if not was_modified_since(request.META.get("HTTP_IF_MODIFIED_SINCE"), statobj.st_mtime):
+        return HttpResponseNotModified()
+
+    content_type, encoding = mimetypes.guess_type(str(fullpath))
+    content_type = content_type or "application/octet-stream"
+
+    sendfile_header = getattr(settings, 'MEDIA_SENDFILE_HEADER', None)
+    if sendfile_header:
+        response = HttpResponse(content_type=content_type)
+        if sendfile_header.lower() == 'x-accel-redirect':
+            # nginx expects the internal location, not the filesystem path
+            prefix = getattr(settings, 'MEDIA_SENDFILE_PREFIX', '/protected-media/')
+            response.headers[sendfile_header] = f"{prefix.rstrip('/')}/{path}"
+        else:
+            response.headers[sendfile_header] = str(fullpath)
+    else:
+        try:
+            byte_range = parse_byte_range(request.META.get("HTTP_RANGE"), statobj.st_size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response.headers["Content-Range"] = f"bytes */{statobj.st_size}"
+            return response
+        if byte_range:
+            first, last = byte_range
+            response = StreamingHttpResponse(
+                read_file_range(fullpath.open("rb"), first, last), status=206, content_type=content_type
+            )
+            response.headers["Content-Range"] = f"bytes {first}-{last}/{statobj.st_size}"
+            response.headers["Content-Length"] = str(last - first + 1)
+        else:
+            response = FileResponse(fullpath.open("rb"), content_type=content_type)
+        response.headers["Accept-Ranges"] = "bytes"
+
+    response.headers["Last-Modified"] = http_date(statobj.st_mtime)
+    response.headers["Cache-Control"] = f"public, max-age={getattr(settings, 'MEDIA_CACHE_MAX_AGE', 86400)}"
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    return response
@@ -60,10 +60,12 @@ interface IOrder {
     status: string;
     status_display: string;
     payment_method: string;
+    payment_account?: string;
     pesapal_merchant_reference: string;
     pesapal_order_tracking_id: string;
     pesapal_redirect_url: string;
-    transaction_init_info: {
+    // Raw gateway payloads, only sent for ?include=payloads and detail requests
+    transaction_init_info?: {
       order_tracking_id: string;
       merchant_reference: string;
       redirect_url: string;
@@ -150,8 +152,8 @@ const ViewOrderInformation = ({ item }: { item: IOrder }) => {
                     <Text size="sm" mt="xs">Confirmation Code: {order.transaction.confirmation_code}</Text>
                   )}
                 </Alert>
-                {order.transaction?.all_transaction_info_after_callback?.payment_account && (
-                  <Text size="sm" c="dimmed">Paid via: {order.transaction.all_transaction_info_after_callback.payment_account}</Text>
+                {order.transaction?.payment_account && (
+                  <Text size="sm" c="dimmed">Paid via: {order.transaction.payment_account}</Text>
                 )}
               </>
             ) : (